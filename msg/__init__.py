@@ -2,5 +2,17 @@ if __name__ != "__main__":
     from . import msg
     from . import models
     from . import config
+    from . import cache
+    from . import validation
+    from . import stream
+    from . import ratelimit
+    from . import search
+    from . import export
+    from . import importer
+    from . import hashing
+    from . import metrics
+    from . import profiler
+    from . import replicas
+    from . import sqlite
 
 __version__ = "0.7.8"
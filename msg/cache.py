@@ -0,0 +1,465 @@
+"""msg caches: small, bounded, in-process caches, optionally
+backed by Redis.
+
+"""
+
+import json
+import time
+import threading
+import collections
+
+import redis
+
+
+SET_IF_CURRENT = """
+if (redis.call('GET', KEYS[1]) or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[2], ARGV[2], 'EX', ARGV[3])
+return 1
+"""
+"""str: Lua script storing a value (ARGV[2], for ARGV[3]
+seconds) under KEYS[2], only if the `VersionCounter` at
+KEYS[1] still holds ARGV[1].
+"""
+
+
+class TTLCache(object):
+    """A bounded mapping which forgets its least recently
+    used entries once full, and any entry older than `ttl`
+    seconds.
+
+    Safe to share between threads (and greenlets).
+
+    Arguments:
+        maxsize (int): Maximum number of entries.
+        ttl (float): Seconds an entry lives for.
+        timer (callable): Returns the current time in seconds,
+            replaceable for testing.
+
+    Attributes:
+        hits (int): Number of successful `get` calls.
+        misses (int): Number of `get` calls which found nothing,
+            or found an expired entry.
+
+    """
+
+    def __init__(self, maxsize, ttl, timer=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            return entry is not None and entry[0] > self.timer()
+
+    def get(self, key, default=None):
+        """Get the value stored under `key`, marking it
+        as recently used.
+
+        Arguments:
+            key (hashable): --
+            default (any): Returned if there is no live entry.
+
+        """
+
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires <= self.timer():
+                self.misses += 1
+                return default
+
+            # re-inserting moves the entry to the most
+            # recently used end.
+            self._data[key] = (expires, value)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """Store `value` under `key`, evicting the least
+        recently used entry if full.
+
+        """
+
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (self.timer() + self.ttl, value)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        """Forget `key`, if it's there at all."""
+
+        with self._lock:
+            self._data.pop(key, None)
+
+    def prune(self, predicate):
+        """Forget every entry whose key satisfies `predicate`.
+
+        Arguments:
+            predicate (callable): Takes a key, returns a bool.
+
+        """
+
+        with self._lock:
+            for key in [k for k in self._data if predicate(k)]:
+                del self._data[key]
+
+    def clear(self):
+        """Forget everything, including the hit/miss counts."""
+
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Return a dictionary describing how well this
+        cache is doing.
+
+        """
+
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._data),
+                'maxsize': self.maxsize}
+
+
+class TieredCache(object):
+    """A read-through cache of JSON-serializable values: a
+    per-process `TTLCache` in front of a Redis tier shared by
+    every worker.
+
+    Redis being unavailable is treated as a miss (and counted),
+    never as an error, so callers simply fall back to the
+    database.
+
+    Other workers' local tiers aren't told about a `delete`,
+    so keep the local TTL short.
+
+    A value loaded before a change, but only stored after the
+    change's `delete`, would be left behind for the whole TTL;
+    with `versions`, which must go up with each change before
+    that `delete`, a value is only stored if nothing changed
+    while it was loaded.
+
+    Arguments:
+        local (TTLCache): --
+        redis_client (redis.StrictRedis|None): If None, only
+            the local tier is used.
+        ttl (int): Seconds entries live for in Redis.
+        prefix (str): Prepended to every Redis key.
+        versions (VersionCounter|None): Kept in the same Redis
+            as the cache, if any.
+
+    """
+
+    def __init__(self, local, redis_client=None, ttl=60,
+                 prefix='msg:cache:', versions=None):
+        self.local = local
+        self.redis = redis_client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.versions = versions
+        self.redis_hits = 0
+        self.redis_misses = 0
+        self.redis_errors = 0
+        self.outdated = 0
+        self._script = None
+
+    def get(self, key):
+        """Get the value stored under `key`, or None.
+
+        Arguments:
+            key (str): --
+
+        """
+
+        value = self.local.get(key)
+
+        if value is not None or self.redis is None:
+            return value
+
+        try:
+            raw = self.redis.get(self.prefix + key)
+        except redis.RedisError:
+            self.redis_errors += 1
+            return None
+
+        if raw is None:
+            self.redis_misses += 1
+            return None
+
+        self.redis_hits += 1
+        value = json.loads(raw.decode('utf-8'))
+        self.local.set(key, value)
+        return value
+
+    def version(self):
+        """Get the `versions` number to load a value at, and
+        then `set` it with.
+
+        Returns:
+            int|None: None without `versions`, or if it can't
+                be known right now (so don't `set` at all).
+
+        """
+
+        if self.versions is None:
+            return None
+
+        return self.versions.get()
+
+    def set(self, key, value, version=None):
+        """Store `value` under `key` in both tiers.
+
+        Arguments:
+            key (str): --
+            value (any): Anything JSON-serializable, which must
+                not be mutated afterwards.
+            version (int|None): From `version`, before `value`
+                was loaded; if given, `value` is only stored if
+                `versions` hasn't gone up since.
+
+        Returns:
+            bool: False if `value` was out of date.
+
+        """
+
+        if version is not None and not self._stored(key, value, version):
+            self.outdated += 1
+            return False
+
+        self.local.set(key, value)
+
+        if self.redis is not None and version is None:
+
+            try:
+                self.redis.set(self.prefix + key, json.dumps(value),
+                               ex=self.ttl)
+            except redis.RedisError:
+                self.redis_errors += 1
+
+        return True
+
+    def _stored(self, key, value, version):
+        """Store `value` in Redis (if there's a Redis tier)
+        only if `versions` is still at `version`.
+
+        Returns:
+            bool: False if it's not, or can't be known.
+
+        """
+
+        if self.redis is None:
+            return self.versions.get() == version
+
+        if self._script is None:
+            self._script = self.redis.register_script(SET_IF_CURRENT)
+
+        try:
+            return bool(self._script(keys=[self.versions.key,
+                                           self.prefix + key],
+                                     args=[version, json.dumps(value),
+                                           self.ttl]))
+        except redis.RedisError:
+            self.redis_errors += 1
+            return False
+
+    def read_through(self, key, load):
+        """Get the value stored under `key`, or else load,
+        store and return it.
+
+        Arguments:
+            key (str): --
+            load (callable): Returns the value, or None if there
+                is none (which isn't cached).
+
+        """
+
+        value = self.get(key)
+
+        if value is None:
+            version = self.version()
+            value = load()
+
+            if value is not None and (version is not None
+                                      or self.versions is None):
+                self.set(key, value, version)
+
+        return value
+
+    def delete(self, *keys):
+        """Forget `keys` in both tiers."""
+
+        for key in keys:
+            self.local.delete(key)
+
+        if self.redis is not None and keys:
+
+            try:
+                self.redis.delete(*[self.prefix + key for key in keys])
+            except redis.RedisError:
+                self.redis_errors += 1
+
+    def clear(self):
+        """Forget everything in both tiers, and the stats."""
+
+        self.local.clear()
+        self.redis_hits = 0
+        self.redis_misses = 0
+        self.redis_errors = 0
+        self.outdated = 0
+
+        if self.redis is not None:
+
+            try:
+                keys = list(self.redis.scan_iter(match=self.prefix + '*'))
+
+                if keys:
+                    self.redis.delete(*keys)
+            except redis.RedisError:
+                self.redis_errors += 1
+
+    def stats(self):
+        """Return a dictionary describing how well this
+        cache is doing.
+
+        """
+
+        local = self.local.stats()
+        hits = local['hits'] + self.redis_hits
+        lookups = local['hits'] + local['misses']
+        return {'local': local,
+                'redis_hits': self.redis_hits,
+                'redis_misses': self.redis_misses,
+                'redis_errors': self.redis_errors,
+                'outdated': self.outdated,
+                'hit_rate': float(hits) / lookups if lookups else 0.0}
+
+
+class VersionCounter(object):
+    """A number which goes up whenever something changes,
+    shared by every worker through Redis (or, without Redis,
+    known only to this process).
+
+    If Redis fails to make it go up, the number isn't known
+    (`get` gives None) until it's made to go up after all, as
+    the old one would pass for current.
+
+    Arguments:
+        redis_client (redis.StrictRedis|None): --
+        key (str): Redis key holding the number (and, after
+            ":at", when it last went up).
+        timer (callable): --
+
+    Attributes:
+        errors (int): Number of times Redis failed us.
+
+    """
+
+    def __init__(self, redis_client=None, key='msg:version',
+                 timer=time.time):
+        self.redis = redis_client
+        self.key = key
+        self.timer = timer
+        self.errors = 0
+        self._local = 0
+        self._local_bumped = 0.0
+        self._missed_bump = False
+        self._lock = threading.Lock()
+
+    @property
+    def shared(self):
+        """bool: Whether every worker sees the same number."""
+
+        return self.redis is not None
+
+    def get(self):
+        """Get the current number.
+
+        Returns:
+            int|None: None if it can't be known right now.
+
+        """
+
+        if self.redis is None:
+            return self._local
+
+        # try again to make up for the bump Redis missed
+        if self._missed_bump and not self.bump():
+            return None
+
+        try:
+            value = self.redis.get(self.key)
+        except redis.RedisError:
+            self.errors += 1
+            return None
+
+        return int(value or 0)
+
+    def bump(self):
+        """Make the number go up.
+
+        Returns:
+            bool: False if Redis failed to.
+
+        """
+
+        now = self.timer()
+
+        if self.redis is None:
+
+            with self._lock:
+                self._local += 1
+                self._local_bumped = now
+
+            return True
+
+        try:
+            self.redis.incr(self.key)
+            self.redis.set(self.key + ':at', repr(now))
+        except redis.RedisError:
+            self.errors += 1
+            self._missed_bump = True
+            return False
+
+        self._missed_bump = False
+        return True
+
+    def bumped(self):
+        """Get when the number last went up.
+
+        Returns:
+            float|None: A time, as from `timer` (0 if never);
+                None if it can't be known right now.
+
+        """
+
+        if self.redis is None:
+            return self._local_bumped
+
+        if self._missed_bump:
+            return None
+
+        try:
+            value = self.redis.get(self.key + ':at')
+        except redis.RedisError:
+            self.errors += 1
+            return None
+
+        return float(value or 0)
@@ -1,18 +1,280 @@
 REDIS_URL = "redis://localhost"
 SQLALCHEMY_DATABASE_URI = "sqlite:///:memory:"
+SQLALCHEMY_REPLICA_URIS = []
+"""list: Read-only replicas of `SQLALCHEMY_DATABASE_URI`.
+Requests which only read (getting users and messages) and
+password checks take turns between them, until they write;
+they may lag the primary a little.
+"""
+
+SQLALCHEMY_REPLICA_CHECK_INTERVAL = 5
+"""int: Seconds between checking each replica is up; those
+which aren't are skipped until they are.
+"""
+
+SQLALCHEMY_REPLICA_LAG = 5
+"""int: Most seconds the replicas are expected to lag the
+primary by. For this long after writing, a client reads from
+the primary; and for this long after any change, what's read
+from replicas isn't cached, nor are lists given ETags.
+"""
+
+SQLITE_PRAGMAS = {
+                  "journal_mode": "WAL",
+                  "synchronous": "NORMAL",
+                  "cache_size": -16000,
+                  "mmap_size": 268435456,
+                  "busy_timeout": 5000,
+                 }
+"""dict: Set on each connection to a SQLite file (given as
+`SQLALCHEMY_DATABASE_URI`): WAL, so reads and a write go on
+at once; syncing to disk only at checkpoints, which is safe
+in WAL; 16 MB of page cache and 256 MB of memory mapping per
+connection; and waiting up to 5 seconds for another process
+to finish writing.
+"""
+
+SQLITE_POOL_SIZE = 5
+"""int: Connections to a SQLite file each worker keeps open."""
+
+SQLITE_SINGLE_WRITER = True
+"""bool: Have a worker's requests write to a SQLite file one
+at a time, so they queue rather than fail with "database is
+locked". See `sqlite`.
+"""
+
 SLEEP_RATE = 0.2
 ERROR_404_HELP = False
 
+PASSWORD_HASH_ALGORITHM = "sha256"
+"""str: hashlib name of the hash function PBKDF2 hashes
+passwords with.
+"""
+
+PASSWORD_HASH_ITERATIONS = 150000
+"""int: PBKDF2's work factor. Users' hashes made with
+another algorithm or work factor are made afresh the next
+time they log in.
+"""
+
+PASSWORD_HASH_THREADS = 4
+"""int: Most passwords each worker hashes at once, in
+threads of their own (native threads, under gevent), so
+other requests and streams aren't held up. 0 hashes in the
+request's own thread.
+"""
+
+METRICS_ENABLED = True
+"""bool: Measure requests, queries, rate limiting, streams
+and password hashing, for /metrics.
+"""
+
+METRICS_SHARED = True
+"""bool: Share each worker's measurements through Redis (at
+`REDIS_URL`), so /metrics describes every worker, whichever
+answers.
+"""
+
+METRICS_SAVE_INTERVAL = 5
+"""int: Most seconds between a worker sharing its
+measurements.
+"""
+
+PROFILE_ENABLED = False
+"""bool: Record every SQL statement run by requests to
+`PROFILE_ENDPOINTS`, logging the slow requests' and those
+which repeat a query.
+"""
+
+PROFILE_ENDPOINTS = ["user", "messages", "message"]
+"""list: Endpoints profiled when `PROFILE_ENABLED`."""
+
+PROFILE_SLOW_SECONDS = 0.5
+"""float: Log profiled requests taking at least this long,
+with the plans of their queries.
+"""
+
+PROFILE_REPEATED = 3
+"""int: Log profiled requests which run the same query (but
+for its values) at least this many times, e.g., loading
+each message's user one by one (N+1 queries).
+"""
+
+AUTH_CACHE_SIZE = 1024
+"""int: Maximum number of verified username/password
+pairs to remember, so repeat requests from the same client
+may skip the user lookup and password hashing.
+"""
+
+AUTH_CACHE_TTL = 300
+"""int: Seconds a verified username/password pair
+is remembered for.
+"""
+
+READ_CACHE_SIZE = 4096
+"""int: Maximum number of message and user descriptions
+each worker keeps in memory for `Message.get`/`User.get`.
+"""
+
+READ_CACHE_TTL = 5
+"""int: Seconds a worker trusts its in-memory copy of a
+message or user description. Keep this short: other workers
+can't tell this tier when something changes.
+"""
+
+READ_CACHE_REDIS = True
+"""bool: Share cached message and user descriptions between
+workers through Redis (at `REDIS_URL`).
+"""
+
+READ_CACHE_REDIS_TTL = 300
+"""int: Seconds a message or user description lives for
+in Redis.
+"""
+
+MESSAGES_COLUMNAR = True
+"""bool: Build lists of messages (`Messages.get`,
+`UserMessages.get`) straight from the few columns they
+need, skipping the ORM entirely. The output is the same.
+
+If False, lists are built from `models.Message` objects,
+loading authors per `MESSAGES_AUTHOR_LOADING`.
+"""
+
+JSON_ENCODER = "json"
+"""str: Name of the module whose `dumps` encodes
+responses. "json" is the standard library, by way of
+flask_restful; faster drop-ins such as "orjson" or
+"ujson" must be installed separately, and skip the spaces
+after separators, so responses are equivalent rather than
+byte-identical.
+"""
+
+MESSAGES_AUTHOR_LOADING = "none"
+"""str: How lists of messages (`Messages.get`,
+`UserMessages.get`) get their authors: "joined," "selectin"
+or "subquery" eager loading, or "none," which leaves it
+to msg to fetch a page's distinct authors in one go,
+from `read_cache` where it can.
+
+Either way, each author is serialized once per page.
+"""
+
+MESSAGE_AUTHOR_LOADING = "joined"
+"""str: How a single message (`Message.get`) gets its
+author: "joined," "selectin," "subquery" or "none" (see
+`MESSAGES_AUTHOR_LOADING`).
+"""
+
+STREAM_QUEUE_SIZE = 100
+"""int: Most events which may be waiting to be sent
+to a single /stream client.
+"""
+
+STREAM_SLOW_CONSUMER = "drop"
+"""str: What to do with a /stream client which has fallen
+`STREAM_QUEUE_SIZE` events behind: "drop" disconnects it
+(EventSource clients reconnect by themselves), "coalesce"
+throws away its waiting events and sends it a single
+"resync" event instead.
+"""
+
+STREAM_KEEPALIVE = 15
+"""int: Seconds of quiet after which a /stream client is
+sent a comment, so dead connections are noticed.
+"""
+
+STREAM_REPLAY_SIZE = 1000
+"""int: Number of recent events kept (in Redis) per
+channel, for /stream clients which reconnect with a
+Last-Event-ID. Those further behind are sent a "resync"
+event instead.
+"""
+
+STREAM_MAX_CHANNELS = 20
+"""int: Most channels a /stream client may subscribe to
+over one connection. New messages are published to "sse"
+(everything), "sse.user.<user ID>" (by that author) and
+maybe "sse.topic.<hashtag>".
+"""
+
+STREAM_TOPIC_CHANNELS = 0
+"""int: Most topic channels, one per distinct #hashtag in
+its text, a new message is also published to; 0 for none.
+"""
+
+STREAM_COALESCE_WINDOW = 0
+"""float: Seconds to gather published events for before
+sending them to Redis together, as one "batch"; 0 sends
+each event right away. /stream clients asking for
+"batch=1" then get one write per batch, and the rest
+still get the usual event per message.
+"""
+
+STREAM_COALESCE_SIZE = 100
+"""int: Most events gathered into one batch, which is sent
+early once full, however much of `STREAM_COALESCE_WINDOW`
+is left.
+"""
+
+ADMIN_USERNAMES = []
+"""list(str): Users who may export every user and message
+(password hashes included) from /messages/export.
+"""
+
+EXPORT_CHUNK_SIZE = 1000
+"""int: Rows fetched from the database, and lines sent,
+at a time by /messages/export.
+"""
+
+IMPORT_CHUNK_SIZE = 1000
+"""int: Rows inserted per transaction by `flask import`."""
+
+IMPORT_PROCESSES = 0
+"""int: Processes hashing passwords for `flask import`; 0 for
+one per CPU.
+"""
+
+SEARCH_BACKEND = "auto"
+"""str: What indexes messages for /messages/search: "fts5"
+(SQLite), "postgres" (a GIN index of tsvectors), "memory"
+(each worker's own inverted index, loaded on first use), or
+"auto" for the best the database supports.
+
+"memory" (which "auto" falls back to for other databases)
+is for development: a worker doesn't see the messages
+others post, so run a single worker with it.
+
+Index existing messages with `rebuild_search_index()`.
+"""
+
 JSON_SCHEMA_DIR = "schema"
-"""str: path to directory containing json schemas.
+"""str: path to directory containing json schemas,
+relative to the msg package.
 
-flask-jsonschema
+Each "name.json" in here is compiled at startup and
+may be validated against as `get_valid_json("name")`.
 """
 
 # Limiting: limit the number of REST requests,
 # implemented with flask_limiter:
 #
 #   https://flask-limiter.readthedocs.io/en/stable/
+RATELIMIT_STORAGE_URL = "memory://"
+"""str: Where flask_limiter counts requests. "memory://"
+counts separately in each worker; "redis://..." makes a
+round trip to Redis for every limit of every request;
+"tiered+redis://..." (`ratelimit.TwoTierStorage`) counts
+locally and syncs with Redis now and then.
+"""
+
+RATELIMIT_STORAGE_OPTIONS = {}
+"""dict: Passed to the storage. For "tiered+redis://",
+"sync_interval" (seconds), "error" (the fraction of a
+limit each worker may count before syncing) and "min_slack"
+(the fewest hits it may count anyway, for small limits).
+"""
+
 LIMITS_GLOBAL = ["200 per day", "50 per hour"]
 """List(str): A list of limits according to the
 flask_limiter API docs.
@@ -34,6 +296,13 @@ Limit the number of users an IP
 may create per second.
 """
 
+LIMITS_USER_MESSAGES_GET = "10 per minute"
+"""str: flask_limiter limit.
+
+Limit the rate which an IP may request
+a range of a user's messages.
+"""
+
 LIMITS_MESSAGES_GET = "10 per minute"
 """str: flask_limiter limit.
 
@@ -44,6 +313,32 @@ a range of messages.
 LIMITS_MESSAGES_GET_LIMIT = 20
 """int: Maximum number of messages per request."""
 
+LIMITS_MESSAGES_SEARCH = "10 per minute"
+"""str: flask_limiter limit.
+
+Limit the rate which an IP may search
+messages.
+"""
+
+LIMITS_MESSAGES_EXPORT = "1 per minute"
+"""str: flask_limiter limit.
+
+Limit the rate which an IP may export
+everything.
+"""
+
+LIMITS_MESSAGES_POST = "10 per minute"
+"""str: flask_limiter limit.
+
+Limit the rate which an IP may create
+messages in bulk.
+"""
+
+LIMITS_MESSAGES_POST_LIMIT = 20
+"""int: Maximum number of messages which may be
+created per bulk request.
+"""
+
 LIMITS_MESSAGE_PUT = "10 per minute"
 """str: flask_limiter limit.
 
@@ -0,0 +1,220 @@
+"""msg export: stream every user and message out as
+newline-delimited JSON, in constant memory.
+
+Each line is one row, with its "type" ("user" or
+"message") and every column, timestamps formatted as in the
+API. Users come first, so the output may be imported back
+in order.
+
+"""
+
+import json
+import time
+import zlib
+import datetime
+
+from . import models
+
+
+USER_COLUMNS = (
+                models.User.id,
+                models.User.username,
+                models.User.password_hash,
+                models.User.bio,
+                models.User.created,
+               )
+"""tuple: Every column of a user, password hash included."""
+
+MESSAGE_COLUMNS = (
+                   models.Message.id,
+                   models.Message.user_id,
+                   models.Message.text,
+                   models.Message.created,
+                   models.Message.edited,
+                   models.Message.version,
+                  )
+"""tuple: Every column of a message."""
+
+TABLES = {
+          "users": ("user", models.User, USER_COLUMNS),
+          "messages": ("message", models.Message, MESSAGE_COLUMNS),
+         }
+"""dict: Name of each table which may be exported, to the
+"type" of its rows, its model and the columns exported.
+"""
+
+
+def format_timestamp(value):
+    return None if value is None else value.isoformat("T") + 'Z'
+
+
+def parse_timestamp(text):
+    """Parse a timestamp as written by `format_timestamp`,
+    with or without the "Z", and with a "T" or a space
+    between the date and time.
+
+    Arguments:
+        text (str|None): --
+
+    Raises:
+        ValueError: --
+
+    Returns:
+        datetime.datetime|None: --
+
+    """
+
+    if not text:
+        return None
+
+    text = text.rstrip('Z').replace(' ', 'T', 1)
+
+    if '.' in text:
+        return datetime.datetime.strptime(text, "%Y-%m-%dT%H:%M:%S.%f")
+    else:
+        return datetime.datetime.strptime(text, "%Y-%m-%dT%H:%M:%S")
+
+
+def rows(session, table, since=None, until=None, chunk_size=1000):
+    """Iterate over a table's rows, by ID, `chunk_size` at
+    a time (with a server-side cursor, where the database
+    has them).
+
+    Arguments:
+        session (sqlalchemy.orm.Session): --
+        table (str): A name in `TABLES`.
+        since (datetime.datetime|None): Only rows created at or
+            after this.
+        until (datetime.datetime|None): Only rows created before
+            this.
+        chunk_size (int): --
+
+    Returns:
+        sqlalchemy.orm.Query: --
+
+    """
+
+    __, model, columns = TABLES[table]
+    query = session.query(*columns)
+
+    if since is not None:
+        query = query.filter(model.created >= since)
+
+    if until is not None:
+        query = query.filter(model.created < until)
+
+    return (query.order_by(model.id)
+            .execution_options(stream_results=True)
+            .yield_per(chunk_size))
+
+
+def ndjson(session, tables=("users", "messages"), since=None, until=None,
+           chunk_size=1000):
+    """Generate NDJSON for `tables`, a chunk of
+    `chunk_size` lines at a time.
+
+    Arguments:
+        session (sqlalchemy.orm.Session): --
+        tables (iterable): Names in `TABLES`.
+        since (datetime.datetime|None): See `rows`.
+        until (datetime.datetime|None): See `rows`.
+        chunk_size (int): --
+
+    Yields:
+        bytes: UTF-8 encoded lines.
+
+    """
+
+    dumps = json.JSONEncoder(ensure_ascii=False).encode
+
+    for table in tables:
+        row_type, __, columns = TABLES[table]
+        names = [column.key for column in columns]
+        timestamps = [i for i, column in enumerate(columns)
+                      if column.key in ('created', 'edited')]
+        lines = []
+
+        for row in rows(session, table, since, until, chunk_size):
+            values = list(row)
+
+            for i in timestamps:
+                values[i] = format_timestamp(values[i])
+
+            record = dict(zip(names, values))
+            record['type'] = row_type
+            lines.append(dumps(record))
+
+            if len(lines) >= chunk_size:
+                yield ('\n'.join(lines) + '\n').encode('utf-8')
+                lines = []
+
+        if lines:
+            yield ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def gzipped(chunks, level=6):
+    """Gzip a stream of bytes as it goes.
+
+    Arguments:
+        chunks (iterable): bytes.
+        level (int): zlib compression level.
+
+    Yields:
+        bytes: --
+
+    """
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+
+        if compressed:
+            yield compressed
+
+    yield compressor.flush()
+
+
+class Meter(object):
+    """Measures the rows and bytes of NDJSON passing through.
+
+    Attributes:
+        rows (int): --
+        bytes (int): --
+        started (float|None): When the first chunk was asked for.
+
+    """
+
+    def __init__(self, timer=time.time):
+        self.timer = timer
+        self.rows = 0
+        self.bytes = 0
+        self.started = None
+
+    def __call__(self, chunks):
+        """Pass `chunks` through, counting them."""
+
+        self.started = self.timer()
+
+        for chunk in chunks:
+            self.rows += chunk.count(b'\n')
+            self.bytes += len(chunk)
+            yield chunk
+
+    def stats(self):
+        """Return a dictionary of what's been counted so far,
+        and how fast.
+
+        """
+
+        if self.started is None:
+            elapsed = 0.0
+        else:
+            elapsed = self.timer() - self.started
+
+        return {'rows': self.rows,
+                'bytes': self.bytes,
+                'seconds': elapsed,
+                'rows_per_second': self.rows / elapsed if elapsed else 0.0,
+                'megabytes_per_second': (self.bytes / 1e6 / elapsed
+                                         if elapsed else 0.0)}
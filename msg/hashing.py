@@ -0,0 +1,149 @@
+"""msg hashing: password hashes, worked out by a bounded
+pool of threads, so the rest of a worker carries on in the
+meantime.
+
+hashlib's PBKDF2 lets go of the GIL, so those threads really
+do run beside the worker's others. Under gevent, whose
+monkey patching makes threads greenlets (which would hash
+one at a time on the event loop, stalling every other
+request and stream), the pool is of gevent's own native
+threads instead, and the greenlet asking for a hash yields
+to the others until it's done.
+
+"""
+
+import time
+import threading
+import multiprocessing.pool
+
+from werkzeug.security import (generate_password_hash,
+                               check_password_hash)
+
+try:
+    import gevent.monkey
+    import gevent.threadpool
+except ImportError:
+    gevent = None
+
+
+class PasswordHasher(object):
+    """Salted PBKDF2 password hashes, in werkzeug's format,
+    e.g., "pbkdf2:sha256:150000$salt$hash".
+
+    The pool is made on first use, i.e., in each worker, once
+    gunicorn has forked it and gevent has patched it.
+
+    Arguments:
+        algorithm (str): hashlib name of PBKDF2's hash function.
+        iterations (int): PBKDF2's work factor.
+        threads (int): Most hashes worked out at once; 0 to
+            hash in the calling thread.
+        observer (callable|None): Called with "hash" or "check"
+            and the seconds it took (waiting for the pool
+            included) after each.
+
+    Attributes:
+        method (str): What hashes are made with, as werkzeug
+            names it, and as hashes begin.
+
+    """
+
+    def __init__(self, algorithm='sha256', iterations=150000, threads=4,
+                 observer=None):
+        self.method = 'pbkdf2:%s:%d' % (algorithm, iterations)
+        self.threads = threads
+        self.observer = observer
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def pool(self):
+        """Get the pool, making it if need be.
+
+        Returns:
+            gevent.threadpool.ThreadPool|multiprocessing.pool.ThreadPool|None:
+                None if hashing in the calling thread.
+
+        """
+
+        if self._pool is None and self.threads:
+
+            with self._lock:
+
+                if self._pool is not None:
+                    pass
+                elif (gevent is not None
+                      and gevent.monkey.is_module_patched('threading')):
+                    self._pool = gevent.threadpool.ThreadPool(self.threads)
+                else:
+                    self._pool = multiprocessing.pool.ThreadPool(self.threads)
+
+        return self._pool
+
+    def run(self, function, *args):
+        """Call a function in the pool, waiting for (and
+        returning) its result.
+
+        """
+
+        pool = self.pool()
+
+        if pool is None:
+            return function(*args)
+
+        return pool.apply(function, args)
+
+    def observed(self, operation, function, *args):
+        """`run`, telling the `observer` how long it took."""
+
+        started = time.time()
+
+        try:
+            return self.run(function, *args)
+        finally:
+
+            if self.observer is not None:
+                self.observer(operation, time.time() - started)
+
+    def hash(self, password):
+        """Hash a password with `method`.
+
+        Arguments:
+            password (str): --
+
+        Returns:
+            str: --
+
+        """
+
+        return self.observed('hash', generate_password_hash, password,
+                             self.method)
+
+    def check(self, password_hash, password):
+        """Check a password against its hash, whatever it was
+        made with.
+
+        Arguments:
+            password_hash (str): --
+            password (str): --
+
+        Returns:
+            bool: --
+
+        """
+
+        return self.observed('check', check_password_hash, password_hash,
+                             password)
+
+    def needs_rehash(self, password_hash):
+        """Check if a hash was made other than with `method`,
+        e.g., before the work factor went up.
+
+        Arguments:
+            password_hash (str): --
+
+        Returns:
+            bool: --
+
+        """
+
+        return password_hash.split('$', 1)[0] != self.method
@@ -0,0 +1,343 @@
+"""msg importer: load users and messages in bulk, from
+NDJSON (as written by `export`) or CSV.
+
+Rows are inserted a chunk at a time, each chunk in one
+transaction of bulk inserts, rather than a request (with its
+own commit and stream event) per row.
+Passwords are hashed in a pool of processes, unless the rows
+have hashes already.
+
+How far an import has got is saved along with each chunk
+(see `models.ImportCheckpoint`), so running an interrupted
+import again, on the same input, carries on where it left
+off.
+
+"""
+
+import csv
+import json
+import time
+import functools
+import itertools
+
+import sqlalchemy
+
+from . import export
+from . import models
+
+
+MODELS = {
+          "user": models.User,
+          "message": models.Message,
+         }
+"""dict: Each "type" of row to its model."""
+
+
+def hash_password(password, method='pbkdf2:sha256'):
+    """`models.User.hash_password`, where a process pool can
+    find it.
+
+    """
+
+    return models.User.hash_password(password, method)
+
+
+def read_ndjson(lines):
+    """Parse lines of NDJSON, skipping blank ones.
+
+    Arguments:
+        lines (iterable): str.
+
+    Yields:
+        dict: --
+
+    """
+
+    for line in lines:
+        line = line.strip()
+
+        if line:
+            yield json.loads(line)
+
+
+def read_csv(lines, row_type=None):
+    """Parse CSV which first line names its columns.
+
+    Arguments:
+        lines (iterable): str.
+        row_type (str|None): The "type" of rows which don't
+            have a "type" column.
+
+    Yields:
+        dict: --
+
+    """
+
+    for record in csv.DictReader(lines):
+
+        if row_type is not None and not record.get('type'):
+            record['type'] = row_type
+
+        yield record
+
+
+def to_mapping(record):
+    """Pick the columns of a row's model out of a row, as
+    read from NDJSON or CSV, converting from text as needed.
+
+    Columns which are missing are left to their defaults;
+    users without a "password_hash" keep their "password",
+    to be hashed.
+
+    Arguments:
+        record (dict): --
+
+    Raises:
+        ValueError: If the row isn't a user or message, or is a
+            user without a password.
+
+    Returns:
+        tuple: The model and a dictionary of its columns.
+
+    """
+
+    model = MODELS.get(record.get('type'))
+
+    if model is None:
+        raise ValueError("Unknown type: %r" % record.get('type'))
+
+    mapping = {}
+
+    for column in model.__table__.columns:
+        value = record.get(column.key)
+
+        if value is None:
+            continue
+        elif isinstance(column.type, sqlalchemy.Integer):
+
+            # CSV has no nulls, only empty strings
+            if value == '':
+                continue
+
+            value = int(value)
+        elif isinstance(column.type, sqlalchemy.DateTime):
+            value = export.parse_timestamp(value)
+
+        mapping[column.key] = value
+
+    if model is models.User and 'password_hash' not in mapping:
+
+        if not record.get('password'):
+            raise ValueError("User has neither password nor password_hash")
+
+        mapping['password'] = record['password']
+
+    return model, mapping
+
+
+def insert_mappings(session, model, mappings):
+    """Insert rows with one `executemany` per set of columns
+    given.
+
+    Like `Session.bulk_insert_mappings`, but straight through
+    the table, so the ORM doesn't number the messages'
+    versions afresh.
+
+    Arguments:
+        session (sqlalchemy.orm.Session): --
+        model (models.Base): --
+        mappings (list): dicts of the model's columns.
+
+    """
+
+    groups = {}
+
+    for mapping in mappings:
+        groups.setdefault(frozenset(mapping), []).append(mapping)
+
+    for group in groups.values():
+        session.execute(model.__table__.insert(), group)
+
+
+def reset_sequences(session):
+    """Make Postgres carry on numbering users and messages
+    after the highest IDs imported. Other databases do so by
+    themselves.
+
+    Arguments:
+        session (sqlalchemy.orm.Session): --
+
+    """
+
+    if session.get_bind().dialect.name != 'postgresql':
+        return
+
+    for model in MODELS.values():
+        table = model.__tablename__
+        session.execute(sqlalchemy.text(
+            "SELECT setval(pg_get_serial_sequence('%s', 'id'), "
+            "coalesce(max(id), 1)) FROM %s" % (table, table)
+        ))
+
+
+class Importer(object):
+    """Inserts rows a chunk at a time, saving a checkpoint
+    with each chunk.
+
+    Arguments:
+        session (sqlalchemy.orm.Session): --
+        source (str): Names the input, e.g., its path, for its
+            checkpoint.
+        chunk_size (int): Rows per transaction.
+        pool (multiprocessing.pool.Pool|None): Hashes passwords;
+            if None, they're hashed in this process.
+        hash_method (str): What passwords are hashed with, as
+            werkzeug names it.
+        timer (callable): --
+
+    Attributes:
+        rows (int): Rows imported by this run.
+        resumed (int): Rows imported by earlier runs, skipped
+            by this one.
+        started (float|None): --
+
+    """
+
+    def __init__(self, session, source, chunk_size=1000, pool=None,
+                 hash_method='pbkdf2:sha256', timer=time.time):
+        self.session = session
+        self.source = source
+        self.chunk_size = chunk_size
+        self.pool = pool
+        self.hash_method = hash_method
+        self.timer = timer
+        self.rows = 0
+        self.resumed = 0
+        self.started = None
+
+    def checkpoint(self):
+        """Get (or start) this import's checkpoint.
+
+        Returns:
+            models.ImportCheckpoint: --
+
+        """
+
+        checkpoint = self.session.query(models.ImportCheckpoint).get(
+            self.source
+        )
+
+        if checkpoint is None:
+            checkpoint = models.ImportCheckpoint(source=self.source, rows=0)
+            self.session.add(checkpoint)
+
+        return checkpoint
+
+    def forget(self):
+        """Delete the checkpoint, so the next run starts from
+        the first row.
+
+        """
+
+        (self.session.query(models.ImportCheckpoint)
+         .filter_by(source=self.source).delete())
+        self.session.commit()
+
+    def run(self, records, progress=None):
+        """Import rows, skipping as many as earlier runs got
+        through, in the order given.
+
+        Arguments:
+            records (iterable): dicts, as read by `read_ndjson`
+                or `read_csv`.
+            progress (callable|None): Called with this importer
+                after each chunk.
+
+        Raises:
+            ValueError: If a row can't be imported; the chunks
+                before it are.
+
+        Returns:
+            int: Rows imported by this run.
+
+        """
+
+        checkpoint = self.checkpoint()
+        self.resumed = done = checkpoint.rows
+        records = itertools.islice(records, done, None)
+        self.started = self.timer()
+
+        while True:
+            chunk = list(itertools.islice(records, self.chunk_size))
+
+            if not chunk:
+                break
+
+            self.insert(chunk, done)
+            done += len(chunk)
+            # in the same transaction as the chunk
+            checkpoint.rows = done
+            self.session.commit()
+            self.rows += len(chunk)
+
+            if progress is not None:
+                progress(self)
+
+        self.session.commit()
+        return self.rows
+
+    def insert(self, chunk, offset):
+        """Insert a chunk of rows, users before messages.
+
+        Arguments:
+            chunk (list): dicts.
+            offset (int): Rows before this chunk, for errors.
+
+        """
+
+        users = []
+        messages = []
+
+        for i, record in enumerate(chunk, offset + 1):
+
+            try:
+                model, mapping = to_mapping(record)
+            except (ValueError, TypeError) as error:
+                self.session.rollback()
+                raise ValueError("Row %d: %s" % (i, error))
+
+            (users if model is models.User else messages).append(mapping)
+
+        unhashed = [user for user in users if 'password' in user]
+
+        if unhashed:
+            passwords = [user.pop('password') for user in unhashed]
+            hash_function = functools.partial(hash_password,
+                                              method=self.hash_method)
+
+            if self.pool is None:
+                hashes = [hash_function(password) for password in passwords]
+            else:
+                hashes = self.pool.map(hash_function, passwords)
+
+            for user, password_hash in zip(unhashed, hashes):
+                user['password_hash'] = password_hash
+
+        insert_mappings(self.session, models.User, users)
+        insert_mappings(self.session, models.Message, messages)
+
+    def stats(self):
+        """Return a dictionary of what this run's done so far,
+        and how fast.
+
+        """
+
+        if self.started is None:
+            elapsed = 0.0
+        else:
+            elapsed = self.timer() - self.started
+
+        return {'rows': self.rows,
+                'resumed': self.resumed,
+                'seconds': elapsed,
+                'rows_per_second': self.rows / elapsed if elapsed else 0.0}
@@ -0,0 +1,297 @@
+"""msg metrics: counters, gauges and histograms, exposed in
+Prometheus' text format.
+
+Each worker counts for itself, which costs a lock and an
+addition per observation. Every so often, and whenever it's
+scraped, a worker saves a snapshot of its counts to Redis,
+so whichever worker answers a scrape answers for them all.
+
+"""
+
+import os
+import json
+import time
+import bisect
+import socket
+import threading
+import collections
+
+import redis
+
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0)
+"""tuple: Upper bounds (seconds) of histogram buckets."""
+
+
+def format_labels(labels, extra=()):
+    """Format label pairs as in `name{a="b",c="d"}`.
+
+    Arguments:
+        labels (iterable): (name, value) pairs.
+        extra (iterable): More pairs, after those.
+
+    Returns:
+        str: --
+
+    """
+
+    pairs = list(labels) + list(extra)
+
+    if not pairs:
+        return ''
+
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                     .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs
+    )
+
+
+def format_value(value):
+    return repr(float(value)) if value % 1 else str(int(value))
+
+
+class Registry(object):
+    """This worker's metrics, and everyone's by way of Redis.
+
+    Labels are given as tuples of (name, value) pairs, always
+    in the same order for the same metric.
+
+    Arguments:
+        redis_client (redis.StrictRedis|None): Where workers
+            share their counts; None for this worker's only.
+        interval (float): Least seconds between `maybe_save`s
+            actually saving.
+        ttl (float): Seconds a worker's snapshot counts after
+            it was saved, e.g., for a worker which has gone.
+        key (str): Redis hash of workers' snapshots.
+        timer (callable): --
+
+    """
+
+    def __init__(self, redis_client=None, interval=5.0, ttl=60.0,
+                 key='metrics', timer=time.time):
+        self.redis = redis_client
+        self.interval = interval
+        self.ttl = ttl
+        self.key = key
+        self.timer = timer
+        self.metrics = collections.OrderedDict()
+        self.collectors = []
+        self.saved = 0.0
+        self.errors = 0
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name, help):
+        self.metrics[name] = ('counter', help, None)
+
+    def gauge(self, name, help):
+        self.metrics[name] = ('gauge', help, None)
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.metrics[name] = ('histogram', help, tuple(buckets))
+
+    def inc(self, name, labels=(), amount=1):
+        """Add to a counter."""
+
+        self.record(increments=[(name, labels, amount)])
+
+    def set(self, name, value, labels=()):
+        """Set a gauge (or a counter kept elsewhere)."""
+
+        with self._lock:
+            self._values[(name, labels)] = value
+
+    def observe(self, name, value, labels=()):
+        """Count a value into a histogram's buckets."""
+
+        self.record(observations=[(name, labels, value)])
+
+    def record(self, increments=(), observations=()):
+        """`inc` and `observe` several at once, taking the lock
+        just the once, e.g., for everything about a request.
+
+        Arguments:
+            increments (iterable): (name, labels, amount) triples.
+            observations (iterable): (name, labels, value) triples.
+
+        """
+
+        with self._lock:
+            values = self._values
+
+            for name, labels, amount in increments:
+                key = (name, labels)
+                values[key] = values.get(key, 0) + amount
+
+            for name, labels, value in observations:
+                key = (name, labels)
+                counts = values.get(key)
+                buckets = self.metrics[name][2]
+
+                if counts is None:
+                    # one per bucket, one for +Inf, then the sum
+                    counts = values[key] = [0] * (len(buckets) + 2)
+
+                counts[bisect.bisect_left(buckets, value)] += 1
+                counts[-1] += value
+
+    def snapshot(self):
+        """Return this worker's values, after running the
+        `collectors` (which `set` gauges).
+
+        Returns:
+            list: [name, labels, value] triples, which JSON can
+                encode; a histogram's value is its list of counts.
+
+        """
+
+        for collector in self.collectors:
+            collector(self)
+
+        with self._lock:
+            return [[name, [list(pair) for pair in labels],
+                     list(value) if isinstance(value, list) else value]
+                    for (name, labels), value in self._values.items()]
+
+    def clear(self):
+        """Forget every value, everywhere."""
+
+        with self._lock:
+            self._values.clear()
+
+        if self.redis is not None:
+
+            try:
+                self.redis.delete(self.key)
+            except redis.RedisError:
+                self.errors += 1
+
+    def worker(self):
+        # not at import, which may be before gunicorn forks
+        return '%s:%d' % (socket.gethostname(), os.getpid())
+
+    def save(self, snapshot=None):
+        """Save a snapshot of this worker's values to Redis,
+        taking one if not given.
+
+        """
+
+        self.saved = self.timer()
+
+        if self.redis is None:
+            return
+
+        try:
+            self.redis.hset(self.key, self.worker(), json.dumps(
+                {'time': self.saved, 'values': snapshot or self.snapshot()}
+            ))
+        except redis.RedisError:
+            self.errors += 1
+
+    def maybe_save(self):
+        """`save`, if it's been `interval` seconds."""
+
+        if self.timer() - self.saved >= self.interval:
+            self.save()
+
+    def collect(self):
+        """Get every worker's values, added up.
+
+        Only this worker's, if Redis isn't there.
+
+        Returns:
+            dict: (name, labels) to value.
+
+        """
+
+        own = self.snapshot()
+        snapshots = [own]
+
+        if self.redis is not None:
+            self.save(own)
+
+            me = self.worker().encode('utf-8')
+            now = self.timer()
+
+            try:
+                for worker, data in self.redis.hgetall(self.key).items():
+                    data = json.loads(data.decode('utf-8'))
+
+                    if worker == me:
+                        continue
+                    elif now - data['time'] > self.ttl:
+                        self.redis.hdel(self.key, worker)
+                    else:
+                        snapshots.append(data['values'])
+            except redis.RedisError:
+                self.errors += 1
+
+        totals = {}
+
+        for snapshot in snapshots:
+
+            for name, labels, value in snapshot:
+                key = (name, tuple(tuple(pair) for pair in labels))
+                total = totals.get(key)
+
+                if total is None:
+                    totals[key] = value
+                elif isinstance(value, list):
+                    totals[key] = [a + b for a, b in zip(total, value)]
+                else:
+                    totals[key] = total + value
+
+        return totals
+
+    def render(self, totals=None):
+        """Describe every metric in Prometheus' text format.
+
+        Arguments:
+            totals (dict|None): As from `collect`, which is
+                called if None.
+
+        Returns:
+            str: --
+
+        """
+
+        if totals is None:
+            totals = self.collect()
+
+        series = collections.defaultdict(list)
+
+        for (name, labels), value in sorted(totals.items()):
+            series[name].append((labels, value))
+
+        lines = []
+
+        for name, (kind, help, buckets) in self.metrics.items():
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+
+            for labels, value in series[name]:
+
+                if kind != 'histogram':
+                    lines.append('%s%s %s' % (name, format_labels(labels),
+                                              format_value(value)))
+                    continue
+
+                cumulative = 0
+
+                for bound, count in zip(buckets + ('+Inf',), value):
+                    cumulative += count
+                    bound = bound if bound == '+Inf' else repr(bound)
+                    lines.append('%s_bucket%s %d'
+                                 % (name,
+                                    format_labels(labels, [('le', bound)]),
+                                    cumulative))
+
+                lines.append('%s_sum%s %s' % (name, format_labels(labels),
+                                              format_value(value[-1])))
+                lines.append('%s_count%s %d' % (name, format_labels(labels),
+                                                cumulative))
+
+        return '\n'.join(lines) + '\n'
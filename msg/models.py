@@ -18,14 +18,15 @@ class User(Base):
     password_hash = sqlalchemy.Column(sqlalchemy.String())
     bio = sqlalchemy.Column(sqlalchemy.String())
 
-    def __init__(self, username, password, bio=None):
+    def __init__(self, username, password, bio=None, password_hash=None):
         self.username = username
-        self.password_hash = self.hash_password(password)
+        self.password_hash = (self.hash_password(password)
+                              if password_hash is None else password_hash)
         self.bio = bio
 
     @staticmethod
-    def hash_password(password):
-        return generate_password_hash(password)
+    def hash_password(password, method='pbkdf2:sha256'):
+        return generate_password_hash(password, method)
 
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
@@ -49,12 +50,26 @@ class Message(Base):
     """
 
     __tablename__ = 'posts'
+    __table_args__ = (
+                      # a user's messages, in order
+                      sqlalchemy.Index('ix_posts_user_id_created',
+                                       'user_id', 'created'),
+                      # everyone's messages, in order
+                      sqlalchemy.Index('ix_posts_created_id',
+                                       'created', 'id'),
+                     )
     id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
     user_id = sqlalchemy.Column(sqlalchemy.Integer,
                                 sqlalchemy.ForeignKey(User.id))
     created = sqlalchemy.Column(sqlalchemy.DateTime,
                                 default=datetime.datetime.utcnow)
     text = sqlalchemy.Column(sqlalchemy.String())
+    # goes up by one with every edit, for ETags
+    version = sqlalchemy.Column(sqlalchemy.Integer, nullable=False,
+                                server_default='1')
+    edited = sqlalchemy.Column(sqlalchemy.DateTime)
+
+    __mapper_args__ = {'version_id_col': version}
 
     user = sqlalchemy.orm.relationship('User', foreign_keys='Message.user_id',
                                        lazy='subquery')
@@ -66,13 +81,36 @@ class Message(Base):
     def __repr__(self):
         return '<Message #%s>' % self.id
 
-    def to_dict(self):
+    def to_dict(self, user_dict=None):
         """Return a dictionary representation of this
         user, which keys are in jsonStyle.
 
+        Arguments:
+            user_dict (dict|None): The author's dictionary
+                representation, if already at hand; otherwise
+                it's made from `user`.
+
         """
 
+        if user_dict is None:
+            user_dict = self.user.to_dict()
+
         return {'id': self.id,
                 'text': self.text,
-                'user': self.user.to_dict(),
+                'user': user_dict,
                 'created': self.created.isoformat("T") + 'Z'}
+
+
+class ImportCheckpoint(Base):
+    """How far a bulk import (see `importer`) has got, saved
+    in the same transaction as each chunk it inserts, so an
+    interrupted import may carry on where it left off.
+
+    """
+
+    __tablename__ = 'imports'
+    source = sqlalchemy.Column(sqlalchemy.String(), primary_key=True)
+    rows = sqlalchemy.Column(sqlalchemy.Integer, nullable=False, default=0)
+    updated = sqlalchemy.Column(sqlalchemy.DateTime,
+                                default=datetime.datetime.utcnow,
+                                onupdate=datetime.datetime.utcnow)
@@ -4,23 +4,47 @@
 
 # First builtins
 import os
+import re
+import datetime
+import hmac
 import json
+import base64
+import hashlib
+import importlib
+import io
+import gzip
+import multiprocessing
+import time
+import functools
 
 # 3rd party
 from flask_httpauth import HTTPBasicAuth
-from flask_sse import sse
+
+import click
 
 import flask
+import werkzeug.http
 import flask_limiter
 import flask_restful
-import flask_sqlalchemy
 import sqlalchemy
 import jsonschema
 import requests
+import redis
 
 # Local
 from . import models
 from . import config
+from . import cache
+from . import validation
+from . import ratelimit  # registers "tiered+redis://"
+from . import search
+from . import export
+from . import importer
+from . import hashing
+from . import metrics
+from . import profiler
+from . import replicas
+from .stream import sse
 
 
 # Flask setup
@@ -35,8 +59,207 @@ limiter = flask_limiter.Limiter(
                                           get_remote_address),
                                 global_limits=config.LIMITS_GLOBAL
                                )
-db = flask_sqlalchemy.SQLAlchemy(app)
+db = replicas.RoutingSQLAlchemy(app)
 auth = HTTPBasicAuth()
+instruments = metrics.Registry(
+    (redis.StrictRedis.from_url(config.REDIS_URL)
+     if config.METRICS_SHARED else None),
+    interval=config.METRICS_SAVE_INTERVAL,
+)
+"""metrics.Registry: What /metrics reports."""
+
+instruments.histogram('msg_request_duration_seconds',
+                      "Time to respond, by endpoint and method.")
+instruments.counter('msg_requests_total',
+                    "Responses, by endpoint, method and status.")
+instruments.counter('msg_db_queries_total',
+                    "SQL statements run, by endpoint.")
+instruments.counter('msg_db_query_seconds_total',
+                    "Time spent running SQL statements, by endpoint.")
+instruments.counter('msg_rate_limited_total',
+                    "Requests refused by a rate limit, by limit and "
+                    "endpoint.")
+instruments.gauge('msg_stream_connections', "Open /stream connections.")
+instruments.counter('msg_stream_events_total',
+                    "Events sent to /stream connections.")
+instruments.counter('msg_stream_dropped_total',
+                    "Events /stream connections fell too far behind "
+                    "to be sent.")
+instruments.histogram('msg_password_hash_seconds',
+                      "Time to hash or check a password, waiting "
+                      "included, by operation.")
+
+hasher = hashing.PasswordHasher(
+    config.PASSWORD_HASH_ALGORITHM,
+    config.PASSWORD_HASH_ITERATIONS,
+    config.PASSWORD_HASH_THREADS,
+    observer=lambda operation, seconds: instruments.observe(
+        'msg_password_hash_seconds', seconds, (('operation', operation),)
+    ),
+)
+"""hashing.PasswordHasher: Hashes and checks passwords, off
+the event loop.
+"""
+
+credential_cache = cache.TTLCache(config.AUTH_CACHE_SIZE,
+                                  config.AUTH_CACHE_TTL)
+"""cache.TTLCache: (username, credential digest) pairs which
+have recently passed `get_password`, mapped to the user ID.
+"""
+
+board_version = cache.VersionCounter(
+    redis.StrictRedis.from_url(config.REDIS_URL)
+    if config.READ_CACHE_REDIS else None
+)
+"""cache.VersionCounter: Goes up with every change to any
+message (or message author), once committed, so lists of
+messages may be given ETags without asking the database
+anything.
+"""
+
+read_cache = cache.TieredCache(
+    cache.TTLCache(config.READ_CACHE_SIZE, config.READ_CACHE_TTL),
+    board_version.redis,
+    ttl=config.READ_CACHE_REDIS_TTL,
+    versions=board_version,
+)
+"""cache.TieredCache: Descriptions of messages and users,
+for `Message.get` and `User.get`.
+"""
+
+credential_versions = cache.VersionCounter(read_cache.redis,
+                                           key='msg:credentials')
+"""cache.VersionCounter: Goes up once any user's password
+change (or deletion) is committed, so every worker stops
+trusting its `credential_cache` entries at once.
+"""
+
+schemas = validation.SchemaRegistry()
+"""validation.SchemaRegistry: Every JSON schema requests are
+validated against, compiled once.
+"""
+
+AUTHOR_LOADERS = {
+                  'joined': sqlalchemy.orm.joinedload,
+                  'selectin': sqlalchemy.orm.selectinload,
+                  'subquery': sqlalchemy.orm.subqueryload,
+                  'none': sqlalchemy.orm.noload,
+                 }
+"""dict: `with_authors` loading option to SQLAlchemy loader."""
+
+MESSAGE_COLUMNS = (
+                   models.Message.id,
+                   models.Message.text,
+                   models.Message.created,
+                   models.Message.user_id,
+                  )
+"""tuple: All `rows_to_dicts` needs to describe a message."""
+
+# Only used to key `credential_cache`; never leaves this process.
+CREDENTIAL_SECRET = os.urandom(32)
+
+WROTE_COOKIE = 'msg_wrote'
+"""str: Cookie set on a client which has just written, so it
+reads from the primary for `SQLALCHEMY_REPLICA_LAG` seconds.
+"""
+
+
+def reads_from_replica(function):
+    """Decorate a handler which only reads, so its queries
+    go to a replica (see `replicas`), if there are any, and
+    the client hasn't just written.
+
+    """
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        db.session().reading = not wrote_recently()
+        return falling_back(function, *args, **kwargs)
+
+    return wrapper
+
+
+def falling_back(function, *args, **kwargs):
+    """Call `function`, which queries through the session,
+    calling it again (on the primary) if the replica it read
+    from failed.
+
+    """
+
+    session = db.session()
+
+    try:
+        return function(*args, **kwargs)
+    except sqlalchemy.exc.DBAPIError:
+
+        if not session.replica:
+            raise
+
+    # e.g., missing tables, having been set up wrong
+    db.get_replicas().failed(session.replica)
+    session.rollback()
+    session.replica = False
+    return function(*args, **kwargs)
+
+
+def wrote_recently():
+    """Check if the client wrote in the last
+    `SQLALCHEMY_REPLICA_LAG` seconds, by its `WROTE_COOKIE`.
+
+    """
+
+    try:
+        wrote = float(flask.request.cookies.get(WROTE_COOKIE, ''))
+    except ValueError:
+        return False
+
+    return time.time() - wrote < app.config['SQLALCHEMY_REPLICA_LAG']
+
+
+def reads_stale():
+    """Check if the current request reads from a replica
+    which may not have the board's latest change yet (it
+    was made in the last `SQLALCHEMY_REPLICA_LAG` seconds),
+    so what it reads mustn't be cached, or given an ETag
+    which says it's current.
+
+    Returns:
+        bool: --
+
+    """
+
+    stale = getattr(flask.g, 'reads_stale', None)
+
+    if stale is None:
+        session = db.session()
+        stale = False
+
+        if (session.reading and not session.wrote
+                and session.replica is not False
+                and db.get_replicas().uris):
+            bumped = board_version.bumped()
+            stale = (bumped is None
+                     or time.time() - bumped
+                     < app.config['SQLALCHEMY_REPLICA_LAG'])
+
+        flask.g.reads_stale = stale
+
+    return stale
+
+
+@app.after_request
+def remember_write(response):
+    """Set `WROTE_COOKIE` if the request wrote, and there
+    are replicas it might otherwise not read back from.
+
+    """
+
+    if db.session().wrote and db.get_replicas().uris:
+        response.set_cookie(WROTE_COOKIE, repr(time.time()),
+                            max_age=app.config['SQLALCHEMY_REPLICA_LAG'],
+                            httponly=True)
+
+    return response
 
 
 class User(flask_restful.Resource):
@@ -56,9 +279,12 @@ class User(flask_restful.Resource):
                   }
 
     @limiter.limit(config.LIMITS_USER_GET)
+    @reads_from_replica
     def get(self, user_id=None, username=None):
         """Get a specific user's info by user ID
-        *or* username.
+        *or* username, through `read_cache`.
+
+        Supports conditional requests (If-None-Match).
 
         This returns a 400 if neither user_id nor
         username was provided. Returns a 404 if
@@ -81,15 +307,14 @@ class User(flask_restful.Resource):
         """
 
         if user_id is not None:
-            user = db.session.query(models.User).get(user_id)
+            user = cached_user(user_id=user_id)
 
             if user is None:
                 message = "No user matching ID: %s" % user_id
                 flask_restful.abort(404, message=message)
 
         elif username is not None:
-            user = (db.session.query(models.User)
-                    .filter(models.User.username == username).first())
+            user = cached_user(username=username)
 
             if user is None:
                 message = "No user matching username: %s" % username
@@ -99,7 +324,8 @@ class User(flask_restful.Resource):
             message = "Must specify user_id or username."
             flask_restful.abort(400, message=message)
 
-        return user.to_dict()
+        etag = 'u%d-%s' % (user['id'], user_digest(user))
+        return not_modified(etag) or (user, 200, validators(etag))
 
     @limiter.limit(config.LIMITS_USER_POST)
     def post(self):
@@ -120,7 +346,8 @@ class User(flask_restful.Resource):
         bio = json_data.get('bio')
         username = json_data['username']
         password = json_data['password']
-        new_user = models.User(username, password, bio=bio)
+        new_user = models.User(username, None, bio=bio,
+                               password_hash=hasher.hash(password))
         db.session.add(new_user)
 
         try:
@@ -134,9 +361,93 @@ class User(flask_restful.Resource):
             return new_user.to_dict()
 
 
+class UserMessages(flask_restful.Resource):
+    """One user's messages, newest first.
+
+    """
+
+    SCHEMA_GET = {
+                  "type": "object",
+                  "properties": {
+                                 "limit": {"type": "integer"},
+                                 "cursor": {"type": "string"},
+                                },
+                  "required": ["limit"],
+                 }
+
+    @limiter.limit(config.LIMITS_USER_MESSAGES_GET)
+    @reads_from_replica
+    def get(self, user_id=None, username=None):
+        """Get a page of a user's messages, by user ID *or*
+        username, using a "limit" and optionally the "cursor"
+        returned with the previous page.
+
+        Arguments:
+            user_id (int|None): --
+            username (str|None): --
+
+        Supports conditional requests (If-None-Match).
+
+        Returns:
+            dict: The "messages" on this page, and the "next"
+                cursor (None if this is the last page).
+            None: If aborted.
+
+        """
+
+        json_data = get_valid_json(self.SCHEMA_GET)
+        limit = int(json_data['limit'])
+
+        if limit > config.LIMITS_MESSAGES_GET_LIMIT:
+            message = ("You may only request %d messages at once."
+                       % config.LIMITS_MESSAGES_GET_LIMIT)
+            flask_restful.abort(400, message=message)
+        elif limit < 1:
+            flask_restful.abort(400, message="Request at least 1 message.")
+
+        if user_id is not None:
+            user = cached_user(user_id=user_id)
+            missing = "No user matching ID: %s" % user_id
+        else:
+            user = cached_user(username=username)
+            missing = "No user matching username: %s" % username
+
+        if user is None:
+            flask_restful.abort(404, message=missing)
+
+        etag = list_etag()
+        response = etag and not_modified(etag)
+
+        if response:
+            return response
+
+        if 'cursor' in json_data:
+            direction, key = decode_cursor(json_data['cursor'])
+        else:
+            direction, key = 'before', None
+
+        # seeks along the (user_id, created) index
+        query = (query_messages(loading='none')
+                 .filter(models.Message.user_id == user['id']))
+        columns = [models.Message.created, models.Message.id]
+        results, next_cursor = keyset_page(query, columns, direction,
+                                           key, limit)
+        # we already have the (only) author at hand
+        return ({'messages': list_to_dicts(results, 'none',
+                                           {user['id']: user}),
+                 'next': next_cursor},
+                200, validators(etag))
+
+
 class Messages(flask_restful.Resource):
     """Manage more than one message at a time!
 
+    Messages may be paged through in one of two ways: the
+    classic "offset" and "limit," or by cursor, seeking past
+    a message ID with "before_id," "after_id," or the opaque
+    "cursor" returned with the previous page. Cursor paging
+    costs the same no matter how deep into the board you are.
+
     """
 
     SCHEMA_GET = {
@@ -144,24 +455,50 @@ class Messages(flask_restful.Resource):
                   "properties": {
                                  "offset": {"type": "integer"},
                                  "limit": {"type": "integer"},
+                                 "before_id": {"type": ["integer", "null"]},
+                                 "after_id": {"type": ["integer", "null"]},
+                                 "cursor": {"type": "string"},
                                 },
-                  "required": ["offset", "limit"],
+                  "required": ["limit"],
                  }
 
+    SCHEMA_POST = {
+                   "type": "array",
+                   "items": {
+                             "type": "object",
+                             "properties": {
+                                            "text": {"type": "string"},
+                                           },
+                             "required": ["text"],
+                            },
+                   "minItems": 1,
+                  }
+
+    CURSOR_KEYS = ('before_id', 'after_id', 'cursor')
+
     @limiter.limit(config.LIMITS_MESSAGES_GET)
-    def get(self):
+    @reads_from_replica
+    def get(self, before_id=None):
         """Get a range of messages using a "limit"
-        and an "offset."
+        and an "offset," or a "limit" and a cursor.
+
+        Supports conditional requests (If-None-Match).
+
+        Arguments:
+            before_id (int|None): If supplied through the URL,
+                get the messages older than this message ID.
 
         Returns:
             list: list of dictionaries describing
-                messages, if successful.
+                messages, if paging by offset.
+            dict: The "messages" on this page, and the "next"
+                cursor (None if this is the last page), if paging
+                by cursor.
             None: If aborted.
 
         """
 
         json_data = get_valid_json(self.SCHEMA_GET)
-        offset = int(json_data['offset'])
         limit = int(json_data['limit'])
 
         # Just make sure not requesting too many at once!
@@ -169,19 +506,97 @@ class Messages(flask_restful.Resource):
             message = ("You may only request %d messages at once."
                        % config.LIMITS_MESSAGES_GET_LIMIT)
             flask_restful.abort(400, message=message)
+        elif limit < 1:
+            flask_restful.abort(400, message="Request at least 1 message.")
+
+        if before_id is not None:
+            json_data['before_id'] = before_id
+
+        etag = list_etag()
+        response = etag and not_modified(etag)
+
+        if response:
+            return response
+
+        if any(key in json_data for key in self.CURSOR_KEYS):
+            direction, key = get_cursor(json_data)
+            results, next_cursor = keyset_page(query_messages(),
+                                               [models.Message.id],
+                                               direction, key, limit)
+            return ({'messages': list_to_dicts(results),
+                     'next': next_cursor},
+                    200, validators(etag))
+
+        if 'offset' not in json_data:
+            message = "'offset' is a required property"
+            flask_restful.abort(400, message=message)
+
+        offset = int(json_data['offset'])
 
         # Now we're sure we have the right data to
         # make a query, actually do that query and
         # return said data or 404 if nothing matches.
-        query = db.session.query(models.Message)
-        results = query.limit(limit).offset(offset).all()
+        results = query_messages().limit(limit).offset(offset).all()
 
         if results == []:
             message = ("No messages found at offset %d limit %d"
                        % (offset, limit))
             flask_restful.abort(404, message=message)
         else:
-            return [r.to_dict() for r in results]
+            return list_to_dicts(results), 200, validators(etag)
+
+    @auth.login_required
+    @limiter.limit(config.LIMITS_MESSAGES_POST)
+    def post(self):
+        """Create many messages at once, from a list
+        of objects like those `Message.post` takes.
+
+        The messages are inserted together in one transaction,
+        and announced together in a single "messages" event
+        (rather than one "message" event apiece).
+
+        Returns:
+            list: list of dictionaries describing the
+                created messages, if successful.
+            None: If aborted.
+
+        """
+
+        json_data = get_valid_json(self.SCHEMA_POST)
+
+        if len(json_data) > config.LIMITS_MESSAGES_POST_LIMIT:
+            message = ("You may only post %d messages at once."
+                       % config.LIMITS_MESSAGES_POST_LIMIT)
+            flask_restful.abort(400, message=message)
+
+        user = current_user()
+
+        # one timestamp for the whole batch, so the database
+        # needn't be asked for each message's default.
+        created = datetime.datetime.utcnow()
+        user_id = user.id
+        rows = [{'user_id': user_id, 'text': item['text'],
+                 'created': created}
+                for item in json_data]
+        ids = insert_messages(rows)
+        get_search_index().add(db.session,
+                               [(message_id, row['text'])
+                                for message_id, row in zip(ids, rows)])
+        # serialize before committing, which would expire `user`.
+        user_dict = user.to_dict()
+        new_messages_dicts = []
+
+        for message_id, row in zip(ids, rows):
+            new_message = models.Message(user_id, row['text'])
+            new_message.id = message_id
+            new_message.created = created
+            new_messages_dicts.append(new_message.to_dict(user_dict))
+
+        db.session.commit()
+        board_version.bump()
+        sse.publish(new_messages_dicts, type='messages',
+                    channel=message_channels(user_id, json_data))
+        return new_messages_dicts
 
 
 class Message(flask_restful.Resource):
@@ -202,24 +617,56 @@ class Message(flask_restful.Resource):
     def put(self, message_id):
         """Edit an existing message.
 
+        The author check is part of the UPDATE itself, and the
+        edited message is read back with RETURNING where the
+        database supports it, otherwise with one SELECT.
+
         Argument:
             message_id (int): --
 
         """
 
         text = get_valid_json(self.SCHEMA)['text']
-        result = db.session.query(models.Message).get(message_id)
+        table = models.Message.__table__
 
         # we don't want people editing posts which don't
         # belong to them...
-        if result.user.username == auth.username():
-            result.text = text
-            db.session.commit()
-            return self.get(message_id)
-
+        statement = (table.update()
+                     .where(table.c.id == message_id)
+                     .where(table.c.user_id == flask.g.user_id)
+                     .values(text=text, version=table.c.version + 1,
+                             edited=datetime.datetime.utcnow()))
+
+        if supports_returning():
+            row = db.session.execute(statement.returning(table.c.created))
+            row = row.first()
+            edited = None
+
+            if row is not None:
+                edited = models.Message(flask.g.user_id, text)
+                edited.id = message_id
+                edited.created = row.created
+                edited.user = current_user()
+        elif db.session.execute(statement).rowcount:
+            edited = (db.session.query(models.Message)
+                      .options(sqlalchemy.orm.joinedload('user'))
+                      .get(message_id))
         else:
+            edited = None
+
+        if edited is not None:
+            get_search_index().update(db.session, [(message_id, text)])
+            # serialize before committing, which would expire it.
+            edited_dict = edited.to_dict()
+            db.session.commit()
+            message_changed(message_id)
+            return edited_dict
+        elif message_exists(message_id):
             message = "You are not this message's author."
             flask_restful.abort(400, message=message)
+        else:
+            message = "Cannot find message by id: %s" % message_id
+            flask_restful.abort(404, message=message)
 
     @auth.login_required
     @limiter.limit(config.LIMITS_MESSAGE_POST)
@@ -229,53 +676,363 @@ class Message(flask_restful.Resource):
         """
 
         text = get_valid_json(self.SCHEMA)['text']
-        user_id = (db.session.query(models.User)
-                   .filter(models.User.username == auth.username())
-                   .first().id)
-        new_message = models.Message(user_id, text)
+        user = current_user()
+        new_message = models.Message(user.id, text)
+        new_message.user = user
         db.session.add(new_message)
+        db.session.flush()
+        get_search_index().add(db.session, [(new_message.id, text)])
+        # serialize before committing, which would expire it.
+        new_message_dict = new_message.to_dict()
         db.session.commit()
-        new_message_from_db = self.get(new_message.id)
-        sse.publish(new_message_from_db, type='message')
-        return new_message_from_db
+        board_version.bump()
+        sse.publish(new_message_dict, type='message',
+                    channel=message_channels(new_message_dict['user']['id'],
+                                             [new_message_dict]))
+        return new_message_dict
 
     @auth.login_required
     @limiter.limit(config.LIMITS_MESSAGE_DELETE)
     def delete(self, message_id):
         """Delete a specific message.
 
+        The author check is part of the DELETE itself.
+
         Argument:
             message_id (int): --
 
         """
 
-        result = db.session.query(models.Message).get(message_id)
+        deleted = (db.session.query(models.Message)
+                   .filter(models.Message.id == message_id)
+                   .filter(models.Message.user_id == flask.g.user_id)
+                   .delete(synchronize_session=False))
 
-        if result is None:
-            flask_restful.abort(404, message="No post by id %d" % message_id)
-
-        if result.user.username == auth.username():
-            db.session.delete(result)
+        if deleted:
+            get_search_index().remove(db.session, [message_id])
             db.session.commit()
+            message_changed(message_id)
             return {}
-        else:
+        elif message_exists(message_id):
             message = "You're not the author of message %d" % message_id
             flask_restful.abort(401, message=message)
+        else:
+            flask_restful.abort(404, message="No post by id %d" % message_id)
 
     @limiter.limit(config.LIMITS_MESSAGE_GET)
+    @reads_from_replica
     def get(self, message_id):
-        """Get a specific post.
+        """Get a specific post, through `read_cache`.
+
+        Supports conditional requests (If-None-Match or
+        If-Modified-Since), which for cached messages don't
+        touch the database at all.
+
+        The ETag covers the message's author too, but
+        Last-Modified only the message itself: authors have
+        no timestamp of their own.
 
         """
 
-        result = db.session.query(models.Message).get(message_id)
+        entry = message_entry(message_id)
 
-        if result:
-            return result.to_dict()
-        else:
+        if entry is None:
             message = "Cannot find message by id: %s" % message_id
             flask_restful.abort(404, message=message)
 
+        user = cached_user(user_id=entry['user_id'])
+        etag = 'm%d.%d-%s' % (entry['id'], entry['version'],
+                              user_digest(user))
+        modified = parse_datetime(entry['modified'])
+        return (not_modified(etag, modified)
+                or (describe_message(entry, user), 200,
+                    validators(etag, modified)))
+
+
+class MessageSearch(flask_restful.Resource):
+    """Full-text search of messages, best matches first.
+
+    """
+
+    @limiter.limit(config.LIMITS_MESSAGES_SEARCH)
+    def get(self):
+        """Get a page of the messages containing every word
+        of the "q" query parameter, using an optional "limit"
+        and the "cursor" returned with the previous page.
+
+        Returns:
+            dict: The "messages" on this page, and the "next"
+                cursor (None if this is the last page).
+            None: If aborted.
+
+        """
+
+        args = flask.request.args
+        query = args.get('q', '')
+
+        if not query.strip():
+            flask_restful.abort(400, message="Missing search query: q")
+
+        try:
+            limit = int(args.get('limit', config.LIMITS_MESSAGES_GET_LIMIT))
+        except ValueError:
+            flask_restful.abort(400, message="Invalid limit.")
+
+        if limit > config.LIMITS_MESSAGES_GET_LIMIT or limit < 1:
+            message = ("You may only request 1 to %d messages at once."
+                       % config.LIMITS_MESSAGES_GET_LIMIT)
+            flask_restful.abort(400, message=message)
+
+        after = None
+
+        if 'cursor' in args:
+            direction, after = decode_cursor(args['cursor'])
+
+            if (direction != 'after' or len(after) != 2
+                    or not all(isinstance(v, (int, float)) for v in after)):
+                flask_restful.abort(400, message="Invalid cursor.")
+
+        # fetch one extra hit to learn if there's another page
+        hits = get_search_index().search(db.session, query, limit + 1,
+                                         after)
+        next_cursor = None
+
+        if len(hits) > limit:
+            hits = hits[:limit]
+            next_cursor = encode_cursor('after', list(hits[-1]))
+
+        message_ids = [message_id for __, message_id in hits]
+        results = {}
+
+        if message_ids:
+            query = query_messages().filter(
+                models.Message.id.in_(message_ids)
+            )
+            results = dict((result.id, result) for result in query)
+
+        # an index may briefly know of messages since deleted
+        results = [results[i] for i in message_ids if i in results]
+        return {'messages': list_to_dicts(results), 'next': next_cursor}
+
+
+class MessagesExport(flask_restful.Resource):
+    """Everything, for backups and analysis; admins only.
+
+    """
+
+    @auth.login_required
+    @limiter.limit(config.LIMITS_MESSAGES_EXPORT)
+    def get(self):
+        """Stream every user and then every message as NDJSON
+        (see `export`), gzipped if the client accepts it.
+
+        Query parameters, all optional: "tables" (comma
+        separated, default "users,messages"), and "since" and
+        "until", bounding when rows were created.
+
+        """
+
+        if auth.username() not in config.ADMIN_USERNAMES:
+            flask_restful.abort(403, message="Only admins may export.")
+
+        args = flask.request.args
+        tables = args.get('tables', 'users,messages').split(',')
+
+        for table in tables:
+
+            if table not in export.TABLES:
+                flask_restful.abort(400, message="No such table: %s" % table)
+
+        chunks = export.ndjson(db.session, tables,
+                               get_datetime_arg('since'),
+                               get_datetime_arg('until'),
+                               config.EXPORT_CHUNK_SIZE)
+        headers = {'Vary': 'Accept-Encoding'}
+
+        if 'gzip' in flask.request.accept_encodings:
+            chunks = export.gzipped(chunks)
+            headers['Content-Encoding'] = 'gzip'
+
+        # the generator runs after we return, and needs the
+        # request's database session
+        return flask.Response(flask.stream_with_context(chunks),
+                              mimetype='application/x-ndjson',
+                              headers=headers)
+
+
+if config.JSON_ENCODER != 'json':
+    json_encoder = importlib.import_module(config.JSON_ENCODER)
+
+    @api.representation('application/json')
+    def output_json(data, code, headers=None):
+        """Encode responses with `config.JSON_ENCODER`
+        instead of the standard library.
+
+        """
+
+        dumped = json_encoder.dumps(data)
+
+        if not isinstance(dumped, bytes):
+            dumped = dumped.encode('utf-8')
+
+        response = flask.make_response(dumped + b"\n", code)
+        response.headers.extend(headers or {})
+        return response
+
+
+def start_measuring():
+    # these run on every request (and query), so flask.g is
+    # looked up through its proxy just the once
+    g = flask.g._get_current_object()
+
+    if config.METRICS_ENABLED:
+        g.measuring = time.time()
+        g.queries = 0
+        g.query_seconds = 0.0
+
+    if (config.PROFILE_ENABLED
+            and flask.request.endpoint in config.PROFILE_ENDPOINTS):
+        g.profile = profiler.Profile(
+            '%s %s' % (flask.request.method,
+                       flask.request.full_path.rstrip('?'))
+        )
+
+
+# before flask_limiter's, which may refuse the request
+app.before_request_funcs.setdefault(None, []).insert(0, start_measuring)
+
+
+@app.after_request
+def measure_request(response):
+    """Record how the request went, in `instruments`: one
+    update per metric per request, however many queries it
+    made, all under one lock.
+
+    """
+
+    g = flask.g._get_current_object()
+    started = g.get('measuring')
+
+    if started is None:
+        return response
+
+    request = flask.request
+    endpoint = request.endpoint or 'none'
+    labels = (('endpoint', endpoint), ('method', request.method))
+    increments = [('msg_requests_total',
+                   labels + (('status', str(response.status_code)),), 1)]
+
+    if g.queries:
+        increments.append(('msg_db_queries_total',
+                           (('endpoint', endpoint),), g.queries))
+        increments.append(('msg_db_query_seconds_total',
+                           (('endpoint', endpoint),), g.query_seconds))
+
+    if response.status_code == 429:
+        # what flask_limiter refused the request by
+        limit = g.get('view_rate_limit')
+        increments.append(('msg_rate_limited_total',
+                           (('limit', str(limit[0]) if limit else 'unknown'),
+                            ('endpoint', endpoint)), 1))
+
+    instruments.record(increments, [('msg_request_duration_seconds', labels,
+                                     time.time() - started)])
+    instruments.maybe_save()
+    return response
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.engine.Engine,
+                              'before_cursor_execute')
+def query_started(conn, cursor, statement, parameters, context, many):
+
+    if not flask.has_request_context():
+        return
+
+    g = flask.g._get_current_object()
+
+    if 'measuring' in g or 'profile' in g:
+        conn.info['query_started'] = time.time()
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.engine.Engine,
+                              'after_cursor_execute')
+def query_finished(conn, cursor, statement, parameters, context, many):
+    started = conn.info.pop('query_started', None)
+
+    if started is None or not flask.has_request_context():
+        return
+
+    seconds = time.time() - started
+    g = flask.g._get_current_object()
+
+    # counted up in flask.g, for `measure_request`
+    if 'measuring' in g:
+        g.queries += 1
+        g.query_seconds += seconds
+
+    if 'profile' in g:
+        g.profile.add(statement, parameters, seconds)
+
+
+@app.after_request
+def log_profile(response):
+    """Log a profiled request's queries, if it was slow (with
+    their plans) or repeated any (N+1).
+
+    """
+
+    # so explaining isn't profiled too
+    profile = flask.g.pop('profile', None)
+
+    if profile is None:
+        return response
+
+    slow = profile.seconds() >= config.PROFILE_SLOW_SECONDS
+
+    if not slow and not profile.repeated(config.PROFILE_REPEATED):
+        return response
+
+    plans = {}
+
+    if slow:
+
+        with db.engine.connect() as connection:
+
+            for shape, queries in profile.shapes().items():
+                statement, parameters, __ = max(queries,
+                                                key=lambda query: query[2])
+
+                try:
+                    plans[shape] = profiler.explain(connection, statement,
+                                                    parameters)
+                except sqlalchemy.exc.DBAPIError as error:
+                    plans[shape] = ["Couldn't explain: %s" % error.orig]
+
+    app.logger.warning(profile.report(config.PROFILE_REPEATED, plans))
+    return response
+
+
+def measure_streams(registry):
+    stats = sse.hub.stats()
+    registry.set('msg_stream_connections', stats['connections'])
+    registry.set('msg_stream_events_total', stats['events'])
+    registry.set('msg_stream_dropped_total', stats['dropped'])
+
+
+instruments.collectors.append(measure_streams)
+
+
+@app.route('/metrics')
+@limiter.exempt
+def metrics_view():
+    """Every worker's measurements, in Prometheus' text
+    format.
+
+    """
+
+    return flask.Response(instruments.render(),
+                          mimetype='text/plain; version=0.0.4')
+
 
 @auth.error_handler
 def auth_error():
@@ -288,6 +1045,14 @@ def get_password(username, password):
     corresponding user, then return the result
     of checking that password.
 
+    Pairs which check out are remembered in
+    `credential_cache` (by a keyed digest of the password,
+    never the password itself), so a client repeating a
+    request skips both the user lookup and the password hash.
+    A wrong password can't hit the cache; its digest differs.
+    Nor can a changed one, in any worker: entries are keyed
+    by `credential_versions` as well, read before the user is.
+
     Arguments:
         username (str):
         password (str):
@@ -301,26 +1066,1148 @@ def get_password(username, password):
 
     """
 
-    result = (db.session.query(models.User)
-              .filter(models.User.username == username).first())
+    version = credential_versions.get()
+    key = (username, credential_digest(password), version)
+    # None when Redis is down; another worker may have changed it
+    user_id = None if version is None else credential_cache.get(key)
 
-    if result is None:
-        return False
-    else:
-        return result.check_password(password)
+    if user_id is not None:
+        flask.g.user_id = user_id
+        return True
 
+    query = db.session.query(models.User).filter(
+        models.User.username == username
+    )
+    session = db.session()
+    reading, session.reading = session.reading, not wrote_recently()
+
+    try:
+        result = falling_back(query.first)
+    finally:
+        session.reading = reading
+
+    # perhaps they've only just signed up, and the replica's behind
+    if result is None and session.replica and not reading:
+        result = query.first()
+
+    if result is None:
+        return False
+    elif hasher.check(result.password_hash, password):
+
+        if hasher.needs_rehash(result.password_hash):
+            result.password_hash = hasher.hash(password)
+            db.session.commit()
+
+        if version is not None:
+            credential_cache.set(key, result.id)
+
+        flask.g.user = result
+        flask.g.user_id = result.id
+        return True
+    else:
+        return False
+
+
+def current_user():
+    """Get the user `get_password` authenticated, querying
+    for them at most once per request (and not at all if
+    `get_password` already had to).
+
+    Returns:
+        models.User: --
+
+    """
+
+    user = getattr(flask.g, 'user', None)
+
+    if user is None:
+        user = db.session.query(models.User).get(flask.g.user_id)
+        flask.g.user = user
+
+    return user
+
+
+def credential_digest(password):
+    """Keyed digest of a password, cheap to compute, for
+    keying `credential_cache`.
+
+    Arguments:
+        password (str): --
+
+    Returns:
+        str: Hex digest.
+
+    """
+
+    return hmac.new(CREDENTIAL_SECRET, password.encode('utf-8'),
+                    hashlib.sha256).hexdigest()
+
+
+def forget_credentials(username, session=None):
+    """Drop every cached credential for `username`, in this
+    worker now, and in every worker once `session` commits.
+
+    Other workers' entries only go stale once the change is
+    committed; bumping `credential_versions` any sooner, they
+    could check the old password again and cache it afresh.
+
+    Arguments:
+        username (str): --
+        session (sqlalchemy.orm.Session|None): Holding the
+            change, if it's not yet committed.
+
+    """
+
+    credential_cache.prune(lambda key: key[0] == username)
+
+    if session is None:
+        credential_versions.bump()
+    else:
+        session.info['credentials_changed'] = True
+
+
+@sqlalchemy.event.listens_for(replicas.RoutingSession, 'after_commit')
+def credentials_committed(session):
+
+    if session.info.pop('credentials_changed', False):
+        credential_versions.bump()
+
+
+@sqlalchemy.event.listens_for(replicas.RoutingSession, 'after_rollback')
+def credentials_rolled_back(session):
+    session.info.pop('credentials_changed', None)
+
+
+@sqlalchemy.event.listens_for(models.User.password_hash, 'set')
+def password_changed(target, value, oldvalue, initiator):
+    session = sqlalchemy.orm.object_session(target)
+
+    # a new user has nothing cached
+    if session is not None:
+        forget_credentials(target.username, session)
+
+
+@sqlalchemy.event.listens_for(models.User, 'after_update')
+def user_updated(mapper, connection, target):
+    forget_user(target, sqlalchemy.orm.object_session(target))
+
+
+@sqlalchemy.event.listens_for(models.User, 'after_delete')
+def user_deleted(mapper, connection, target):
+    session = sqlalchemy.orm.object_session(target)
+    forget_credentials(target.username, session)
+    forget_user(target, session)
+
+
+@sqlalchemy.event.listens_for(replicas.RoutingSession, 'after_commit')
+def users_committed(session):
+    keys = session.info.pop('forget_users', None)
+
+    if keys:
+        cache_changed(*keys)
+
+
+@sqlalchemy.event.listens_for(replicas.RoutingSession, 'after_rollback')
+def users_rolled_back(session):
+    session.info.pop('forget_users', None)
+
+
+def message_entry(message_id):
+    """Get what `read_cache` knows about a message: its
+    description, but with its author's "user_id" instead
+    of the author, plus its "version," and when it was last
+    "modified."
+
+    The author is cached (and so invalidated) separately;
+    see `describe_message`.
+
+    Arguments:
+        message_id (int): --
+
+    Returns:
+        dict|None: None if there's no such message.
+
+    """
+
+    key = 'message:%d' % message_id
+    entry = read_cache.get(key)
+
+    if entry is None:
+        version = read_cache.version()
+        query = with_authors(db.session.query(models.Message),
+                             config.MESSAGE_AUTHOR_LOADING)
+        result = query.get(message_id)
+
+        if result is None:
+            return None
+
+        entry = messages_to_dicts([result],
+                                  config.MESSAGE_AUTHOR_LOADING)[0]
+        user_dict = entry.pop('user')
+        entry['user_id'] = user_dict['id']
+        entry['version'] = result.version
+        entry['modified'] = (result.edited or result.created).isoformat()
+
+        if version is not None and not reads_stale():
+            read_cache.set(key, entry, version)
+            read_cache.set('user:%d' % user_dict['id'], user_dict, version)
+
+    return entry
+
+
+def describe_message(entry, user):
+    """Turn a `message_entry` into the message's description,
+    as `models.Message.to_dict` would.
+
+    Arguments:
+        entry (dict): --
+        user (dict|None): Its author, from `cached_user`.
+
+    Returns:
+        dict: --
+
+    """
+
+    return {'id': entry['id'],
+            'text': entry['text'],
+            'user': user,
+            'created': entry['created']}
+
+
+def user_digest(user):
+    """Digest a user's description, for ETags: users have no
+    version of their own, but their (cached) description is
+    tiny.
+
+    Arguments:
+        user (dict|None): From `cached_user`.
+
+    Returns:
+        str: Hex digest.
+
+    """
+
+    user_json = json.dumps(user, sort_keys=True).encode('utf-8')
+    return hashlib.sha1(user_json).hexdigest()
+
+
+def cached_user(user_id=None, username=None):
+    """Get the dictionary describing a user, by user ID
+    *or* username, by way of `read_cache`.
+
+    Arguments:
+        user_id (int|None): --
+        username (str|None): --
+
+    Returns:
+        dict|None: None if there's no such user.
+
+    """
+
+    query = db.session.query(models.User)
+
+    if user_id is not None:
+        key = 'user:%d' % user_id
+        query = query.filter(models.User.id == user_id)
+    else:
+        key = 'username:%s' % username
+        query = query.filter(models.User.username == username)
+
+    user_dict = read_cache.get(key)
+
+    if user_dict is None:
+        version = read_cache.version()
+        user = query.first()
+
+        if user is None:
+            return None
+
+        user_dict = user.to_dict()
+
+        if version is not None and not reads_stale():
+            read_cache.set(key, user_dict, version)
+
+    return user_dict
+
+
+def cached_users(user_ids):
+    """Get the dictionaries describing many users at once,
+    by way of `read_cache`, querying for all of those not
+    cached together.
+
+    Arguments:
+        user_ids (iterable): --
+
+    Returns:
+        dict: User ID to dictionary, for those users who exist.
+
+    """
+
+    users = {}
+    missing = []
+
+    for user_id in set(user_ids):
+        user_dict = read_cache.get('user:%d' % user_id)
+
+        if user_dict is None:
+            missing.append(user_id)
+        else:
+            users[user_id] = user_dict
+
+    if missing:
+        version = read_cache.version()
+        query = (db.session.query(models.User)
+                 .filter(models.User.id.in_(missing)))
+
+        for user in query:
+            user_dict = user.to_dict()
+            users[user.id] = user_dict
+
+            if version is not None and not reads_stale():
+                read_cache.set('user:%d' % user.id, user_dict, version)
+
+    return users
+
+
+def with_authors(query, loading):
+    """Have a query for messages load their authors a
+    certain way.
+
+    Arguments:
+        query (sqlalchemy.orm.Query): For `models.Message`.
+        loading (str): "joined," "selectin," "subquery," or
+            "none," see `config.MESSAGES_AUTHOR_LOADING`.
+
+    Returns:
+        sqlalchemy.orm.Query: --
+
+    """
+
+    return query.options(AUTHOR_LOADERS[loading](models.Message.user))
+
+
+def messages_to_dicts(messages, loading, authors=None):
+    """Describe many messages, describing each of their
+    authors only once.
+
+    Arguments:
+        messages (list): `models.Message`s, as queried with
+            `with_authors(query, loading)`.
+        loading (str): --
+        authors (dict|None): User ID to dictionary for authors
+            already at hand.
+
+    Returns:
+        list: --
+
+    """
+
+    authors = dict(authors or {})
+
+    if loading == 'none':
+        authors.update(cached_users(m.user_id for m in messages
+                                    if m.user_id not in authors))
+
+    message_dicts = []
+
+    for message in messages:
+
+        if message.user_id not in authors:
+            authors[message.user_id] = message.user.to_dict()
+
+        message_dicts.append(message.to_dict(authors[message.user_id]))
+
+    return message_dicts
+
+
+def query_messages(loading=None):
+    """Start a query for a list of messages: for plain
+    `MESSAGE_COLUMNS` rows if `config.MESSAGES_COLUMNAR`,
+    otherwise for `models.Message`s with their authors
+    loaded per `loading`.
+
+    Arguments:
+        loading (str|None): Defaults to
+            `config.MESSAGES_AUTHOR_LOADING`.
+
+    Returns:
+        sqlalchemy.orm.Query: --
+
+    """
+
+    if config.MESSAGES_COLUMNAR:
+        return db.session.query(*MESSAGE_COLUMNS)
+
+    return with_authors(db.session.query(models.Message),
+                        loading or config.MESSAGES_AUTHOR_LOADING)
+
+
+def list_to_dicts(results, loading=None, authors=None):
+    """Describe the results of `query_messages`.
+
+    Arguments:
+        results (list): --
+        loading (str|None): As given to `query_messages`.
+        authors (dict|None): See `messages_to_dicts`.
+
+    Returns:
+        list: --
+
+    """
+
+    if config.MESSAGES_COLUMNAR:
+        return rows_to_dicts(results, authors)
+
+    return messages_to_dicts(results,
+                             loading or config.MESSAGES_AUTHOR_LOADING,
+                             authors)
+
+
+def rows_to_dicts(rows, authors=None):
+    """Describe messages given as `MESSAGE_COLUMNS` rows,
+    exactly as `models.Message.to_dict` would, without
+    any ORM objects.
+
+    Arguments:
+        rows (list): --
+        authors (dict|None): See `messages_to_dicts`.
+
+    Returns:
+        list: --
+
+    """
+
+    authors = dict(authors or {})
+    authors.update(cached_users(row[3] for row in rows
+                                if row[3] not in authors))
+    timestamps = format_timestamps(row[2] for row in rows)
+    return [{'id': message_id,
+             'text': text,
+             'user': authors[user_id],
+             'created': timestamps[created]}
+            for message_id, text, created, user_id in rows]
+
+
+def format_timestamps(values):
+    """Format many datetimes as `to_dict` does, each
+    distinct one only once (e.g., a bulk post's messages
+    all share a timestamp).
+
+    Arguments:
+        values (iterable): `datetime.datetime`s.
+
+    Returns:
+        dict: datetime to string.
+
+    """
+
+    formatted = {}
+
+    for value in values:
+
+        if value not in formatted:
+            formatted[value] = value.isoformat("T") + 'Z'
+
+    return formatted
+
+
+def forget_user(user, session):
+    """Drop `user`'s descriptions from `read_cache` once
+    `session` commits (see `cache_changed`).
+
+    Arguments:
+        user (models.User): --
+        session (sqlalchemy.orm.Session): Holding the change.
+
+    """
+
+    usernames = set([user.username])
+    history = sqlalchemy.inspect(user).attrs.username.history
+    usernames.update(history.deleted or ())
+    keys = session.info.setdefault('forget_users', set())
+    keys.add('user:%d' % user.id)
+    keys.update('username:%s' % name for name in usernames)
+
+
+TOPIC = re.compile(r'#(\w+)', re.UNICODE)
+"""re.RegexObject: A topic, i.e., hashtag, in a message's
+text.
+"""
+
+
+def message_channels(user_id, messages):
+    """Get the stream channels new messages are published
+    to: everything, their author's and, if there's a
+    `config.STREAM_TOPIC_CHANNELS`, their topics'.
+
+    Arguments:
+        user_id (int): The author's ID.
+        messages (list): Dictionaries with "text."
+
+    Returns:
+        list: --
+
+    """
+
+    channels = ['sse', 'sse.user.%d' % user_id]
+    topics = []
+
+    if config.STREAM_TOPIC_CHANNELS:
+
+        for message in messages:
+
+            for topic in TOPIC.findall(message['text']):
+                topic = topic.lower()
+
+                if topic not in topics:
+                    topics.append(topic)
+
+    channels.extend('sse.topic.%s' % topic
+                    for topic in topics[:config.STREAM_TOPIC_CHANNELS])
+    return channels
+
+
+def get_search_index():
+    """Get the `search.SearchIndex` for the database, per
+    `config.SEARCH_BACKEND`.
+
+    """
+
+    return search.index_for(db.engine, config.SEARCH_BACKEND)
+
+
+def rebuild_search_index():
+    """Index every message afresh, e.g., after switching
+    `config.SEARCH_BACKEND`, or for messages written before
+    there was search.
+
+    Returns:
+        int: Number of messages indexed.
+
+    """
+
+    index = get_search_index()
+    index.create(db.session)
+    indexed = index.rebuild(db.session)
+    db.session.commit()
+    return indexed
+
+
+@app.cli.command('rebuild-search')
+def rebuild_search_command():
+    """Index every message for /messages/search afresh."""
+
+    print("Indexed %d messages." % rebuild_search_index())
+
+
+@app.cli.command('export')
+@click.option('--tables', default='users,messages',
+              help="Comma separated: users, messages.")
+@click.option('--since', type=click.DateTime(), default=None,
+              help="Only rows created at or after this (UTC).")
+@click.option('--until', type=click.DateTime(), default=None,
+              help="Only rows created before this (UTC).")
+@click.option('--gzip', 'compress', is_flag=True, help="Gzip the output.")
+@click.option('--output', '-o', type=click.File('wb'), default='-',
+              help="File to write to, default stdout.")
+def export_command(tables, since, until, compress, output):
+    """Write every user and message out as NDJSON, as
+    /messages/export does, reporting throughput to stderr.
+
+    """
+
+    tables = tables.split(',')
+
+    for table in tables:
+
+        if table not in export.TABLES:
+            raise click.BadParameter("No such table: %s" % table,
+                                     param_hint='--tables')
+
+    meter = export.Meter()
+    chunks = meter(export.ndjson(db.session, tables, since, until,
+                                 config.EXPORT_CHUNK_SIZE))
+
+    if compress:
+        chunks = export.gzipped(chunks)
+
+    for chunk in chunks:
+        output.write(chunk)
+
+    stats = meter.stats()
+    click.echo("Exported %d rows (%.1f MB) in %.1fs: %d rows/s, %.1f MB/s"
+               % (stats['rows'], stats['bytes'] / 1e6, stats['seconds'],
+                  stats['rows_per_second'], stats['megabytes_per_second']),
+               err=True)
+
+
+@app.cli.command('import')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'input_format', type=click.Choice(['ndjson', 'csv']),
+              default=None, help="Default: from the file's extension.")
+@click.option('--type', 'row_type', type=click.Choice(['user', 'message']),
+              default=None, help="Type of CSV rows without a type column.")
+@click.option('--chunk-size', type=int, default=config.IMPORT_CHUNK_SIZE,
+              help="Rows per transaction.")
+@click.option('--processes', type=int, default=config.IMPORT_PROCESSES,
+              help="Processes hashing passwords, 0 for one per CPU.")
+@click.option('--restart', is_flag=True,
+              help="Start from the first row, even if an earlier run "
+                   "got further.")
+def import_command(path, input_format, row_type, chunk_size, processes,
+                   restart):
+    """Import users and messages from NDJSON (as written by
+    `flask export`, maybe gzipped) or CSV, a chunk at a
+    time, carrying on from where an interrupted run on the
+    same file left off.
+
+    """
+
+    name = path[:-3] if path.endswith('.gz') else path
+
+    if input_format is None:
+        input_format = 'csv' if name.endswith('.csv') else 'ndjson'
+
+    if path.endswith('.gz'):
+        lines = gzip.open(path, 'rt', encoding='utf-8', newline='')
+    else:
+        lines = io.open(path, encoding='utf-8', newline='')
+
+    if input_format == 'csv':
+        records = importer.read_csv(lines, row_type)
+    else:
+        records = importer.read_ndjson(lines)
+
+    # fork before there are database connections to inherit
+    pool = multiprocessing.Pool(processes or None)
+    loader = importer.Importer(db.session, os.path.abspath(path),
+                               chunk_size, pool, hasher.method)
+    reported = [0.0]
+
+    def progress(loader):
+        stats = loader.stats()
+
+        if stats['seconds'] - reported[0] >= 1:
+            reported[0] = stats['seconds']
+            click.echo("%d rows, %d rows/s"
+                       % (stats['rows'] + stats['resumed'],
+                          stats['rows_per_second']), err=True)
+
+    imported = False
+
+    try:
+
+        if restart:
+            loader.forget()
+
+        loader.run(records, progress)
+        imported = True
+    except ValueError as error:
+        raise click.ClickException("%s (run again to carry on from "
+                                   "the last chunk imported)" % error)
+    finally:
+        pool.close()
+        pool.join()
+        lines.close()
+
+        # only the chunks the checkpoint counts are kept
+        if not imported:
+            db.session.rollback()
+
+    # nobody was told about the rows as they went in
+    importer.reset_sequences(db.session)
+    db.session.commit()
+    rebuild_search_index()
+    read_cache.clear()
+    board_version.bump()
+
+    stats = loader.stats()
+    click.echo("Imported %d rows (%d resumed) in %.1fs: %d rows/s"
+               % (stats['rows'], stats['resumed'], stats['seconds'],
+                  stats['rows_per_second']), err=True)
+
+
+def message_changed(message_id):
+    """Forget what we know about a message which has just
+    been edited or deleted.
+
+    Arguments:
+        message_id (int): --
+
+    """
+
+    cache_changed('message:%d' % message_id)
+
+
+def cache_changed(*keys):
+    """Forget `keys` in `read_cache`, once the change to
+    what they describe is committed.
+
+    `board_version` goes up first, so a reader which loaded
+    the old row before the commit, but only stores it after
+    this, is turned away by `read_cache`; and anything it
+    stored before, this deletes.
+
+    Arguments:
+        keys (str): --
+
+    """
+
+    board_version.bump()
+    read_cache.delete(*keys)
+
+
+def list_etag():
+    """Make an ETag for the list of messages the current
+    request is after: the same request against the same
+    `board_version` gets the same list.
+
+    Without Redis, each worker has a `board_version` of its
+    own, which doesn't go up for others' changes; so lists get
+    no ETags.
+
+    Returns:
+        str|None: None if the board's version can't be known.
+
+    """
+
+    if not board_version.shared or reads_stale():
+        return None
+
+    version = board_version.get()
+
+    if version is None:
+        return None
+
+    request = flask.request
+    request_key = request.path.encode('utf-8') + b'?' + request.get_data()
+    return 'b%d-%s' % (version, hashlib.sha1(request_key).hexdigest())
+
+
+def not_modified(etag, last_modified=None):
+    """Check if the client already has what it's asking
+    for, by its If-None-Match or, failing that, its
+    If-Modified-Since.
+
+    Arguments:
+        etag (str): The current ETag, unquoted.
+        last_modified (datetime.datetime|None): In UTC.
+
+    Returns:
+        flask.Response|None: A 304 if the client is up to
+            date, otherwise None.
+
+    """
+
+    request = flask.request
+
+    if request.if_none_match:
+        fresh = request.if_none_match.contains_weak(etag)
+    elif request.if_modified_since and last_modified is not None:
+        if_modified_since = request.if_modified_since.replace(tzinfo=None)
+        fresh = last_modified.replace(microsecond=0) <= if_modified_since
+    else:
+        fresh = False
+
+    if fresh:
+        return flask.Response(status=304,
+                              headers=validators(etag, last_modified))
+
+
+def validators(etag, last_modified=None):
+    """Headers telling the client how to ask again
+    conditionally.
+
+    Arguments:
+        etag (str|None): Unquoted.
+        last_modified (datetime.datetime|None): In UTC.
+
+    Returns:
+        dict: --
+
+    """
+
+    headers = {}
+
+    if etag is not None:
+        headers['ETag'] = werkzeug.http.quote_etag(etag)
+
+    if last_modified is not None:
+        headers['Last-Modified'] = werkzeug.http.http_date(last_modified)
+
+    return headers
+
+
+def message_exists(message_id):
+    """Check if there's a message by `message_id`, without
+    loading it.
+
+    Arguments:
+        message_id (int): --
+
+    Returns:
+        bool: --
+
+    """
+
+    query = (db.session.query(models.Message.id)
+             .filter(models.Message.id == message_id))
+    return db.session.query(query.exists()).scalar()
+
+
+def supports_returning():
+    """Check if the database can hand back rows from an
+    UPDATE with RETURNING.
+
+    Returns:
+        bool: --
+
+    """
+
+    dialect = db.engine.dialect
+    return getattr(dialect, 'update_returning', dialect.implicit_returning)
+
+
+def insert_messages(rows):
+    """Insert messages with a single INSERT statement, and
+    get their IDs without asking again: by RETURNING where the
+    database supports it, otherwise from the statement's last
+    row ID, as SQLite numbers the rows of one statement one
+    after another (as does MySQL, from the first).
+
+    Arguments:
+        rows (list): dicts of `models.Message` columns, each
+            with the same keys.
+
+    Returns:
+        list: IDs, in the order of `rows`.
+
+    """
+
+    table = models.Message.__table__
+    statement = table.insert().values(rows)
+
+    if supports_returning():
+        result = db.session.execute(statement.returning(table.c.id))
+        return [row.id for row in result]
+
+    last_id = db.session.execute(statement).lastrowid
+
+    if db.engine.dialect.name == 'mysql':
+        return list(range(last_id, last_id + len(rows)))
+
+    return list(range(last_id - len(rows) + 1, last_id + 1))
+
+
+def get_valid_json(schema):
+    """Get the request's JSON, aborting with a 400 if it
+    doesn't validate against `schema`.
+
+    Arguments:
+        schema (str|dict): A schema, or the name of one
+            in `schemas`.
+
+    Returns:
+        dict: The request's JSON.
+
+    """
 
-def get_valid_json(schema):
     json_data = flask.request.get_json(force=True)
 
     try:
-        jsonschema.validate(json_data, schema)
+        schemas.validate(json_data, schema)
     except jsonschema.ValidationError as e:
         flask_restful.abort(400, message=e.message)
     else:
         return json_data
 
 
+def encode_cursor(direction, key):
+    """Create the opaque cursor handed out with a page.
+
+    Arguments:
+        direction (str): Either "before" or "after".
+        key (list): The values the page was ordered by, for
+            the last row on the page, e.g., its ID.
+
+    Returns:
+        str: URL-safe token to request the next page with.
+
+    """
+
+    key = [v.isoformat() if isinstance(v, datetime.datetime) else v
+           for v in key]
+    token = json.dumps([direction] + key).encode('utf-8')
+    return base64.urlsafe_b64encode(token).decode('utf-8')
+
+
+def decode_cursor(cursor):
+    """The reverse of `encode_cursor`, except datetimes
+    are left as strings, and the key is only checked against
+    the columns it seeks on by `keyset_page`.
+
+    Aborts with a 400 if the cursor is garbage.
+
+    Arguments:
+        cursor (str): --
+
+    Returns:
+        tuple: (direction, key)
+
+    """
+
+    try:
+        token = base64.urlsafe_b64decode(cursor.encode('utf-8'))
+        token = json.loads(token.decode('utf-8'))
+    except (TypeError, ValueError):
+        token = None
+
+    if (not isinstance(token, list) or len(token) < 2
+            or token[0] not in ('before', 'after')):
+        flask_restful.abort(400, message="Invalid cursor: %s" % cursor)
+
+    return token[0], token[1:]
+
+
+def get_cursor(json_data):
+    """Figure out which way to seek, and from where, from
+    a request's "before_id," "after_id," or "cursor."
+
+    A null "before_id" starts from the newest message, a
+    null "after_id" starts from the oldest.
+
+    Arguments:
+        json_data (dict): Validated request JSON.
+
+    Returns:
+        tuple: (direction, key), where key may be None.
+
+    """
+
+    supplied = [k for k in ('before_id', 'after_id', 'cursor')
+                if k in json_data]
+
+    if len(supplied) > 1:
+        message = "Specify only one of: %s." % ", ".join(supplied)
+        flask_restful.abort(400, message=message)
+
+    if 'cursor' in json_data:
+        return decode_cursor(json_data['cursor'])
+    elif 'before_id' in json_data:
+        direction, message_id = 'before', json_data['before_id']
+    else:
+        direction, message_id = 'after', json_data['after_id']
+
+    return direction, None if message_id is None else [message_id]
+
+
+def get_datetime_arg(name):
+    """Get a query parameter which is a UTC timestamp, as
+    formatted by the API (or without the "Z").
+
+    Aborts with a 400 if it's garbage.
+
+    Arguments:
+        name (str): --
+
+    Returns:
+        datetime.datetime|None: None if absent.
+
+    """
+
+    value = flask.request.args.get(name)
+
+    if value is None:
+        return None
+
+    try:
+        return parse_datetime(value[:-1] if value.endswith('Z') else value)
+    except ValueError:
+        message = "Invalid %s: %s" % (name, value)
+        flask_restful.abort(400, message=message)
+
+
+def parse_datetime(text):
+    """Parse a naive `datetime.isoformat()` string.
+
+    Arguments:
+        text (str): --
+
+    Raises:
+        ValueError: --
+
+    Returns:
+        datetime.datetime: --
+
+    """
+
+    if '.' in text:
+        return datetime.datetime.strptime(text, "%Y-%m-%dT%H:%M:%S.%f")
+    else:
+        return datetime.datetime.strptime(text, "%Y-%m-%dT%H:%M:%S")
+
+
+def keyset_page(query, columns, direction, key, limit):
+    """Get one page of `query` by seeking on indexed
+    `columns` rather than using OFFSET, so deep pages
+    cost as much as the first.
+
+    Arguments:
+        query (sqlalchemy.orm.Query): --
+        columns (list): Columns which together are unique
+            and indexed, e.g., [the primary key].
+        direction (str): "before" to walk toward smaller keys,
+            "after" to walk toward larger keys.
+        key (list|None): Exclusive starting point, one value per
+            column; None starts at the appropriate end.
+        limit (int): Maximum number of rows.
+
+    Returns:
+        tuple: (rows, next_cursor), where next_cursor is None
+            when there are no more rows.
+
+    """
+
+    if key is not None:
+
+        if len(key) != len(columns):
+            flask_restful.abort(400, message="Invalid cursor.")
+
+        try:
+            key = [cursor_value(column, value)
+                   for column, value in zip(columns, key)]
+        except (TypeError, ValueError):
+            flask_restful.abort(400, message="Invalid cursor.")
+
+        query = query.filter(seek(columns, key, direction))
+
+    if direction == 'before':
+        query = query.order_by(*[column.desc() for column in columns])
+    else:
+        query = query.order_by(*[column.asc() for column in columns])
+
+    # fetch one extra row to learn if there's another page
+    rows = query.limit(limit + 1).all()
+
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = [getattr(rows[-1], column.key) for column in columns]
+        next_cursor = encode_cursor(direction, last)
+    else:
+        next_cursor = None
+
+    return rows, next_cursor
+
+
+def cursor_value(column, value):
+    """Check one value of a cursor's key has the type of
+    the `column` it seeks on, since the cursor came from the
+    client and may have been tampered with.
+
+    Arguments:
+        column (sqlalchemy.Column): --
+        value: From the decoded cursor.
+
+    Raises:
+        ValueError: `value` doesn't suit `column`.
+
+    Returns:
+        The value to compare `column` with.
+
+    """
+
+    if isinstance(column.type, sqlalchemy.DateTime):
+
+        if not isinstance(value, type(u'')):
+            raise ValueError(value)
+
+        return parse_datetime(value)
+
+    if isinstance(column.type, sqlalchemy.Integer):
+
+        if isinstance(value, bool) or not isinstance(value, int):
+            raise ValueError(value)
+
+    return value
+
+
+def seek(columns, key, direction):
+    """Build the WHERE clause which is true for rows
+    ordered `direction` of `key` on `columns`, i.e.,
+    (a, b) < (x, y) spelled out as a < x OR (a = x AND b < y),
+    which every database understands.
+
+    Arguments:
+        columns (list): --
+        key (list): --
+        direction (str): "before" or "after."
+
+    Returns:
+        sqlalchemy.sql.ClauseElement: --
+
+    """
+
+    column, value = columns[0], key[0]
+    past = column < value if direction == 'before' else column > value
+
+    if len(columns) == 1:
+        return past
+
+    return sqlalchemy.or_(past,
+                          sqlalchemy.and_(column == value,
+                                          seek(columns[1:], key[1:],
+                                               direction)))
+
+
+def upgrade_db():
+    """Create whichever tables, columns and indexes are
+    missing, leaving existing tables and their data alone.
+
+    Use this, rather than `init_db`, to bring an existing
+    database up to date with `models`.
+
+    Returns:
+        list: Names of the columns ("table.column") and
+            indexes created.
+
+    """
+
+    engine = db.engine
+    models.Base.metadata.create_all(bind=engine)
+    inspector = sqlalchemy.inspect(engine)
+    created = []
+
+    for table in models.Base.metadata.sorted_tables:
+        existing = set(column['name']
+                       for column in inspector.get_columns(table.name))
+
+        for column in table.columns:
+
+            if column.name not in existing:
+                column_spec = sqlalchemy.schema.CreateColumn(column)
+                engine.execute("ALTER TABLE %s ADD COLUMN %s"
+                               % (table.name,
+                                  column_spec.compile(dialect=engine.dialect)))
+                created.append("%s.%s" % (table.name, column.name))
+
+        existing = set(index['name']
+                       for index in inspector.get_indexes(table.name))
+
+        for index in table.indexes:
+
+            if index.name not in existing:
+                index.create(bind=engine)
+                created.append(index.name)
+
+    search_index = get_search_index()
+
+    if search_index.create(engine):
+        search_index.rebuild(engine)
+        created.append(search_index.name)
+
+    return created
+
+
 def init_db():
     """Erase the tables (if exist) and create them anew.
 
@@ -328,14 +2215,31 @@ def init_db():
 
     """
 
+    search_index = get_search_index()
+    search_index.drop(db.engine)
     models.Base.metadata.drop_all(bind=db.engine)
     models.Base.metadata.create_all(bind=db.engine)
+    search_index.create(db.engine)
     db.session.commit()
+    credential_cache.clear()
+    read_cache.clear()
+    board_version.bump()
 
 
 api.add_resource(Message, '/message', '/message/<int:message_id>')
-api.add_resource(Messages, '/messages', '/messages/<int:page>')
+api.add_resource(Messages, '/messages', '/messages/<int:before_id>')
+api.add_resource(MessageSearch, '/messages/search')
+api.add_resource(MessagesExport, '/messages/export')
 api.add_resource(User, '/user', '/user/<int:user_id>', '/user/<username>')
+api.add_resource(UserMessages, '/user/<int:user_id>/messages',
+                 '/user/<username>/messages')
+
+schemas.register('user_post', User.SCHEMA_POST)
+schemas.register('messages_get', Messages.SCHEMA_GET)
+schemas.register('messages_post', Messages.SCHEMA_POST)
+schemas.register('message', Message.SCHEMA)
+schemas.register('user_messages_get', UserMessages.SCHEMA_GET)
+schemas.load_directory(os.path.join(config_path, config.JSON_SCHEMA_DIR))
 
 
 if config.SQLALCHEMY_DATABASE_URI == "sqlite:///:memory:":
@@ -0,0 +1,167 @@
+"""msg profiler: the SQL statements a request runs, and how
+long each took, for finding out why an endpoint is slow.
+
+Statements are grouped by their shape (the statement with
+its values taken out), so a request running the same shape
+over and over, e.g., loading each message's user one at a
+time (N+1 queries), stands out.
+
+"""
+
+import re
+import time
+import collections
+
+
+LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+"""regex: String and number literals."""
+
+PARAMETERS = re.compile(r"%\(\w+\)s|%s|(?<!:):\w+")
+"""regex: Bound parameters, in the paramstyles which aren't
+"?".
+"""
+
+LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+"""regex: Lists of values, e.g., for IN."""
+
+EXPLAIN = {
+           "sqlite": "EXPLAIN QUERY PLAN ",
+           "postgresql": "EXPLAIN ",
+           "mysql": "EXPLAIN ",
+          }
+"""dict: Database dialect to what goes before a query to get
+its plan.
+"""
+
+
+def shape(statement):
+    """Reduce a statement to what it'd be for any values,
+    and any number of them in a list.
+
+    Arguments:
+        statement (str): SQL.
+
+    Returns:
+        str: --
+
+    """
+
+    statement = PARAMETERS.sub('?', LITERALS.sub('?', statement))
+    return ' '.join(LISTS.sub('(?)', statement).split())
+
+
+def explain(connection, statement, parameters):
+    """Get a query's plan from the database, without running
+    it.
+
+    Arguments:
+        connection (sqlalchemy.engine.Connection): --
+        statement (str): SQL, as sent to the database.
+        parameters (tuple|dict): As sent with it.
+
+    Returns:
+        list: Lines of the plan; none for anything but a
+            SELECT, or a database we can't ask.
+
+    """
+
+    prefix = EXPLAIN.get(connection.dialect.name)
+
+    if prefix is None or not statement.lstrip().upper().startswith('SELECT'):
+        return []
+
+    return [str(row[-1]) for row
+            in connection.execute(prefix + statement, parameters)]
+
+
+class Profile(object):
+    """The statements run by one request.
+
+    Arguments:
+        name (str): What ran them, e.g., "GET /messages".
+        timer (callable): --
+
+    Attributes:
+        queries (list): (statement, parameters, seconds) triples,
+            in the order they were run.
+        started (float): --
+
+    """
+
+    def __init__(self, name, timer=time.time):
+        self.name = name
+        self.timer = timer
+        self.queries = []
+        self.started = timer()
+
+    def add(self, statement, parameters, seconds):
+        self.queries.append((statement, parameters, seconds))
+
+    def seconds(self):
+        """Seconds since the profile started."""
+
+        return self.timer() - self.started
+
+    def shapes(self):
+        """Group the statements by shape.
+
+        Returns:
+            collections.OrderedDict: Each shape to its
+                (statement, parameters, seconds) triples, in the
+                order first run.
+
+        """
+
+        shapes = collections.OrderedDict()
+
+        for query in self.queries:
+            shapes.setdefault(shape(query[0]), []).append(query)
+
+        return shapes
+
+    def repeated(self, least=3):
+        """Find the shapes run at least `least` times, which
+        probably should have been one query.
+
+        Returns:
+            list: (shape, times) pairs, most times first.
+
+        """
+
+        counts = [(statement, len(queries))
+                  for statement, queries in self.shapes().items()
+                  if len(queries) >= least]
+        return sorted(counts, key=lambda pair: -pair[1])
+
+    def report(self, least=3, plans=None):
+        """Describe the request's statements, one shape to a
+        paragraph, slowest (in all) first.
+
+        Arguments:
+            least (int): Flag shapes run at least this many
+                times as N+1.
+            plans (dict|None): Shape to lines of its plan, to
+                include.
+
+        Returns:
+            str: --
+
+        """
+
+        plans = plans or {}
+        shapes = self.shapes()
+        lines = ["%s: %.1f ms, %d queries (%.1f ms)"
+                 % (self.name, self.seconds() * 1000, len(self.queries),
+                    sum(query[2] for query in self.queries) * 1000)]
+
+        for statement, queries in sorted(
+            shapes.items(), key=lambda item: -sum(q[2] for q in item[1])
+        ):
+            lines.append("  %d x %.1f ms%s: %s"
+                         % (len(queries),
+                            sum(query[2] for query in queries) * 1000,
+                            " (N+1?)" if len(queries) >= least else "",
+                            statement))
+            lines.extend("    %s" % line for line in plans.get(statement, []))
+
+        return '\n'.join(lines)
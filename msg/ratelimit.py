@@ -0,0 +1,287 @@
+"""msg rate limiting: a `limits` storage backend which
+counts hits in-process, and only now and then adds them up
+in Redis.
+
+flask_limiter's Redis storage makes a round trip for every
+limit of every request; its memory storage makes none, but
+each worker then has limits of its own. `TwoTierStorage`
+sits in between: limits are shared by every worker, within
+a configurable error, while most hits cost no network.
+
+Use it with flask_limiter's settings, e.g.:
+
+    RATELIMIT_STORAGE_URL = "tiered+redis://localhost:6379"
+    RATELIMIT_STORAGE_OPTIONS = {"sync_interval": 1, "error": 0.1,
+                                 "min_slack": 2}
+
+Only the fixed window strategies are supported. These are
+counted windows, not token buckets: `limits` (which
+flask_limiter builds on) has no token bucket strategy, and a
+storage only counts hits. A worker's slack of unsynced hits
+plays the part of a local bucket of tokens, but a window's
+hits are only forgotten when it ends, so a client may burst
+up to twice a limit across the end of one window and the
+start of the next, as with any fixed window.
+
+"""
+
+import time
+
+import limits.storage
+import redis
+
+
+class Window(object):
+    """One worker's view of a limit's current window.
+
+    Attributes:
+        expires (float): When the window ends.
+        count (int): Hits counted by every worker, as of the
+            last sync.
+        pending (int): Hits counted here since then.
+        synced (float|None): When the last sync was.
+
+    """
+
+    __slots__ = ('expires', 'count', 'pending', 'synced')
+
+    def __init__(self, expires):
+        self.expires = expires
+        self.count = 0
+        self.pending = 0
+        self.synced = None
+
+
+class TwoTierStorage(limits.storage.Storage):
+    """Counts hits locally, adding them to Redis (and
+    learning everyone else's) once a limit has this worker's
+    share of the `error` in hits waiting, or once it's been
+    `sync_interval` seconds.
+
+    Each of W workers may then let through up to `error` of
+    a limit too many, so the most a limit may be overshot by
+    is W * `error` of it. An `error` of 0 makes every hit
+    a round trip, just like flask_limiter's Redis storage.
+
+    For small limits, such as most of msg's, that share rounds
+    down to nothing, so every hit would be a round trip anyway;
+    so a worker may always count `min_slack` hits (but fewer
+    than a limit's amount) without syncing, overshooting such
+    limits by up to W * `min_slack` hits instead. And once a
+    worker knows a limit's been reached, the rest of a burst
+    is refused without asking (still syncing every
+    `sync_interval`), error or not.
+
+    If Redis goes away, each worker falls back to counting
+    by itself until it's back.
+
+    Arguments:
+        uri (str): "tiered+" and a Redis URL.
+        sync_interval (float): Most seconds between syncs of
+            a busy limit.
+        error (float): Fraction of a limit each worker may
+            count without syncing.
+        min_slack (int): Fewest hits each worker may count
+            without syncing, unless `error` is 0.
+        timer (callable): Returns the current time in seconds,
+            replaceable for testing.
+
+    Attributes:
+        syncs (int): Number of round trips to Redis.
+        errors (int): Number of times Redis failed us.
+
+    """
+
+    STORAGE_SCHEME = ['tiered+redis']
+
+    PRUNE_INTERVAL = 60
+    """int: Seconds between forgetting ended windows."""
+
+    def __init__(self, uri, sync_interval=1.0, error=0.1, min_slack=2,
+                 timer=time.time, **options):
+        self.redis = redis.StrictRedis.from_url(uri.split('+', 1)[1],
+                                                **options)
+        self.sync_interval = sync_interval
+        self.error = error
+        self.min_slack = min_slack
+        self.timer = timer
+        self.syncs = 0
+        self.errors = 0
+        self._windows = {}
+        self._pruned = timer()
+        super(TwoTierStorage, self).__init__(uri)
+
+    def amount(self, key):
+        """Get the most hits the limit `key` allows per window.
+
+        `limits` keys end in the limit's amount, multiples and
+        granularity, e.g., "LIMITER/127.0.0.1/10/1/minute".
+
+        Returns:
+            int|None: None if `key` isn't such a key.
+
+        """
+
+        try:
+            return int(key.rsplit('/', 3)[1])
+        except (IndexError, ValueError):
+            return None
+
+    def slack(self, key):
+        """Get the number of hits on the limit `key` which
+        may be counted here before syncing.
+
+        """
+
+        amount = self.amount(key)
+
+        if amount is None or not self.error:
+            return 0
+
+        return max(int(amount * self.error),
+                   min(self.min_slack, amount - 1))
+
+    def incr(self, key, expiry, elastic_expiry=False):
+        """Count a hit on the limit `key`.
+
+        Arguments:
+            key (str): --
+            expiry (int): Length of the limit's window.
+            elastic_expiry (bool): Whether each sync restarts
+                the window.
+
+        Returns:
+            int: Hits in this window, as far as we know.
+
+        """
+
+        with self.lock:
+            now = self.timer()
+            window = self._live_window(key, now)
+
+            if window is None:
+                window = self._windows[key] = Window(now + expiry)
+
+            window.pending += 1
+            estimate = window.count + window.pending
+            amount = self.amount(key)
+
+            # nothing's known of a new window until it's synced;
+            # past the limit, others' hits can't change the answer
+            if (window.synced is not None
+                    and (window.pending <= self.slack(key)
+                         or (amount is not None and estimate > amount))
+                    and now - window.synced < self.sync_interval):
+                return estimate
+
+            pending = window.pending
+            window.pending = 0
+            window.synced = now
+
+        try:
+            count, ttl = self._push(key, pending, expiry, elastic_expiry)
+        except redis.RedisError:
+
+            with self.lock:
+                window.pending += pending
+                self.errors += 1
+
+            return estimate
+
+        with self.lock:
+            window.count = count
+            window.expires = now + ttl
+            return window.count + window.pending
+
+    def _push(self, key, hits, expiry, elastic_expiry):
+        """Add `hits` to Redis' count for `key`.
+
+        Returns:
+            tuple: Total hits and seconds left in the window.
+
+        """
+
+        pipeline = self.redis.pipeline()
+        pipeline.incrby(key, hits)
+        pipeline.ttl(key)
+        count, ttl = pipeline.execute()
+        self.syncs += 1
+
+        if elastic_expiry or ttl < 0:
+            self.redis.expire(key, expiry)
+            ttl = expiry
+
+        return count, ttl
+
+    def _live_window(self, key, now):
+        """Get the window `key` is in, if it hasn't ended,
+        now and then forgetting those which have.
+
+        """
+
+        if now - self._pruned >= self.PRUNE_INTERVAL:
+            self._windows = dict((k, w) for k, w in self._windows.items()
+                                 if w.expires > now)
+            self._pruned = now
+
+        window = self._windows.get(key)
+
+        if window is None or window.expires <= now:
+            return None
+
+        return window
+
+    def get(self, key):
+        """Get the hits in the current window of the limit
+        `key`, as far as we know.
+
+        """
+
+        with self.lock:
+            window = self._live_window(key, self.timer())
+            return 0 if window is None else window.count + window.pending
+
+    def get_expiry(self, key):
+        """Get when the current window of `key` ends."""
+
+        with self.lock:
+            now = self.timer()
+            window = self._live_window(key, now)
+            return int(now if window is None else window.expires)
+
+    def check(self):
+        """Check if Redis is there."""
+
+        try:
+            return self.redis.ping()
+        except redis.RedisError:
+            return False
+
+    def clear(self, key):
+        """Forget every hit on the limit `key`."""
+
+        with self.lock:
+            self._windows.pop(key, None)
+
+        self.redis.delete(key)
+
+    def reset(self):
+        """Forget every hit on every limit."""
+
+        with self.lock:
+            self._windows.clear()
+
+        keys = list(self.redis.scan_iter(match='LIMITER*'))
+
+        if keys:
+            self.redis.delete(*keys)
+
+    def stats(self):
+        """Return a dictionary describing how often this
+        storage goes to Redis.
+
+        """
+
+        return {'windows': len(self._windows),
+                'syncs': self.syncs,
+                'errors': self.errors}
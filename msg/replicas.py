@@ -0,0 +1,238 @@
+"""msg replicas: reading from copies of the database, so
+the primary is left to writing.
+
+Handlers which only read mark their session as `reading`;
+its queries then go to one of `SQLALCHEMY_REPLICA_URIS`
+(taking turns between requests, and skipping those which
+are down) until it writes, after which everything goes to
+the primary, so a request reads what it's written. (So that
+a client reads what it's written in earlier requests, see
+`msg.reads_from_replica`.)
+
+"""
+
+import time
+import threading
+import itertools
+
+import sqlalchemy
+import flask_sqlalchemy
+
+from . import sqlite
+
+
+class ReplicaSet(object):
+    """Engines for the replicas, taken in turn.
+
+    Engines are made on first use, i.e., in each worker, once
+    gunicorn has forked it, so their connection pools aren't
+    shared between workers.
+
+    Arguments:
+        uris (list): Database URIs.
+        check_interval (float): Seconds between checking each
+            replica is up.
+        timer (callable): --
+
+    Attributes:
+        engines (list): sqlalchemy.engine.Engine for each URI;
+            empty until first used.
+        healthy (list): bool for each URI, as last checked.
+        reads (list): Times each URI's been chosen.
+
+    """
+
+    def __init__(self, uris, check_interval=5.0, timer=time.time):
+        self.uris = list(uris)
+        self.check_interval = check_interval
+        self.timer = timer
+        self.engines = []
+        self.healthy = [True] * len(self.uris)
+        self.checked = [None] * len(self.uris)
+        self.reads = [0] * len(self.uris)
+        self._turns = itertools.count()
+        self._lock = threading.Lock()
+
+    def check(self, index):
+        """Check a replica answers a trivial query.
+
+        Returns:
+            bool: --
+
+        """
+
+        try:
+
+            with self.engines[index].connect() as connection:
+                connection.execute(sqlalchemy.text('SELECT 1'))
+
+            healthy = True
+        except sqlalchemy.exc.DBAPIError:
+            healthy = False
+
+        self.healthy[index] = healthy
+        self.checked[index] = self.timer()
+        return healthy
+
+    def choose(self):
+        """Get the next replica which is up, checking it first
+        if it's been `check_interval` seconds.
+
+        Returns:
+            sqlalchemy.engine.Engine|None: None if none are up.
+
+        """
+
+        if not self.engines and self.uris:
+
+            with self._lock:
+
+                if not self.engines:
+                    self.engines = [sqlalchemy.create_engine(uri)
+                                    for uri in self.uris]
+
+        now = self.timer()
+
+        for __ in self.uris:
+            index = next(self._turns) % len(self.uris)
+            checked = self.checked[index]
+
+            if checked is None or now - checked >= self.check_interval:
+                self.check(index)
+
+            if self.healthy[index]:
+                self.reads[index] += 1
+                return self.engines[index]
+
+        return None
+
+    def failed(self, engine):
+        """Skip a replica which failed a query until it's
+        next checked.
+
+        Arguments:
+            engine (sqlalchemy.engine.Engine): As `choose` gave.
+
+        """
+
+        index = self.engines.index(engine)
+        self.healthy[index] = False
+        self.checked[index] = self.timer()
+
+    def dispose(self):
+        """Close every replica's pooled connections."""
+
+        for engine in self.engines:
+            engine.dispose()
+
+    def stats(self):
+        """Describe each replica (without its password).
+
+        Returns:
+            list: dicts.
+
+        """
+
+        return [{'uri': repr(sqlalchemy.engine.url.make_url(uri)),
+                 'healthy': healthy,
+                 'reads': reads}
+                for uri, healthy, reads
+                in zip(self.uris, self.healthy, self.reads)]
+
+
+class RoutingSession(flask_sqlalchemy.SignallingSession):
+    """A session which reads from a replica while `reading`,
+    until it writes.
+
+    Attributes:
+        reading (bool): Set by handlers which only read.
+        wrote (bool): Whether anything's been written, by
+            flushing or an INSERT, UPDATE or DELETE statement.
+        replica (sqlalchemy.engine.Engine|bool|None): Which
+            replica this session reads from, chosen on its first
+            read; False if none were up.
+
+    """
+
+    def __init__(self, db, **options):
+        self.db = db
+        self.reading = False
+        self.wrote = False
+        self.replica = None
+        super(RoutingSession, self).__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+
+        if (self._flushing
+                or isinstance(clause, sqlalchemy.sql.expression.UpdateBase)):
+            self.wrote = True
+        elif self.reading and not self.wrote:
+
+            # the same replica throughout, as they may lag differently
+            if self.replica is None:
+                self.replica = self.db.get_replicas(self.app).choose() or False
+
+            if self.replica:
+                return self.replica
+
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(flask_sqlalchemy.SQLAlchemy):
+    """flask_sqlalchemy, with `RoutingSession`s, reading from
+    an app's `SQLALCHEMY_REPLICA_URIS`, and a SQLite file
+    primary set up per `sqlite`.
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._replicas = {}
+        super(RoutingSQLAlchemy, self).__init__(*args, **kwargs)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+
+        # else flask_sqlalchemy opens a connection per checkout
+        if sqlite.is_file(sa_url):
+            sqlite.engine_options(options, app.config['SQLITE_POOL_SIZE'])
+
+        super(RoutingSQLAlchemy, self).apply_driver_hacks(app, sa_url,
+                                                          options)
+
+    def create_engine(self, sa_url, engine_opts):
+        engine = super(RoutingSQLAlchemy, self).create_engine(sa_url,
+                                                              engine_opts)
+
+        if sqlite.is_file(engine.url):
+            app = self.get_app()
+            sqlite.tune(engine, app.config['SQLITE_PRAGMAS'],
+                        app.config['SQLITE_SINGLE_WRITER'])
+
+        return engine
+
+    def create_session(self, options):
+        return sqlalchemy.orm.sessionmaker(class_=RoutingSession, db=self,
+                                           **options)
+
+    def get_replicas(self, app=None):
+        """Get an app's replicas, afresh if its
+        `SQLALCHEMY_REPLICA_URIS` have changed.
+
+        Returns:
+            ReplicaSet: --
+
+        """
+
+        app = self.get_app(app)
+        uris = list(app.config.get('SQLALCHEMY_REPLICA_URIS') or [])
+        replicas = self._replicas.get(app)
+
+        if replicas is None or replicas.uris != uris:
+
+            if replicas is not None:
+                replicas.dispose()
+
+            replicas = self._replicas[app] = ReplicaSet(
+                uris, app.config.get('SQLALCHEMY_REPLICA_CHECK_INTERVAL', 5)
+            )
+
+        return replicas
@@ -0,0 +1,512 @@
+"""msg search: full-text indexes of message text.
+
+There's one `SearchIndex` per kind of database: SQLite's
+FTS5, Postgres' tsvector (with a GIN index), and a pure
+Python inverted index for anything else.
+
+Every index answers a search with (score, message ID)
+pairs, best (lowest score) first, so results may be paged
+through by seeking past the last pair, whatever the index.
+
+"""
+
+import re
+import math
+import threading
+import collections
+
+import sqlalchemy
+
+
+WORD = re.compile(r'\w+', re.UNICODE)
+"""re.RegexObject: What counts as a word, for searching."""
+
+
+def words(text):
+    """Split text into lowercase words.
+
+    Arguments:
+        text (str|None): --
+
+    Returns:
+        list: --
+
+    """
+
+    return [word.lower() for word in WORD.findall(text or '')]
+
+
+class SearchIndex(object):
+    """A full-text index of `posts.text`.
+
+    Each method takes a `bind`, i.e., the session (or
+    connection) to work through, so changes to the index
+    may be part of the same transaction as the messages'.
+
+    """
+
+    name = None
+    """str: Name of the table or index holding the index."""
+
+    def create(self, bind):
+        """Create the index, if it's missing.
+
+        Returns:
+            bool: True if it was missing.
+
+        """
+
+        raise NotImplementedError
+
+    def drop(self, bind):
+        """Drop the index, if it's there."""
+
+        raise NotImplementedError
+
+    def add(self, bind, messages):
+        """Index new messages.
+
+        Arguments:
+            bind (sqlalchemy.orm.Session|sqlalchemy.engine.Connectable):
+                --
+            messages (list): (message ID, text) pairs.
+
+        """
+
+        raise NotImplementedError
+
+    def remove(self, bind, message_ids):
+        """Forget messages.
+
+        Arguments:
+            bind (sqlalchemy.orm.Session|sqlalchemy.engine.Connectable):
+                --
+            message_ids (list): --
+
+        """
+
+        raise NotImplementedError
+
+    def update(self, bind, messages):
+        """Re-index edited messages.
+
+        Arguments:
+            bind (sqlalchemy.orm.Session|sqlalchemy.engine.Connectable):
+                --
+            messages (list): (message ID, text) pairs.
+
+        """
+
+        self.remove(bind, [message_id for message_id, __ in messages])
+        self.add(bind, messages)
+
+    def search(self, bind, query, limit, after=None):
+        """Find the messages containing every word of
+        `query`, best first.
+
+        Arguments:
+            bind (sqlalchemy.orm.Session|sqlalchemy.engine.Connectable):
+                --
+            query (str): --
+            limit (int): Most results.
+            after (list|None): The (score, message ID) to seek
+                past, as returned by an earlier search.
+
+        Returns:
+            list: (score, message ID) pairs.
+
+        """
+
+        raise NotImplementedError
+
+    def rebuild(self, bind):
+        """Index every message afresh.
+
+        Returns:
+            int: Number of messages indexed.
+
+        """
+
+        raise NotImplementedError
+
+
+class SQLiteSearch(SearchIndex):
+    """An FTS5 table, whose rowids are message IDs, ranked
+    by BM25.
+
+    """
+
+    name = 'posts_fts'
+
+    @staticmethod
+    def available(bind):
+        """Check if this SQLite has FTS5."""
+
+        options = bind.execute(sqlalchemy.text("PRAGMA compile_options"))
+        return any(row[0] == 'ENABLE_FTS5' for row in options)
+
+    def create(self, bind):
+        exists = bind.execute(sqlalchemy.text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' "
+            "AND name = :name"
+        ), {'name': self.name}).first()
+
+        if exists:
+            return False
+
+        bind.execute(sqlalchemy.text(
+            "CREATE VIRTUAL TABLE %s USING fts5(text)" % self.name
+        ))
+        return True
+
+    def drop(self, bind):
+        bind.execute(sqlalchemy.text("DROP TABLE IF EXISTS %s" % self.name))
+
+    def add(self, bind, messages):
+
+        if messages:
+            bind.execute(sqlalchemy.text(
+                "INSERT INTO %s (rowid, text) VALUES (:id, :text)" % self.name
+            ), [{'id': message_id, 'text': text or ''}
+                for message_id, text in messages])
+
+    def remove(self, bind, message_ids):
+
+        if message_ids:
+            bind.execute(sqlalchemy.text(
+                "DELETE FROM %s WHERE rowid = :id" % self.name
+            ), [{'id': message_id} for message_id in message_ids])
+
+    def update(self, bind, messages):
+
+        if messages:
+            bind.execute(sqlalchemy.text(
+                "UPDATE %s SET text = :text WHERE rowid = :id" % self.name
+            ), [{'id': message_id, 'text': text or ''}
+                for message_id, text in messages])
+
+    def search(self, bind, query, limit, after=None):
+        query_words = words(query)
+
+        if not query_words:
+            return []
+
+        # quoted, so words are never taken for FTS5 syntax
+        match = ' '.join('"%s"' % word for word in query_words)
+        params = {'match': match, 'limit': limit}
+        sql = ("SELECT score, id FROM "
+               "(SELECT bm25(%s) AS score, rowid AS id FROM %s "
+               "WHERE %s MATCH :match)" % (self.name, self.name, self.name))
+
+        if after is not None:
+            sql += (" WHERE score > :score"
+                    " OR (score = :score AND id > :id)")
+            params['score'], params['id'] = after
+
+        sql += " ORDER BY score, id LIMIT :limit"
+        rows = bind.execute(sqlalchemy.text(sql), params)
+        return [(score, message_id) for score, message_id in rows]
+
+    def rebuild(self, bind):
+        bind.execute(sqlalchemy.text("DELETE FROM %s" % self.name))
+        result = bind.execute(sqlalchemy.text(
+            "INSERT INTO %s (rowid, text) "
+            "SELECT id, coalesce(text, '') FROM posts" % self.name
+        ))
+        return result.rowcount
+
+
+class PostgresSearch(SearchIndex):
+    """A GIN index on the tsvector of `posts.text`, ranked by
+    `ts_rank`.
+
+    Postgres keeps the index up to date by itself, so there's
+    nothing to `add` or `remove`.
+
+    Arguments:
+        language (str): Text search configuration.
+
+    """
+
+    name = 'ix_posts_text_tsvector'
+
+    def __init__(self, language='english'):
+        self.language = language
+
+    def document(self):
+        return "to_tsvector('%s', coalesce(text, ''))" % self.language
+
+    def create(self, bind):
+        exists = bind.execute(sqlalchemy.text(
+            "SELECT 1 FROM pg_indexes WHERE indexname = :name"
+        ), {'name': self.name}).first()
+
+        if exists:
+            return False
+
+        bind.execute(sqlalchemy.text(
+            "CREATE INDEX %s ON posts USING gin (%s)"
+            % (self.name, self.document())
+        ))
+        return True
+
+    def drop(self, bind):
+        bind.execute(sqlalchemy.text("DROP INDEX IF EXISTS %s" % self.name))
+
+    def add(self, bind, messages):
+        pass
+
+    def remove(self, bind, message_ids):
+        pass
+
+    def search(self, bind, query, limit, after=None):
+
+        if not words(query):
+            return []
+
+        params = {'query': query, 'limit': limit}
+        # ts_rank is higher for better matches
+        sql = ("SELECT score, id FROM "
+               "(SELECT -ts_rank(%s, query) AS score, id "
+               "FROM posts, plainto_tsquery('%s', :query) AS query "
+               "WHERE %s @@ query) AS matches"
+               % (self.document(), self.language, self.document()))
+
+        if after is not None:
+            sql += (" WHERE score > :score"
+                    " OR (score = :score AND id > :id)")
+            params['score'], params['id'] = after
+
+        sql += " ORDER BY score, id LIMIT :limit"
+        rows = bind.execute(sqlalchemy.text(sql), params)
+        return [(score, message_id) for score, message_id in rows]
+
+    def rebuild(self, bind):
+        bind.execute(sqlalchemy.text("REINDEX INDEX %s" % self.name))
+        return bind.execute(sqlalchemy.text(
+            "SELECT count(*) FROM posts"
+        )).scalar()
+
+
+class MemorySearch(SearchIndex):
+    """An in-process inverted index (word to message ID to
+    occurrences), ranked by BM25, for databases without
+    full-text search of their own.
+
+    It's loaded from the database on the first search, and
+    only kept up to date with changes made by this process,
+    so it's for development, with a single worker: other
+    workers' changes aren't seen until it's rebuilt.
+
+    Changes made through a session are only applied once it
+    commits, and never if it rolls back.
+
+    Arguments:
+        k1 (float): BM25 term frequency saturation.
+        b (float): BM25 document length normalization.
+
+    """
+
+    name = 'memory'
+
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.loaded = False
+        self._postings = collections.defaultdict(dict)
+        self._lengths = {}
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._lengths)
+
+    def create(self, bind):
+        return False
+
+    def drop(self, bind):
+
+        with self._lock:
+            self._postings.clear()
+            self._lengths.clear()
+            self.loaded = False
+
+    def add(self, bind, messages):
+        self._when_committed(bind, self._add, messages)
+
+    def remove(self, bind, message_ids):
+        self._when_committed(bind, self._remove, message_ids)
+
+    def _when_committed(self, bind, change, argument):
+        """Make a change to the index once `bind` commits,
+        if it's a session, otherwise straight away.
+
+        """
+
+        if isinstance(bind, sqlalchemy.orm.scoped_session):
+            bind = bind()
+
+        if isinstance(bind, sqlalchemy.orm.Session):
+            bind.info.setdefault(PENDING, []).append((change, list(argument)))
+        else:
+            change(argument)
+
+    def _add(self, messages):
+
+        with self._lock:
+
+            # loading picks up what's in the database anyway
+            if not self.loaded:
+                return
+
+            # e.g., if loading had already picked it up
+            self._remove([message_id for message_id, __ in messages
+                          if message_id in self._lengths])
+
+            for message_id, text in messages:
+                message_words = words(text)
+                self._lengths[message_id] = len(message_words)
+
+                for word in message_words:
+                    postings = self._postings[word]
+                    postings[message_id] = postings.get(message_id, 0) + 1
+
+    def _remove(self, message_ids):
+
+        with self._lock:
+
+            if not self.loaded:
+                return
+
+            for message_id in message_ids:
+                self._lengths.pop(message_id, None)
+
+            message_ids = set(message_ids)
+
+            # a full scan, but edits and deletes are rare
+            for word in list(self._postings):
+                postings = self._postings[word]
+
+                for message_id in message_ids.intersection(postings):
+                    del postings[message_id]
+
+                if not postings:
+                    del self._postings[word]
+
+    def search(self, bind, query, limit, after=None):
+        query_words = set(words(query))
+
+        if not query_words:
+            return []
+
+        with self._lock:
+
+            if not self.loaded:
+                self.rebuild(bind)
+
+            postings = [self._postings.get(word, {}) for word in query_words]
+
+            if not all(postings):
+                return []
+
+            count = len(self._lengths)
+            average = float(sum(self._lengths.values())) / count
+            # only the rarest word's messages can match them all
+            postings.sort(key=len)
+            results = []
+
+            for message_id in postings[0]:
+
+                if not all(message_id in p for p in postings[1:]):
+                    continue
+
+                norm = self.k1 * (1 - self.b + self.b
+                                  * self._lengths[message_id] / average)
+                score = 0.0
+
+                for p in postings:
+                    idf = math.log(1 + (count - len(p) + 0.5)
+                                   / (len(p) + 0.5))
+                    frequency = p[message_id]
+                    score -= (idf * frequency * (self.k1 + 1)
+                              / (frequency + norm))
+
+                results.append((score, message_id))
+
+        if after is not None:
+            after = tuple(after)
+            results = [result for result in results if result > after]
+
+        results.sort()
+        return results[:limit]
+
+    def rebuild(self, bind):
+        rows = bind.execute(sqlalchemy.text("SELECT id, text FROM posts"))
+
+        with self._lock:
+            self.drop(bind)
+            self.loaded = True
+            self._add(list(rows))
+            return len(self._lengths)
+
+
+PENDING = 'search_changes'
+"""str: Key of a session's `info` holding `MemorySearch`
+changes to make once it commits.
+"""
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_commit')
+def apply_changes(session):
+
+    for change, argument in session.info.pop(PENDING, ()):
+        change(argument)
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_rollback')
+def discard_changes(session):
+    session.info.pop(PENDING, None)
+
+
+BACKENDS = {
+            "fts5": SQLiteSearch,
+            "postgres": PostgresSearch,
+            "memory": MemorySearch,
+           }
+"""dict: Name of each kind of `SearchIndex`, as used by
+`config.SEARCH_BACKEND`.
+"""
+
+_indexes = {}
+
+
+def index_for(engine, backend="auto"):
+    """Get the `SearchIndex` for a database, made the first
+    time it's asked for.
+
+    Arguments:
+        engine (sqlalchemy.engine.Engine): --
+        backend (str): A name in `BACKENDS`, or "auto" for the
+            best the database supports.
+
+    Returns:
+        SearchIndex: --
+
+    """
+
+    key = (str(engine.url), backend)
+
+    if key not in _indexes:
+
+        if backend == "auto":
+            dialect = engine.dialect.name
+
+            if dialect == "sqlite" and SQLiteSearch.available(engine):
+                backend = "fts5"
+            elif dialect == "postgresql":
+                backend = "postgres"
+            else:
+                backend = "memory"
+
+        _indexes[key] = BACKENDS[backend]()
+
+    return _indexes[key]
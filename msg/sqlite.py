@@ -0,0 +1,211 @@
+"""msg sqlite: running on a SQLite file, with readers and a
+writer at once.
+
+Each connection is set up with pragmas (WAL, so readers
+and the writer don't wait for each other) when it's made,
+and kept in a pool, so that's done once per connection
+rather than once per request.
+
+SQLite lets one connection write at a time. A transaction
+which has read, and then writes, can fail with "database is
+locked" straight away, however long `busy_timeout` is, if
+another has written since it read. So a transaction's first
+write (in each process, one at a time) ends what it's read
+and begins again IMMEDIATE, taking the write lock before
+going on. Like Postgres' READ COMMITTED, it sees what's been
+committed since its first read.
+
+Transactions wait their turn to write on a `WriteLock` of
+this process (which, under gevent, yields to other
+greenlets), and on `busy_timeout` only for other processes.
+The lock is let go once the transaction has committed or
+rolled back, not before.
+
+"""
+
+import re
+import threading
+
+import sqlalchemy
+
+
+READS = re.compile(r'\s*(SELECT|PRAGMA|EXPLAIN)\b', re.IGNORECASE)
+"""regex: Statements which don't write."""
+
+
+def is_file(url):
+    """Check if a database URL is of a SQLite file.
+
+    Arguments:
+        url (sqlalchemy.engine.url.URL): --
+
+    Returns:
+        bool: --
+
+    """
+
+    return (url.get_backend_name() == 'sqlite'
+            and url.database not in (None, '', ':memory:')
+            and 'mode=memory' not in url.database)
+
+
+def engine_options(options, pool_size=5):
+    """Set `sqlalchemy.create_engine` options for a pool of
+    connections to a SQLite file, for `tune`.
+
+    Arguments:
+        options (dict): Changed in place.
+        pool_size (int): Connections kept open.
+
+    """
+
+    options['poolclass'] = sqlalchemy.pool.QueuePool
+    options['pool_size'] = pool_size
+    connect_args = options.setdefault('connect_args', {})
+    # greenlets (and threads) share the pool
+    connect_args['check_same_thread'] = False
+    # sqlite3 only begins before writing, and never IMMEDIATE
+    connect_args['isolation_level'] = None
+
+
+class WriteLock(object):
+    """Lets one of an engine's connections write at a time.
+
+    It's not reentrant: another connection on the thread (or
+    greenlet) of the one writing would wait for ever, so it
+    isn't let wait at all.
+
+    Attributes:
+        holder (dict|None): `info` of the connection writing.
+        thread (threading.Thread|None): The thread it's on.
+
+    """
+
+    def __init__(self):
+        self.holder = None
+        self.thread = None
+        self._lock = threading.Lock()
+
+    def acquire(self, info):
+        """Wait for the lock, for the connection whose `info`
+        is given.
+
+        Returns:
+            bool: False, without waiting, if another connection
+                on this thread holds it.
+
+        """
+
+        thread = threading.current_thread()
+
+        # only this thread could have set it to this thread
+        if self.thread is thread:
+            return False
+
+        self._lock.acquire()
+        self.holder = info
+        self.thread = thread
+        return True
+
+    def release(self):
+        """Let the next connection write."""
+
+        self.holder = None
+        self.thread = None
+        self._lock.release()
+
+
+def tune(engine, pragmas, single_writer=True):
+    """Set pragmas on each of an engine's connections, and
+    have one transaction write at a time.
+
+    Arguments:
+        engine (sqlalchemy.engine.Engine): Made with
+            `engine_options`.
+        pragmas (dict): Pragma name to value, e.g.,
+            {"journal_mode": "WAL"}.
+        single_writer (bool): Whether to have writes wait for
+            the write lock, as above.
+
+    """
+
+    lock = WriteLock()
+    dbapi = engine.dialect.dbapi
+
+    @sqlalchemy.event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+
+        for name, value in pragmas.items():
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+
+        cursor.close()
+
+    @sqlalchemy.event.listens_for(engine, 'begin')
+    def begin(connection):
+        connection.connection.execute('BEGIN')
+        connection.info['began'] = True
+
+    @sqlalchemy.event.listens_for(engine, 'before_cursor_execute')
+    def before_write(connection, cursor, statement, parameters, context,
+                     many):
+        info = connection.info
+
+        if (not single_writer or 'writing' in info
+                or not info.get('began') or READS.match(statement)):
+            return
+
+        if not lock.acquire(info):
+            cursor.close()
+            raise sqlalchemy.exc.OperationalError(
+                statement, parameters, dbapi.OperationalError(
+                    "database is locked by another connection on this "
+                    "thread, which is writing"
+                )
+            )
+
+        info['writing'] = True
+        connection.connection.execute('ROLLBACK')
+        connection.connection.execute('BEGIN IMMEDIATE')
+
+    # These come just before sqlite3 commits or rolls back, so
+    # a writer does so itself, then lets the next one write;
+    # sqlite3 is left nothing to do.
+    @sqlalchemy.event.listens_for(engine, 'commit')
+    def commit(connection):
+        end(connection, 'COMMIT')
+
+    @sqlalchemy.event.listens_for(engine, 'rollback')
+    def rollback(connection):
+        end(connection, 'ROLLBACK')
+
+    def end(connection, statement):
+        info = connection.info
+        info.pop('began', None)
+
+        if not info.get('writing'):
+            return
+
+        try:
+            connection.connection.execute(statement)
+        except dbapi.Error:
+
+            # still writing; the rollback which follows lets go
+            if statement == 'COMMIT':
+                raise
+
+            # otherwise SQLite had rolled back already, as it
+            # does for some errors
+
+        del info['writing']
+        lock.release()
+
+    # e.g., if neither happened, for an error; the pool's
+    # rolled back by now
+    @sqlalchemy.event.listens_for(engine, 'checkin')
+    def checkin(dbapi_connection, connection_record):
+        info = connection_record.info
+        info.pop('began', None)
+
+        if info.pop('writing', False):
+            lock.release()
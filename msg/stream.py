@@ -0,0 +1,949 @@
+"""msg stream: server-sent events, fanned out to every
+client of a worker from a single Redis subscription.
+
+flask_sse gives each client its own Redis subscription,
+and decodes every event once per client. Here each worker
+has one `Hub`, which subscribes once, encodes each event
+once, and hands it to each client's bounded queue.
+
+Every event is given an ID, and the latest are kept in
+Redis, so a client which reconnects with a Last-Event-ID
+is sent what it missed.
+
+An event may be published to several channels at once,
+and a client may subscribe to several, and still gets it
+just once.
+
+Under bursts, events may be gathered by a `Batcher` and
+published to Redis together; clients which ask for batches
+get them as a single "batch" event, the rest one event per
+message as usual.
+
+"""
+
+import json
+import time
+import fnmatch
+import logging
+import threading
+import collections
+
+import flask
+import flask_sse
+import redis
+
+
+logger = logging.getLogger(__name__)
+
+
+RESYNC = str(flask_sse.Message({}, type='resync'))
+"""str: Event telling a client it has missed events and
+should fetch what it needs afresh.
+"""
+
+KEEPALIVE = ":\n\n"
+"""str: SSE comment, sent to idle clients so dead
+connections get noticed.
+"""
+
+RECENT_IDS = 64
+"""int: Number of recent event IDs a client subscribed to
+several channels remembers, so an event published to more
+than one of them is only queued once.
+"""
+
+PUBLISH = """
+local replay_size = tonumber(ARGV[1])
+local batch = ARGV[2] == '1'
+local channels = #KEYS - 1
+local first = 3 + channels
+local count = (#ARGV - first + 1) / 2
+local last_id = redis.call('INCRBY', KEYS[1], count)
+local events = {}
+local scored = {}
+
+for c = 1, channels do
+    events[c] = {}
+    scored[c] = {}
+end
+
+for i = 1, count do
+    local id = last_id - count + i
+    local event = string.format('{"id": %d, %s', id,
+                                string.sub(ARGV[first + 2 * i - 2], 2))
+
+    for c in string.gmatch(ARGV[first + 2 * i - 1], '%d+') do
+        c = tonumber(c)
+        table.insert(events[c], event)
+        table.insert(scored[c], id)
+        table.insert(scored[c], event)
+    end
+end
+
+for c = 1, channels do
+
+    if #events[c] > 0 then
+        local message = events[c][1]
+
+        if batch then
+            message = '{"batch": [' .. table.concat(events[c], ', ') .. ']}'
+        end
+
+        redis.call('ZADD', KEYS[c + 1], unpack(scored[c]))
+        redis.call('ZREMRANGEBYRANK', KEYS[c + 1], 0, -(replay_size + 1))
+        redis.call('PUBLISH', ARGV[2 + c], message)
+    end
+end
+
+return last_id
+"""
+"""str: Lua script numbering events (given as JSON objects
+without IDs), keeping them for replay and publishing them,
+all at once: so no event is published out of the order of
+its ID, nor numbered and then lost.
+
+KEYS are the ID counter, then each channel's replay buffer.
+ARGV are the replay size, "1" to publish a batch (or "0",
+for a single event), the channels, then for each event its
+JSON and the (space-separated, 1-based) numbers of the
+channels it's for. Each channel is sent just its events.
+"""
+
+
+def as_channels(channel):
+    """Return `channel` (a channel name, or a list of them)
+    as a list.
+
+    """
+
+    if isinstance(channel, (list, tuple)):
+        return list(channel)
+
+    return [channel]
+
+
+def encode_batch(events):
+    """Encode events as a single "batch" event.
+
+    Arguments:
+        events (list): flask_sse's event dictionaries.
+
+    Returns:
+        tuple: (last event ID, encoded event), as queued for
+            a `Subscription`.
+
+    """
+
+    last_id = events[-1].get('id')
+    return (last_id,
+            str(flask_sse.Message(events, type='batch', id=last_id)))
+
+
+class Subscription(object):
+    """One client's bounded queue of (event ID, encoded
+    event) pairs.
+
+    Arguments:
+        channels (iterable): Channels this client wants.
+        maxsize (int): Most events which may be waiting.
+        slow_consumer (str): What to do once `maxsize` events
+            are waiting: "drop" the client, or "coalesce" them
+            into a single `RESYNC` event.
+        batch (bool): Whether this client wants a batch of
+            events published together as one "batch" event.
+
+    Attributes:
+        closed (bool): True once dropped; the client should
+            be disconnected.
+
+    """
+
+    def __init__(self, channels, maxsize, slow_consumer, batch=False):
+        self.channels = frozenset(channels)
+        self.maxsize = maxsize
+        self.slow_consumer = slow_consumer
+        self.batch = batch
+        self.closed = False
+        self._events = collections.deque()
+        self._ready = threading.Condition()
+        self._recent = collections.deque()
+        self._recent_ids = set()
+
+    def __len__(self):
+        return len(self._events)
+
+    def put(self, event, fresh=False):
+        """Queue an event, never blocking.
+
+        Arguments:
+            event (tuple): (event ID, encoded event).
+            fresh (bool): Whether it's known not to have been
+                queued already, by `unseen`.
+
+        Returns:
+            str|None: "dropped" or "coalesced" if this client
+                was too slow, otherwise None.
+
+        """
+
+        with self._ready:
+
+            if self.closed or (not fresh and self._seen(event[0])):
+                return None
+
+            outcome = None
+
+            if len(self._events) >= self.maxsize:
+                self._events.clear()
+
+                if self.slow_consumer == 'coalesce':
+                    self._events.append((None, RESYNC))
+                    self._events.append(event)
+                    outcome = 'coalesced'
+                else:
+                    self.closed = True
+                    outcome = 'dropped'
+            else:
+                self._events.append(event)
+
+            self._ready.notify()
+            return outcome
+
+    def _seen(self, event_id):
+        """Check if an event has already been queued, by way of
+        another channel, remembering it if not.
+
+        """
+
+        if event_id is None or len(self.channels) < 2:
+            return False
+
+        if event_id in self._recent_ids:
+            return True
+
+        self._recent.append(event_id)
+        self._recent_ids.add(event_id)
+
+        if len(self._recent) > RECENT_IDS:
+            self._recent_ids.discard(self._recent.popleft())
+
+        return False
+
+    def unseen(self, event_ids):
+        """Get which events of a batch haven't already been
+        queued, by way of another channel, remembering them.
+
+        Arguments:
+            event_ids (list): --
+
+        Returns:
+            list: Those of `event_ids` not yet queued.
+
+        """
+
+        with self._ready:
+            return [event_id for event_id in event_ids
+                    if not self._seen(event_id)]
+
+    def get(self, timeout):
+        """Wait up to `timeout` seconds for the next event.
+
+        Returns:
+            tuple|None: (event ID, encoded event); None if
+                there's nothing yet, or if `closed`.
+
+        """
+
+        with self._ready:
+
+            if not self._events and not self.closed:
+                self._ready.wait(timeout)
+
+            if self._events:
+                return self._events.popleft()
+
+    def close(self):
+        """Wake up `get`, for good."""
+
+        with self._ready:
+            self.closed = True
+            self._ready.notify()
+
+
+class Hub(object):
+    """Fans events out from one Redis pattern subscription
+    to every `Subscription` in this process.
+
+    The subscription is only made once the first client
+    subscribes, by a background thread (a greenlet, under
+    gevent), which reconnects if Redis goes away.
+
+    Arguments:
+        redis_client (redis.StrictRedis|None): None for no
+            listener at all, e.g., for testing with `dispatch`.
+        pattern (str): Redis channel pattern covering every
+            channel clients may subscribe to.
+        queue_size (int): See `Subscription`.
+        slow_consumer (str): See `Subscription`.
+
+    """
+
+    def __init__(self, redis_client, pattern='sse*', queue_size=100,
+                 slow_consumer='drop'):
+        self.redis = redis_client
+        self.pattern = pattern
+        self.queue_size = queue_size
+        self.slow_consumer = slow_consumer
+        self.events = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.malformed = 0
+        self._subscriptions = {}
+        self._lock = threading.Lock()
+        self._listener = None
+
+    def subscribe(self, channels, batch=False):
+        """Start receiving events on `channels`.
+
+        Arguments:
+            channels (iterable): --
+            batch (bool): See `Subscription`.
+
+        Returns:
+            Subscription: Pass to `unsubscribe` when done.
+
+        """
+
+        subscription = Subscription(channels, self.queue_size,
+                                    self.slow_consumer, batch)
+
+        with self._lock:
+
+            for channel in subscription.channels:
+                self._subscriptions.setdefault(channel, set())
+                self._subscriptions[channel].add(subscription)
+
+        self.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Stop receiving events for `subscription`."""
+
+        with self._lock:
+
+            for channel in subscription.channels:
+                subscribers = self._subscriptions.get(channel, set())
+                subscribers.discard(subscription)
+
+                if not subscribers:
+                    self._subscriptions.pop(channel, None)
+
+        subscription.close()
+
+    def start(self):
+        """Start listening to Redis, if not already."""
+
+        if self.redis is None:
+            return
+
+        with self._lock:
+
+            if self._listener is None or not self._listener.is_alive():
+                self._listener = threading.Thread(target=self.listen)
+                self._listener.daemon = True
+                self._listener.start()
+
+    def listen(self):
+        """Relay everything published to `pattern` to
+        `dispatch`, forever.
+
+        A message `dispatch` can't handle is logged and
+        skipped, rather than ending the only listener every
+        client of this worker relies on.
+
+        """
+
+        while True:
+
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(self.pattern)
+
+                for message in pubsub.listen():
+
+                    if message['type'] != 'pmessage':
+                        continue
+
+                    try:
+                        self.dispatch(message['channel'], message['data'])
+                    except Exception:
+                        self.malformed += 1
+                        logger.exception("Skipped an event on %r",
+                                         message['channel'])
+            except redis.RedisError:
+                pass
+            except Exception:
+                logger.exception("Stream listener failed; resubscribing")
+
+            # back off, then resubscribe
+            time.sleep(1)
+
+    def dispatch(self, channel, data):
+        """Encode an event published by `flask_sse` (or a
+        batch of them, published by `HubBlueprint.publish_batch`)
+        just once, then queue it for each client subscribed to
+        `channel`.
+
+        Arguments:
+            channel (bytes|str): --
+            data (bytes|str): flask_sse's JSON, or a JSON object
+                with a list of those under "batch".
+
+        """
+
+        if isinstance(channel, bytes):
+            channel = channel.decode('utf-8')
+
+        with self._lock:
+            subscribers = list(self._subscriptions.get(channel, ()))
+
+        if not subscribers:
+            return
+
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+
+        event = json.loads(data)
+        batch = event.get('batch')
+
+        if batch is None:
+            batch = [event]
+
+        self.events += len(batch)
+        # each encoding is only made if some client wants it
+        events = None
+        batched = None
+
+        for subscription in subscribers:
+            fresh = False
+
+            if subscription.batch and len(batch) > 1:
+                # a batch for one channel may share some events
+                # with a batch for another this client's also on
+                unseen = subscription.unseen([e.get('id') for e in batch])
+                fresh = True
+
+                if len(unseen) == len(batch):
+
+                    if batched is None:
+                        batched = [encode_batch(batch)]
+
+                    queue = batched
+                elif len(unseen) == 1:
+                    event = next(e for e in batch if e.get('id') in unseen)
+                    queue = [(event.get('id'),
+                              str(flask_sse.Message(**event)))]
+                elif unseen:
+                    unseen = set(unseen)
+                    queue = [encode_batch([e for e in batch
+                                           if e.get('id') in unseen])]
+                else:
+                    continue
+            else:
+
+                if events is None:
+                    events = [(e.get('id'), str(flask_sse.Message(**e)))
+                              for e in batch]
+
+                queue = events
+
+            for event in queue:
+                outcome = subscription.put(event, fresh)
+
+                if outcome == 'dropped':
+                    self.dropped += 1
+                    self.unsubscribe(subscription)
+                    break
+                elif outcome == 'coalesced':
+                    self.coalesced += 1
+
+    def stats(self):
+        """Return a dictionary describing this hub's clients
+        and how far behind they are.
+
+        """
+
+        with self._lock:
+            subscriptions = set()
+
+            for subscribers in self._subscriptions.values():
+                subscriptions.update(subscribers)
+
+            channels = len(self._subscriptions)
+
+        depths = [len(subscription) for subscription in subscriptions]
+        return {'connections': len(subscriptions),
+                'channels': channels,
+                'queue_depth': sum(depths),
+                'max_queue_depth': max(depths) if depths else 0,
+                'events': self.events,
+                'dropped': self.dropped,
+                'coalesced': self.coalesced,
+                'malformed': self.malformed}
+
+
+class Batcher(object):
+    """Gathers items published to each channel, handing
+    them to `send` together once `window` seconds have
+    passed since the first, or as soon as `size` have been
+    gathered.
+
+    The window is timed by a background thread (a greenlet,
+    under gevent); `send` is called from it, or from whoever
+    `add`s the item which fills a batch. Sends never overlap.
+
+    Arguments:
+        send (callable): Takes a channel and a list of items.
+
+    Attributes:
+        batches (int): Number of times `send` has been called.
+
+    """
+
+    def __init__(self, send):
+        self.send = send
+        self.batches = 0
+        self._pending = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._sending = threading.Lock()
+        self._timer = None
+
+    def __len__(self):
+        return sum(len(items) for items in self._pending.values())
+
+    def add(self, channel, item, window, size):
+        """Gather `item` into `channel`'s next batch.
+
+        Arguments:
+            channel (str): --
+            item (any): --
+            window (float): Seconds to wait for more items,
+                if no wait has started yet.
+            size (int): Most items in a batch.
+
+        """
+
+        with self._lock:
+            items = self._pending.setdefault(channel, [])
+            items.append(item)
+            full = len(items) >= size
+
+            if full:
+                del self._pending[channel]
+            elif self._timer is None:
+                self._timer = threading.Timer(window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+        if full:
+            self._send(channel, items)
+
+    def flush(self):
+        """Send everything gathered so far, now."""
+
+        with self._lock:
+            pending = self._pending
+            self._pending = collections.OrderedDict()
+
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+        for channel, items in pending.items():
+            self._send(channel, items)
+
+    def _send(self, channel, items):
+
+        with self._sending:
+            self.batches += 1
+            self.send(channel, items)
+
+
+class HubBlueprint(flask_sse.ServerSentEventsBlueprint):
+    """flask_sse's blueprint, streaming from a per-worker
+    `Hub` rather than a Redis subscription per client.
+
+    Published events are given increasing IDs, and the last
+    `STREAM_REPLAY_SIZE` of each channel are kept in Redis for
+    clients resuming with a Last-Event-ID. The Redis client
+    (and its connection pool) is made once rather than once
+    per event.
+
+    With a `STREAM_COALESCE_WINDOW`, events are gathered by
+    a `Batcher`, and published together by `publish_batch`.
+
+    Configured by the app's STREAM_* settings.
+
+    """
+
+    ID_KEY = 'msg:sse:id'
+    """str: Redis key counting published events."""
+
+    REPLAY_KEY = 'msg:sse:replay:%s'
+    """str: Redis key of a channel's sorted set of recent
+    events, scored by ID.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(HubBlueprint, self).__init__(*args, **kwargs)
+        self._redis = {}
+        self._scripts = {}
+        self._hub = None
+        self._hub_lock = threading.Lock()
+        self._batcher = None
+
+    @property
+    def redis(self):
+        """A `redis.StrictRedis` for the current app, made
+        once per Redis URL.
+
+        """
+
+        config = flask.current_app.config
+        redis_url = config.get("SSE_REDIS_URL") or config.get("REDIS_URL")
+
+        if not redis_url:
+            raise KeyError("Must set a redis connection URL in app config.")
+
+        if redis_url not in self._redis:
+            self._redis[redis_url] = redis.StrictRedis.from_url(redis_url)
+
+        return self._redis[redis_url]
+
+    @property
+    def hub(self):
+        """This worker's `Hub`, made on first use."""
+
+        with self._hub_lock:
+
+            if self._hub is None:
+                config = flask.current_app.config
+                self._hub = Hub(self.redis,
+                                queue_size=config['STREAM_QUEUE_SIZE'],
+                                slow_consumer=config['STREAM_SLOW_CONSUMER'])
+
+            return self._hub
+
+    @property
+    def batcher(self):
+        """This worker's `Batcher`, made on first use, which
+        publishes batches for the app using it first.
+
+        """
+
+        with self._hub_lock:
+
+            if self._batcher is None:
+                app = flask.current_app._get_current_object()
+
+                def send(channel, items):
+                    messages = [message for message, __ in items]
+                    channels = [channels for __, channels in items]
+
+                    with app.app_context():
+
+                        try:
+                            self.publish_batch(messages, channels=channels)
+                        except redis.RedisError:
+                            # as good as lost in a full replay
+                            # buffer: clients resync when they
+                            # reconnect
+                            pass
+
+                self._batcher = Batcher(send)
+
+            return self._batcher
+
+    def publish(self, data, type=None, id=None, retry=None, channel='sse'):
+        """Publish data as a server-sent event, as flask_sse
+        does, but given the next ID if it hasn't one, and kept
+        for `replay`.
+
+        With a `STREAM_COALESCE_WINDOW`, an event without an
+        ID is gathered into a batch instead, to be published
+        shortly. Batches are gathered by the first channel
+        (for messages, "sse", which has them all), so events
+        for different authors or topics go together, and each
+        of their other channels is sent just its share.
+
+        Arguments:
+            channel (str|list): A channel, or several channels
+                to publish the same event (with one ID) to.
+
+        Returns:
+            int|None: The event's ID; None if batched, and so
+                not known yet.
+
+        """
+
+        channels = as_channels(channel)
+        config = flask.current_app.config
+        window = config['STREAM_COALESCE_WINDOW']
+
+        if window and id is None:
+            message = flask_sse.Message(data, type=type, retry=retry)
+            self.batcher.add(channels[0], (message, channels), window,
+                             config['STREAM_COALESCE_SIZE'])
+            return None
+
+        if id is None:
+            message = flask_sse.Message(data, type=type, retry=retry)
+            return self._publish([message], [channels], batch=False)
+
+        message = flask_sse.Message(data, type=type, id=id, retry=retry)
+        message_json = flask.json.dumps(message.to_dict())
+        pipeline = self.redis.pipeline()
+        self._keep(pipeline, channels, {message_json: id})
+
+        for channel in channels:
+            pipeline.publish(channel=channel, message=message_json)
+
+        pipeline.execute()
+        return id
+
+    def publish_batch(self, messages, channel='sse', channels=None):
+        """Publish several events with a single Redis message
+        (per channel), giving each the next ID and keeping each
+        for `replay`.
+
+        Arguments:
+            messages (list): `flask_sse.Message`s without IDs.
+            channel (str|list): See `publish`.
+            channels (list|None): For each message, the channel
+                (or channels) to publish it to, instead of
+                `channel`; each channel's Redis message has only
+                the events for it.
+
+        Returns:
+            int: The last event's ID.
+
+        """
+
+        if channels is None:
+            channels = [channel] * len(messages)
+
+        return self._publish(messages, [as_channels(c) for c in channels],
+                             batch=True)
+
+    def _publish(self, messages, channels, batch):
+        """Number, keep and publish events with the `PUBLISH`
+        script.
+
+        Arguments:
+            messages (list): `flask_sse.Message`s without IDs;
+                given theirs.
+            channels (list): Each message's list of channels.
+            batch (bool): Whether to publish them as a batch.
+
+        Returns:
+            int: The last event's ID.
+
+        """
+
+        redis_client = self.redis
+        script = self._scripts.get(redis_client)
+
+        if script is None:
+            script = self._scripts[redis_client] = (
+                redis_client.register_script(PUBLISH)
+            )
+
+        # every channel any message is for, numbered from 1
+        numbers = collections.OrderedDict()
+        args = []
+
+        for message, message_channels in zip(messages, channels):
+            args.append(flask.json.dumps(message.to_dict()))
+            args.append(' '.join(
+                str(numbers.setdefault(c, len(numbers) + 1))
+                for c in message_channels
+            ))
+
+        keys = [self.ID_KEY] + [self.REPLAY_KEY % c for c in numbers]
+        args = ([flask.current_app.config['STREAM_REPLAY_SIZE'], int(batch)]
+                + list(numbers) + args)
+        last_id = script(keys=keys, args=args)
+
+        for id, message in enumerate(messages, last_id - len(messages) + 1):
+            message.id = id
+
+        return last_id
+
+    def _keep(self, pipeline, channels, events):
+        """Add `events` (event JSON to ID) to each of
+        `channels`' replay buffers, by way of `pipeline`.
+
+        """
+
+        replay_size = flask.current_app.config['STREAM_REPLAY_SIZE']
+
+        for channel in channels:
+            replay_key = self.REPLAY_KEY % channel
+            pipeline.zadd(replay_key, events)
+            pipeline.zremrangebyrank(replay_key, 0, -(replay_size + 1))
+
+    def replay(self, channel, last_event_id):
+        """Get the events on `channel` after `last_event_id`.
+
+        Arguments:
+            channel (str|list): A channel, or several, whose
+                events are merged.
+            last_event_id (int): --
+
+        Returns:
+            list|None: (event ID, encoded event) pairs, oldest
+                first. None if events may have been missed which
+                are no longer kept.
+
+        """
+
+        channels = as_channels(channel)
+        replay_size = flask.current_app.config['STREAM_REPLAY_SIZE']
+        pipeline = self.redis.pipeline()
+
+        for channel in channels:
+            replay_key = self.REPLAY_KEY % channel
+            pipeline.zcard(replay_key)
+            pipeline.zrange(replay_key, 0, 0, withscores=True)
+            pipeline.zrangebyscore(replay_key, '(%d' % last_event_id, '+inf')
+
+        results = pipeline.execute()
+        events = {}
+
+        for i in range(0, len(results), 3):
+            kept, oldest, missed = results[i:i + 3]
+
+            # IDs are shared by every channel, so there are gaps
+            # in any one channel's; but until the replay buffer
+            # is full, nothing's been thrown away.
+            if (kept >= replay_size and oldest
+                    and oldest[0][1] > last_event_id):
+                return None
+
+            for event in missed:
+                event = json.loads(event.decode('utf-8'))
+
+                # the same event may be kept for several channels
+                if event['id'] not in events:
+                    events[event['id']] = str(flask_sse.Message(**event))
+
+        return sorted(events.items())
+
+    def channels(self):
+        """Get the channels the current request asks for in
+        its "channel" query parameters, each of which may be a
+        comma-separated list; "sse" if none.
+
+        Aborts with a 400 if there are more than
+        `STREAM_MAX_CHANNELS`, or any the hub won't hear of.
+
+        Returns:
+            list: --
+
+        """
+
+        channels = set()
+
+        for value in flask.request.args.getlist('channel'):
+            channels.update(c for c in value.split(',') if c)
+
+        limit = flask.current_app.config['STREAM_MAX_CHANNELS']
+        error = None
+
+        if len(channels) > limit:
+            error = "Too many channels: at most %d allowed." % limit
+        else:
+            pattern = self.hub.pattern
+
+            for channel in channels:
+
+                if not fnmatch.fnmatchcase(channel, pattern):
+                    error = "Invalid channel: %s" % channel
+
+        if error is not None:
+            flask.abort(flask.make_response(
+                flask.jsonify(message=error), 400
+            ))
+
+        return sorted(channels) or ['sse']
+
+    def stream(self):
+        """Stream events from the `channels` asked for (by
+        default, "sse": everything), by way of the `hub`.
+
+        A client reconnecting with a Last-Event-ID header (or
+        "last_event_id" query parameter) is first sent the
+        events it missed, or a "resync" event if they're no
+        longer kept.
+
+        A client passing "batch=1" is sent events published
+        together as a single "batch" event, whose data is the
+        list of events (each with its "data," "type" and "id").
+
+        """
+
+        request = flask.request
+        channels = self.channels()
+        batch = request.args.get('batch') in ('1', 'true')
+        last_event_id = (request.headers.get('Last-Event-ID')
+                         or request.args.get('last_event_id'))
+        hub = self.hub
+        keepalive = flask.current_app.config['STREAM_KEEPALIVE']
+        # subscribe before looking back, so nothing falls
+        # between the two
+        subscription = hub.subscribe(channels, batch)
+        backlog = []
+
+        try:
+            if last_event_id is not None:
+                backlog = self.replay(channels, int(last_event_id))
+        except ValueError:
+            pass
+        except redis.RedisError:
+            backlog = None
+
+        if backlog is None:
+            backlog = [(None, RESYNC)]
+
+        def generator():
+            replayed = set(event_id for event_id, __ in backlog)
+
+            try:
+                for event_id, event in backlog:
+                    yield event
+
+                while not subscription.closed:
+                    event = subscription.get(keepalive)
+
+                    if event is None:
+                        yield KEEPALIVE
+                    elif event[0] is None or event[0] not in replayed:
+                        yield event[1]
+            finally:
+                hub.unsubscribe(subscription)
+
+        return flask.current_app.response_class(
+            generator(),
+            mimetype='text/event-stream',
+        )
+
+    def stats(self):
+        """A view describing this worker's stream clients."""
+
+        return flask.jsonify(self.hub.stats())
+
+
+sse = HubBlueprint('sse', __name__)
+"""HubBlueprint: Mount at /stream."""
+sse.add_url_rule(rule="", endpoint="stream", view_func=sse.stream)
+sse.add_url_rule(rule="/stats", endpoint="stats", view_func=sse.stats)
@@ -0,0 +1,262 @@
+"""msg JSON validation: compile each JSON schema once,
+then validate requests against the compiled validators.
+
+"""
+
+import os
+import json
+
+import jsonschema
+import jsonschema.exceptions
+import jsonschema.validators
+
+
+try:
+    STRING_TYPES = (str, unicode)
+    INTEGER_TYPES = (int, long)
+except NameError:  # Python 3
+    STRING_TYPES = (str,)
+    INTEGER_TYPES = (int,)
+
+
+def is_string(value):
+    return isinstance(value, STRING_TYPES)
+
+
+def is_integer(value):
+    return isinstance(value, INTEGER_TYPES) and not isinstance(value, bool)
+
+
+def is_number(value):
+    return is_integer(value) or isinstance(value, float)
+
+
+def is_boolean(value):
+    return isinstance(value, bool)
+
+
+def is_null(value):
+    return value is None
+
+
+SIMPLE_TYPES = {
+                "string": is_string,
+                "integer": is_integer,
+                "number": is_number,
+                "boolean": is_boolean,
+                "null": is_null,
+               }
+"""dict: JSON schema type name to a predicate which is True
+only if a value is certainly of that type.
+"""
+
+
+def fast_path(schema):
+    """Generate a quick check for a flat object schema, the
+    kind msg uses for every resource: "type": "object," some
+    "properties" of simple types and maybe "required."
+
+    The check only ever says "definitely valid" (True) or
+    "not sure" (False); when not sure, use the real validator,
+    which also produces the usual error messages.
+
+    Arguments:
+        schema (dict): --
+
+    Returns:
+        callable|None: Takes an instance, returns a bool. None
+            if the schema is too fancy for a fast path.
+
+    """
+
+    if set(schema) - {"type", "properties", "required", "$schema"}:
+        return None
+
+    if schema.get("type") != "object":
+        return None
+
+    required = tuple(schema.get("required", ()))
+    checks = []
+
+    for name, property_schema in schema.get("properties", {}).items():
+
+        if set(property_schema) != {"type"}:
+            return None
+
+        types = property_schema["type"]
+
+        if is_string(types):
+            types = [types]
+
+        if not all(t in SIMPLE_TYPES for t in types):
+            return None
+
+        checks.append((name, tuple(SIMPLE_TYPES[t] for t in types)))
+
+    def check(instance):
+
+        if not isinstance(instance, dict):
+            return False
+
+        for name in required:
+
+            if name not in instance:
+                return False
+
+        for name, predicates in checks:
+
+            if name in instance:
+                value = instance[name]
+
+                if not any(predicate(value) for predicate in predicates):
+                    return False
+
+        return True
+
+    return check
+
+
+class CompiledSchema(object):
+    """A JSON schema which has been checked against its
+    meta-schema, with its validator built, once.
+
+    Arguments:
+        schema (dict): --
+
+    Raises:
+        jsonschema.SchemaError: If `schema` is not a valid schema.
+
+    """
+
+    def __init__(self, schema):
+        validator_class = jsonschema.validators.validator_for(schema)
+        validator_class.check_schema(schema)
+        self.schema = schema
+        self.validator = validator_class(schema)
+        self.fast_path = fast_path(schema)
+
+    def validate(self, instance):
+        """Just like `jsonschema.validate`, but without the
+        per-call meta-schema check and validator construction.
+
+        Raises:
+            jsonschema.ValidationError: --
+
+        """
+
+        if self.fast_path is not None and self.fast_path(instance):
+            return
+
+        error = jsonschema.exceptions.best_match(
+            self.validator.iter_errors(instance)
+        )
+
+        if error is not None:
+            raise error
+
+
+class SchemaRegistry(object):
+    """Compiled JSON schemas, looked up either by name or
+    by the schema (dictionary) itself.
+
+    """
+
+    def __init__(self):
+        self._by_name = {}
+        self._by_id = {}
+
+    def __contains__(self, name):
+        return name in self._by_name
+
+    def register(self, name, schema):
+        """Compile `schema` and file it under `name`.
+
+        Arguments:
+            name (str|None): --
+            schema (dict): --
+
+        Returns:
+            CompiledSchema: --
+
+        """
+
+        compiled = CompiledSchema(schema)
+        self._by_id[id(schema)] = compiled
+
+        if name is not None:
+            self._by_name[name] = compiled
+
+        return compiled
+
+    def load_directory(self, path):
+        """Register every "*.json" schema in the directory
+        at `path`, named after the file sans extension.
+
+        Nothing happens if there's no such directory.
+
+        Arguments:
+            path (str): --
+
+        Returns:
+            list: Names of the schemas loaded.
+
+        """
+
+        if not os.path.isdir(path):
+            return []
+
+        loaded = []
+
+        for file_name in sorted(os.listdir(path)):
+            name, extension = os.path.splitext(file_name)
+
+            if extension != ".json":
+                continue
+
+            with open(os.path.join(path, file_name)) as f:
+                self.register(name, json.load(f))
+
+            loaded.append(name)
+
+        return loaded
+
+    def get(self, schema):
+        """Get the compiled version of `schema`.
+
+        Arguments:
+            schema (str|dict): A registered name, or a schema,
+                which is compiled and remembered if unseen.
+
+        Raises:
+            KeyError: No schema registered under that name.
+
+        Returns:
+            CompiledSchema: --
+
+        """
+
+        if is_string(schema):
+            return self._by_name[schema]
+
+        compiled = self._by_id.get(id(schema))
+
+        # id() can be reused once a schema is garbage collected,
+        # so make sure it really is the same schema.
+        if compiled is None or compiled.schema is not schema:
+            compiled = self.register(None, schema)
+
+        return compiled
+
+    def validate(self, instance, schema):
+        """Validate `instance` against `schema`.
+
+        Arguments:
+            instance (any): --
+            schema (str|dict): See `get`.
+
+        Raises:
+            jsonschema.ValidationError: --
+
+        """
+
+        self.get(schema).validate(instance)
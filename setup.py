@@ -17,7 +17,7 @@ setup(name='msg',
       setup_requires=['setuptools-markdown',],
       install_requires=['flask', 'flask_sqlalchemy',
                         'flask_sqlalchemy', 'flask_limiter', 'flask-restful',
-                        'flask-httpauth', 'requests', 'flask_sse',
+                        'flask-httpauth', 'requests', 'flask_sse', 'redis',
                         'gunicorn', 'jsonschema', 'gevent'],
       long_description_markdown_filename='README.md',
       author='Lily Seabreeze',
@@ -0,0 +1,855 @@
+"""Micro-benchmarks for msg's per-request hot paths.
+
+Run from the root of this repository:
+
+    python -m tests.benchmark
+
+Or just some suites, at some table sizes, saving the results
+as JSON and flagging those more than 20% worse than a
+previous run's:
+
+    python -m tests.benchmark --suites hot-paths --rows 1000,100000 \\
+        --json new.json --compare old.json --threshold 0.2
+
+Each result is the median of --repeat runs (3, by default).
+Timings vary from run to run, so a result is only flagged if
+it's also worse by more than how far apart its runs were, in
+either comparison.
+
+"""
+
+import io
+import os
+import sys
+import json
+import argparse
+import platform
+import collections
+import time
+import random
+import shutil
+import timeit
+import tempfile
+import threading
+import multiprocessing
+
+import flask
+import flask_limiter
+import jsonschema
+import sqlalchemy
+
+from msg import __version__
+from msg import msg
+from msg import models
+from msg import stream
+from msg import export
+from msg import importer
+from msg import sqlite
+from msg import ratelimit
+
+
+def bench(statement, number=10000):
+    """Return the best per-call time of `statement`, in
+    microseconds, over a few rounds of `number` calls.
+
+    """
+
+    rounds = timeit.repeat(statement, number=number, repeat=5)
+    return min(rounds) / number * 1e6
+
+
+def bench_schema_validation():
+    """Per-request JSON validation cost, before (plain
+    `jsonschema.validate`) and after (`msg.schemas`).
+
+    """
+
+    cases = [
+             ('User.SCHEMA_POST', msg.User.SCHEMA_POST,
+              {"username": "kitten", "password": "yarn"}),
+             ('Messages.SCHEMA_GET', msg.Messages.SCHEMA_GET,
+              {"offset": 0, "limit": 20}),
+             ('Message.SCHEMA', msg.Message.SCHEMA,
+              {"text": "i love kittens"}),
+            ]
+    results = []
+
+    for name, schema, instance in cases:
+        compiled = msg.schemas.get(schema)
+        before = bench(lambda: jsonschema.validate(instance, schema))
+        after = bench(lambda: compiled.validate(instance))
+        results.append((name, before, after))
+
+    return results
+
+
+def seed(users, messages_per_user):
+    """Fill a fresh database with `users` users, each with
+    `messages_per_user` messages, interleaved.
+
+    """
+
+    msg.init_db()
+
+    with msg.app.app_context():
+        engine = msg.db.engine
+        user_rows = [{'username': 'user%d' % i,
+                      'password_hash': 'x'} for i in range(users)]
+        engine.execute(models.User.__table__.insert(), user_rows)
+        message_rows = [{'user_id': user_id, 'text': 'message %d' % i}
+                        for i in range(messages_per_user)
+                        for user_id in range(1, users + 1)]
+        engine.execute(models.Message.__table__.insert(), message_rows)
+
+
+def bench_author_loading(users=5, messages_per_user=100, limit=20):
+    """Time a page of `Messages.get`, and count its queries,
+    for each way of loading message authors.
+
+    """
+
+    seed(users, messages_per_user)
+    msg.limiter.enabled = False
+    client = msg.app.test_client()
+    data = json.dumps({'offset': 0, 'limit': limit})
+
+    with msg.app.app_context():
+        engine = msg.db.engine
+
+    statements = []
+
+    def count(*args):
+        statements.append(1)
+
+    original_loading = msg.config.MESSAGES_AUTHOR_LOADING
+    msg.config.MESSAGES_COLUMNAR = False
+    results = []
+    sqlalchemy.event.listen(engine, 'before_cursor_execute', count)
+
+    try:
+        for loading in ('subquery', 'joined', 'selectin', 'none'):
+            msg.config.MESSAGES_AUTHOR_LOADING = loading
+            msg.read_cache.clear()
+            del statements[:]
+            client.get('/messages', data=data,
+                       content_type='application/json')
+            queries = len(statements)
+            per_call = bench(lambda: client.get('/messages', data=data,
+                             content_type='application/json'),
+                             number=200)
+            results.append((loading, queries, per_call))
+    finally:
+        msg.config.MESSAGES_AUTHOR_LOADING = original_loading
+        msg.config.MESSAGES_COLUMNAR = True
+        sqlalchemy.event.remove(engine, 'before_cursor_execute', count)
+        msg.limiter.enabled = True
+
+    return results
+
+
+def bench_columnar(users=10, messages_per_user=1000):
+    """Time describing and encoding every message in a
+    table of `users` * `messages_per_user` rows, by way of
+    the ORM and straight from columns, with each available
+    JSON encoder.
+
+    """
+
+    seed(users, messages_per_user)
+    encoders = [('json', lambda data: json.dumps(data))]
+
+    for name in ('ujson', 'orjson'):
+
+        try:
+            module = __import__(name)
+        except ImportError:
+            continue
+
+        encoders.append((name, module.dumps))
+
+    def orm():
+        messages = (msg.with_authors(msg.db.session.query(models.Message),
+                                     'none').all())
+        return msg.messages_to_dicts(messages, 'none')
+
+    def columnar():
+        rows = msg.db.session.query(*msg.MESSAGE_COLUMNS).all()
+        return msg.rows_to_dicts(rows)
+
+    results = []
+
+    with msg.app.app_context():
+
+        for name, build in (('orm', orm), ('columnar', columnar)):
+            data = build()
+
+            for encoder_name, dumps in encoders:
+                per_call = bench(lambda: dumps(build()), number=3)
+                results.append(("%s + %s" % (name, encoder_name),
+                                len(data), per_call))
+
+    return results
+
+
+def bench_coalescing(events=500, size=50):
+    """Publish a burst of `events` messages one at a time,
+    then gathered into batches of `size`, timing both the
+    publishing (throughput, in events per second) and one
+    client's share of fanning them out (total ms).
+
+    Needs Redis, just like the tests.
+
+    """
+
+    message = {'id': 1, 'text': 'i love kittens',
+               'created': 'Sat, 01 Jan 2000 00:00:00 GMT',
+               'user': {'id': 1, 'username': 'kitten', 'bio': None,
+                        'created': 'Sat, 01 Jan 2000 00:00:00 GMT'}}
+    config = msg.app.config
+    results = []
+
+    for mode, window in (('per message', 0), ('coalesced', 60)):
+        config['STREAM_COALESCE_WINDOW'] = window
+        config['STREAM_COALESCE_SIZE'] = size
+
+        try:
+            with msg.app.app_context():
+                start = time.time()
+
+                for __ in range(events):
+                    msg.sse.publish(message, type='message')
+
+                if window:
+                    msg.sse.batcher.flush()
+
+                published = events / (time.time() - start)
+        finally:
+            config.update(STREAM_COALESCE_WINDOW=(msg.config.
+                                                  STREAM_COALESCE_WINDOW),
+                          STREAM_COALESCE_SIZE=msg.config.STREAM_COALESCE_SIZE)
+
+        # what the hub then does for each client
+        if window:
+            payloads = [json.dumps({'batch': [dict(data=message, id=i,
+                                                   type='message')
+                                              for i in range(size)]})
+                        for __ in range(events // size)]
+        else:
+            payloads = [json.dumps(dict(data=message, id=i, type='message'))
+                        for i in range(events)]
+
+        def fan_out():
+            hub = stream.Hub(None, queue_size=events)
+            subscription = hub.subscribe(['sse'], batch=bool(window))
+
+            for payload in payloads:
+                hub.dispatch('sse', payload)
+
+            writes = 0
+
+            while subscription.get(0) is not None:
+                writes += 1
+
+            return writes
+
+        writes = fan_out()
+        per_call = bench(fan_out, number=10)
+        results.append((mode, published, writes, per_call))
+
+    return results
+
+
+def bench_rate_limiting(limits=("1000000 per hour", "100000 per minute")):
+    """Time a request to a tiny app behind flask_limiter,
+    with each storage, and count how often it goes to Redis.
+
+    Needs Redis, just like the tests.
+
+    """
+
+    storages = [('memory', 'memory://', {}),
+                ('redis', 'redis://localhost:6379', {}),
+                ('tiered+redis', 'tiered+redis://localhost:6379',
+                 {'error': 0.1, 'sync_interval': 1})]
+    results = []
+
+    for name, uri, options in storages:
+        app = flask.Flask(name)
+        limiter = flask_limiter.Limiter(app, storage_uri=uri,
+                                        storage_options=options,
+                                        key_func=lambda: 'bench',
+                                        global_limits=list(limits))
+        limiter.reset()
+        app.add_url_rule('/', 'index', lambda: 'kitten')
+        client = app.test_client()
+        per_call = bench(lambda: client.get('/'), number=500)
+        storage = limiter._storage
+
+        # bench() makes 5 rounds of 500 requests
+        if isinstance(storage, ratelimit.TwoTierStorage):
+            syncs = storage.syncs / 2500.0
+        elif name == 'redis':
+            syncs = len(limits)
+        else:
+            syncs = 0
+
+        results.append((name, syncs, per_call))
+
+    return results
+
+
+def bench_export(users=1000, messages_per_user=1000):
+    """Stream `users` users and `users` * `messages_per_user`
+    messages out as NDJSON, plain and gzipped, measuring the
+    throughput of what's sent.
+
+    """
+
+    seed(users, messages_per_user)
+    results = []
+
+    with msg.app.app_context():
+
+        for name, compress in (('ndjson', False), ('ndjson + gzip', True)):
+            meter = export.Meter()
+            chunks = export.ndjson(msg.db.session)
+
+            if compress:
+                chunks = export.gzipped(meter(chunks))
+                sent = sum(len(chunk) for chunk in chunks)
+            else:
+                sent = sum(len(chunk) for chunk in meter(chunks))
+
+            stats = meter.stats()
+            results.append((name, stats['rows'], stats['rows_per_second'],
+                            sent / 1e6 / stats['seconds']))
+
+    return results
+
+
+def bench_import(users=100, messages_per_user=1000, passwords=40):
+    """Import users (already hashed) and their messages from
+    NDJSON with a commit per row, as the API does (less its
+    other work), then in bulk; then time hashing `passwords`
+    passwords, in this process and in a pool.
+
+    """
+
+    lines = [json.dumps({'type': 'user', 'username': 'user%d' % i,
+                         'password_hash': 'x'}) for i in range(users)]
+    lines.extend(json.dumps({'type': 'message', 'user_id': user_id,
+                             'text': 'message %d' % i})
+                 for i in range(messages_per_user)
+                 for user_id in range(1, users + 1))
+    text = u'\n'.join(lines)
+    results = []
+
+    with msg.app.app_context():
+        msg.init_db()
+        session = msg.db.session
+        started = time.time()
+
+        # a commit per row is slow, so only for five seconds
+        for record in importer.read_ndjson(io.StringIO(text)):
+            model, mapping = importer.to_mapping(record)
+            session.execute(model.__table__.insert(), mapping)
+            session.commit()
+
+            if time.time() - started > 5:
+                break
+
+        rows = session.query(models.Message).count() + users
+        results.append(('row by row', rows, rows / (time.time() - started)))
+
+        msg.init_db()
+        loader = importer.Importer(session, 'bench', 1000)
+        loader.run(importer.read_ndjson(io.StringIO(text)))
+        stats = loader.stats()
+        results.append(('bulk', stats['rows'], stats['rows_per_second']))
+
+    hashes = ['yarn%d' % i for i in range(passwords)]
+    started = time.time()
+    list(map(importer.hash_password, hashes))
+    results.append(('hashing', passwords,
+                    passwords / (time.time() - started)))
+    pool = multiprocessing.Pool()
+    started = time.time()
+    pool.map(importer.hash_password, hashes)
+    results.append(('hashing, %d processes' % multiprocessing.cpu_count(),
+                    passwords, passwords / (time.time() - started)))
+    pool.close()
+    pool.join()
+    return results
+
+
+def bench_hot_paths(rows, limit=20):
+    """Time what runs on every request against a table of
+    `rows` messages (by a hundred per user): describing
+    messages and users, validating JSON, checking passwords,
+    and getting messages through the test client.
+
+    Returns:
+        list: (name, microseconds) pairs.
+
+    """
+
+    seed(max(1, rows // 100), min(rows, 100))
+    msg.limiter.enabled = False
+    msg.read_cache.clear()
+    client = msg.app.test_client()
+    results = []
+    middle = rows // 2 or 1
+
+    with msg.app.app_context():
+        session = msg.db.session
+        session.add(models.User('kitten', None,
+                                password_hash=msg.hasher.hash('yarn')))
+        session.commit()
+        message = session.query(models.Message).get(middle)
+        user = message.user
+        results.append(('Message.to_dict', bench(message.to_dict)))
+        results.append(('User.to_dict', bench(user.to_dict)))
+
+    with msg.app.test_request_context('/message', method='POST',
+                                      data=json.dumps({'text': 'kitten'}),
+                                      content_type='application/json'):
+        results.append(('get_valid_json', bench(
+            lambda: msg.get_valid_json(msg.Message.SCHEMA)
+        )))
+        msg.get_password('kitten', 'yarn')
+        results.append(('get_password (cached)', bench(
+            lambda: msg.get_password('kitten', 'yarn')
+        )))
+
+        def uncached():
+            msg.credential_cache.clear()
+            msg.get_password('kitten', 'yarn')
+
+        results.append(('get_password (hashing)', bench(uncached, number=5)))
+
+    pages = [('GET /messages', {'offset': 0, 'limit': limit}),
+             ('GET /messages (deep offset)', {'offset': rows - limit,
+                                              'limit': limit}),
+             ('GET /messages (deep cursor)', {'before_id': middle,
+                                              'limit': limit})]
+
+    for name, data in pages:
+        data = json.dumps(data)
+        results.append((name, bench(
+            lambda: client.get('/messages', data=data,
+                               content_type='application/json'),
+            number=100,
+        )))
+
+    url = '/message/%d' % middle
+    client.get(url)
+    results.append(('GET /message/<id> (cached)', bench(
+        lambda: client.get(url), number=200
+    )))
+
+    def uncached_message():
+        msg.read_cache.delete('message:%d' % middle)
+        client.get(url)
+
+    results.append(('GET /message/<id> (uncached)', bench(uncached_message,
+                                                          number=200)))
+    msg.limiter.enabled = True
+    return results
+
+
+def bench_metrics(users=10, messages_per_user=100):
+    """Time getting a message (cached, then not) and
+    rendering /metrics, with metrics off and on.
+
+    Returns:
+        list: (name, microseconds off, microseconds on); off is
+            None for /metrics itself.
+
+    """
+
+    seed(users, messages_per_user)
+    msg.limiter.enabled = False
+    client = msg.app.test_client()
+    url = '/message/%d' % (users * messages_per_user // 2)
+    enabled = msg.config.METRICS_ENABLED
+    results = []
+
+    def uncached():
+        msg.read_cache.clear()
+        client.get(url)
+
+    for name, function in (('GET /message/<id> (cached)',
+                            lambda: client.get(url)),
+                           ('GET /message/<id> (uncached)', uncached)):
+        times = []
+
+        for on in (False, True):
+            msg.config.METRICS_ENABLED = on
+            client.get(url)
+            times.append(bench(function, number=200))
+
+        results.append((name,) + tuple(times))
+
+    msg.config.METRICS_ENABLED = enabled
+    msg.limiter.enabled = True
+    results.append(('GET /metrics', None,
+                    bench(lambda: client.get('/metrics'), number=200)))
+    return results
+
+
+def bench_sqlite(messages=100000, readers=(1, 4, 16), seconds=2.0):
+    """Read messages by ID from a SQLite file, in threads,
+    while another thread posts messages, first as
+    flask_sqlalchemy would by default (a connection per
+    checkout, rollback journal), then tuned per `sqlite`.
+
+    Returns:
+        list: (mode, readers, reads/s, writes/s, errors).
+
+    """
+
+    directory = tempfile.mkdtemp()
+    url = 'sqlite:///' + os.path.join(directory, 'bench.db')
+    engine = sqlalchemy.create_engine(url)
+    models.Base.metadata.create_all(engine)
+    engine.execute(models.User.__table__.insert(),
+                   [{'username': 'kitten', 'password_hash': 'x'}])
+    engine.execute(models.Message.__table__.insert(),
+                   [{'user_id': 1, 'text': 'message %d' % i}
+                    for i in range(messages)])
+    engine.dispose()
+    select = sqlalchemy.text("SELECT id, text, created, user_id "
+                             "FROM posts WHERE id = :id")
+    insert = models.Message.__table__.insert()
+    results = []
+
+    def run(engine, threads):
+        deadline = time.time() + seconds
+        counts = collections.Counter()
+
+        def reader(i):
+            rng = random.Random(i)
+
+            while time.time() < deadline:
+
+                with engine.connect() as connection:
+                    connection.execute(
+                        select, id=rng.randint(1, messages)
+                    ).fetchall()
+
+                counts['reads'] += 1
+
+        def writer():
+
+            while time.time() < deadline:
+
+                try:
+
+                    with engine.begin() as connection:
+                        connection.execute(insert, user_id=1, text='new')
+
+                    counts['writes'] += 1
+                except sqlalchemy.exc.OperationalError:
+                    counts['errors'] += 1
+
+        workers = [threading.Thread(target=reader, args=(i,))
+                   for i in range(threads)]
+        workers.append(threading.Thread(target=writer))
+
+        for worker in workers:
+            worker.start()
+
+        for worker in workers:
+            worker.join()
+
+        return (counts['reads'] / seconds, counts['writes'] / seconds,
+                counts['errors'])
+
+    try:
+
+        # default first, as WAL mode stays with the file
+        for mode in ('default', 'tuned'):
+
+            if mode == 'default':
+                engine = sqlalchemy.create_engine(
+                    url, poolclass=sqlalchemy.pool.NullPool
+                )
+            else:
+                options = {}
+                sqlite.engine_options(options, max(readers) + 1)
+                engine = sqlalchemy.create_engine(url, **options)
+                sqlite.tune(engine, msg.config.SQLITE_PRAGMAS)
+
+            for threads in readers:
+                results.append((mode, threads) + run(engine, threads))
+
+            engine.dispose()
+    finally:
+        shutil.rmtree(directory)
+
+    return results
+
+
+HIGHER_IS_BETTER = ('x', 'events/s', 'rows/s', 'MB/s', 'reads/s')
+"""tuple: Units of results which are better when higher;
+the rest (times, queries, writes) are better when lower.
+"""
+
+SUITES = ('schema', 'author-loading', 'columnar', 'coalescing',
+          'rate-limiting', 'export', 'import', 'hot-paths', 'metrics',
+          'sqlite')
+
+
+def compare(baseline, results, threshold):
+    """Find the results which are more than `threshold`
+    (a fraction) worse than in `baseline`, and more than
+    either run's spread, i.e., than what's just noise.
+
+    Arguments:
+        baseline (dict): As saved by `main`.
+        results (dict): --
+        threshold (float): --
+
+    Returns:
+        list: (name, before, after, change) tuples, where
+            change is the fraction worse.
+
+    """
+
+    regressions = []
+
+    for name, result in results.items():
+        before = baseline['results'].get(name)
+
+        if before is None or before['unit'] != result['unit']:
+            continue
+
+        noise = max(threshold, before.get('spread', 0.0),
+                    result.get('spread', 0.0))
+        before, after = before['value'], result['value']
+
+        if result['unit'] in HIGHER_IS_BETTER:
+            change = (before - after) / before if before else 0.0
+        else:
+            change = (after - before) / before if before else 0.0
+
+        if change > noise:
+            regressions.append((name, before, after, change))
+
+    return regressions
+
+
+def run(args):
+    """Run and print the suites `args` ask for, once.
+
+    Returns:
+        collections.OrderedDict: Name to {"value", "unit"}.
+
+    """
+
+    suites = args.suites.split(',')
+    results = collections.OrderedDict()
+
+    def record(name, value, unit):
+        results[name] = {'value': value, 'unit': unit}
+
+    if 'schema' in suites:
+        print("%-22s %12s %12s %8s" % ("schema", "before (us)",
+                                       "after (us)", "speedup"))
+
+        for name, before, after in bench_schema_validation():
+            print("%-22s %12.2f %12.2f %7.1fx"
+                  % (name, before, after, before / after))
+            record("schema: %s" % name, after, 'us')
+            record("schema: %s speedup" % name, before / after, 'x')
+
+        print("")
+
+    if 'author-loading' in suites:
+        print("%-22s %12s %12s" % ("author loading", "queries",
+                                   "page (us)"))
+
+        for loading, queries, per_call in bench_author_loading():
+            print("%-22s %12d %12.2f" % (loading, queries, per_call))
+            record("author loading: %s" % loading, per_call, 'us')
+            record("author loading: %s queries" % loading, queries,
+                   'queries')
+
+        print("")
+
+    if 'columnar' in suites:
+        print("%-22s %12s %12s" % ("message list", "rows", "total (ms)"))
+
+        for name, rows, per_call in bench_columnar():
+            print("%-22s %12d %12.2f" % (name, rows, per_call / 1000))
+            record("message list: %s" % name, per_call / 1000, 'ms')
+
+        print("")
+
+    if 'coalescing' in suites:
+        print("%-22s %12s %12s %12s" % ("stream burst", "events/s",
+                                        "writes", "client (ms)"))
+
+        for mode, published, writes, per_call in bench_coalescing():
+            print("%-22s %12d %12d %12.2f"
+                  % (mode, published, writes, per_call / 1000))
+            record("stream burst: %s" % mode, published, 'events/s')
+            record("stream burst: %s writes" % mode, writes, 'writes')
+
+        print("")
+
+    if 'rate-limiting' in suites:
+        print("%-22s %12s %12s" % ("rate limit storage", "syncs/req",
+                                   "request (us)"))
+
+        for name, syncs, per_call in bench_rate_limiting():
+            print("%-22s %12.3f %12.2f" % (name, syncs, per_call))
+            record("rate limit storage: %s" % name, per_call, 'us')
+
+        print("")
+
+    if 'export' in suites:
+        print("%-22s %12s %12s %12s" % ("export", "rows", "rows/s",
+                                        "sent MB/s"))
+
+        for name, rows, rows_per_second, sent in bench_export():
+            print("%-22s %12d %12d %12.2f"
+                  % (name, rows, rows_per_second, sent))
+            record("export: %s" % name, rows_per_second, 'rows/s')
+
+        print("")
+
+    if 'import' in suites:
+        print("%-22s %12s %12s" % ("import", "rows", "rows/s"))
+
+        for name, rows, rows_per_second in bench_import():
+            print("%-22s %12d %12d" % (name, rows, rows_per_second))
+            record("import: %s" % name, rows_per_second, 'rows/s')
+
+        print("")
+
+    if 'hot-paths' in suites:
+
+        for rows in [int(rows) for rows in args.rows.split(',')]:
+            print("%-30s %12s" % ("hot paths, %d rows" % rows, "call (us)"))
+
+            for name, per_call in bench_hot_paths(rows):
+                print("%-30s %12.2f" % (name, per_call))
+                record("%s [%d rows]" % (name, rows), per_call, 'us')
+
+            print("")
+
+    if 'metrics' in suites:
+        print("%-30s %12s %12s" % ("metrics", "off (us)", "on (us)"))
+
+        for name, off, on in bench_metrics():
+            off = '-' if off is None else '%.2f' % off
+            print("%-30s %12s %12.2f" % (name, off, on))
+            record("metrics: %s" % name, on, 'us')
+
+        print("")
+
+    if 'sqlite' in suites:
+        print("%-22s %12s %12s %12s" % ("sqlite file", "reads/s",
+                                        "writes/s", "locked"))
+
+        for mode, threads, reads, writes, errors in bench_sqlite():
+            name = "%s, %d readers" % (mode, threads)
+            print("%-22s %12d %12d %12d" % (name, reads, writes, errors))
+            record("sqlite: %s" % name, reads, 'reads/s')
+
+        print("")
+
+    return results
+
+
+def summarize(runs):
+    """Combine the results of repeated `run`s: the median of
+    each, and its spread, i.e., how far apart the best and
+    worst were, as a fraction of the median.
+
+    Arguments:
+        runs (list): Of `run` results.
+
+    Returns:
+        collections.OrderedDict: Name to {"value", "unit",
+            "spread"}.
+
+    """
+
+    results = collections.OrderedDict()
+
+    for name, result in runs[0].items():
+        values = sorted(r[name]['value'] for r in runs if name in r)
+        middle = len(values) // 2
+
+        if len(values) % 2:
+            median = values[middle]
+        else:
+            median = (values[middle - 1] + values[middle]) / 2.0
+
+        spread = (values[-1] - values[0]) / median if median else 0.0
+        results[name] = {'value': median, 'unit': result['unit'],
+                         'spread': spread}
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--suites', default=','.join(SUITES),
+                        help="Comma separated, of: %s." % ', '.join(SUITES))
+    parser.add_argument('--rows', default='1000,100000,1000000',
+                        help="Comma separated table sizes, for hot-paths.")
+    parser.add_argument('--json', help="Save results to this file.")
+    parser.add_argument('--compare', help="Results saved by an earlier run, "
+                                          "to flag regressions against.")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="Runs to take the median of.")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="Flag results worse than this fraction, "
+                             "or than their spread, if more.")
+    args = parser.parse_args(argv)
+    runs = []
+
+    for repeat in range(args.repeat):
+        stdout = sys.stdout
+
+        # the tables are printed from the first run only
+        if repeat:
+            sys.stdout = open(os.devnull, 'w')
+
+        try:
+            runs.append(run(args))
+        finally:
+
+            if repeat:
+                sys.stdout.close()
+                sys.stdout = stdout
+
+    results = summarize(runs)
+
+    if args.json:
+
+        with open(args.json, 'w') as f:
+            json.dump({'version': __version__,
+                       'python': platform.python_version(),
+                       'results': results}, f, indent=2)
+
+    if args.compare:
+
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+        regressions = compare(baseline, results, args.threshold)
+
+        for name, before, after, change in regressions:
+            print("REGRESSION %s: %.2f -> %.2f (%+.0f%%)"
+                  % (name, before, after, change * 100))
+
+        if regressions:
+            return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,214 @@
+"""Test the msg caches.
+
+"""
+
+import fnmatch
+import unittest
+
+import redis
+
+from ..msg import cache
+
+
+class FakeClock(object):
+    """Stand in for time.time, so we can skip ahead."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTTLCache(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = cache.TTLCache(2, 10, timer=self.clock)
+
+    def test_hit_and_miss(self):
+        self.cache.set('a', 1)
+        assert self.cache.get('a') == 1
+        assert self.cache.get('b') is None
+        assert self.cache.stats() == {'hits': 1, 'misses': 1,
+                                      'size': 1, 'maxsize': 2}
+
+    def test_expiry(self):
+        self.cache.set('a', 1)
+        self.clock.now = 9.9
+        assert self.cache.get('a') == 1
+        self.clock.now = 10
+        assert self.cache.get('a') is None
+        assert 'a' not in self.cache
+
+    def test_evicts_least_recently_used(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+        assert 'a' in self.cache
+        assert 'b' not in self.cache
+        assert 'c' in self.cache
+
+    def test_prune(self):
+        self.cache.set(('kitten', 'x'), 1)
+        self.cache.set(('puppy', 'y'), 2)
+        self.cache.prune(lambda key: key[0] == 'kitten')
+        assert len(self.cache) == 1
+        assert ('puppy', 'y') in self.cache
+
+
+class DictRedis(object):
+    """Just enough of redis.StrictRedis for TieredCache,
+    kept in a dictionary.
+
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.down = False
+
+    def check(self):
+
+        if self.down:
+            raise redis.ConnectionError("redis is down")
+
+    def get(self, key):
+        self.check()
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.check()
+        self.data[key] = value.encode('utf-8')
+
+    def incr(self, key):
+        self.check()
+        value = int(self.data.get(key) or 0) + 1
+        self.data[key] = str(value).encode('utf-8')
+        return value
+
+    def delete(self, *keys):
+        self.check()
+
+        for key in keys:
+            self.data.pop(key, None)
+
+    def scan_iter(self, match):
+        self.check()
+        return [k for k in self.data if fnmatch.fnmatch(k, match)]
+
+
+class TestTieredCache(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = DictRedis()
+        self.cache = cache.TieredCache(cache.TTLCache(10, 10), self.redis)
+        # another worker, sharing the same redis
+        self.other = cache.TieredCache(cache.TTLCache(10, 10), self.redis)
+
+    def test_shared_through_redis(self):
+        self.cache.set('user:1', {'username': 'kitten'})
+        assert self.other.get('user:1') == {'username': 'kitten'}
+        assert self.other.get('user:1') == {'username': 'kitten'}
+        stats = self.other.stats()
+        assert stats['redis_hits'] == 1
+        assert stats['local']['hits'] == 1
+        assert stats['hit_rate'] == 1.0
+
+    def test_read_through(self):
+        loads = []
+
+        def load():
+            loads.append(1)
+            return {'id': 1}
+
+        assert self.cache.read_through('message:1', load) == {'id': 1}
+        assert self.cache.read_through('message:1', load) == {'id': 1}
+        assert len(loads) == 1
+        assert self.cache.read_through('message:2', lambda: None) is None
+        assert self.cache.get('message:2') is None
+
+    def test_delete_and_clear(self):
+        self.cache.set('user:1', 1)
+        self.cache.set('user:2', 2)
+        self.redis.data['unrelated'] = b'3'
+        self.cache.delete('user:1')
+        assert self.other.get('user:1') is None
+        self.cache.clear()
+        assert self.other.get('user:2') is None
+        assert list(self.redis.data) == ['unrelated']
+
+    def test_redis_down(self):
+        self.cache.set('user:1', 1)
+        self.redis.down = True
+        self.cache.set('user:2', 2)
+        assert self.cache.get('user:1') == 1
+        assert self.other.get('user:1') is None
+        assert self.other.stats()['redis_errors'] == 1
+
+    def test_outdated(self):
+        versions = cache.VersionCounter()
+        tiered = cache.TieredCache(cache.TTLCache(10, 10),
+                                   versions=versions)
+        version = tiered.version()
+        versions.bump()
+        assert not tiered.set('user:1', 1, version)
+        assert tiered.get('user:1') is None
+        assert tiered.set('user:1', 1, tiered.version())
+        assert tiered.get('user:1') == 1
+
+        def load():
+            # changed while loading
+            versions.bump()
+            return 2
+
+        assert tiered.read_through('user:2', load) == 2
+        assert tiered.get('user:2') is None
+        assert tiered.stats()['outdated'] == 2
+
+
+class TestVersionCounter(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = DictRedis()
+        self.clock = FakeClock()
+        self.counter = cache.VersionCounter(self.redis, timer=self.clock)
+        # another worker, sharing the same redis
+        self.other = cache.VersionCounter(self.redis)
+
+    def test_shared_through_redis(self):
+        assert self.counter.shared
+        assert self.counter.get() == 0
+        assert self.other.bumped() == 0
+        self.clock.now = 5
+        self.counter.bump()
+        assert self.other.get() == 1
+        assert self.other.bumped() == 5
+
+        local = cache.VersionCounter()
+        assert not local.shared
+        local.bump()
+        assert local.get() == 1
+
+    def test_missed_bump(self):
+        self.redis.down = True
+        assert not self.counter.bump()
+        self.redis.down = False
+
+        # the bump is tried again before getting
+        assert self.counter.get() == 1
+        assert self.other.get() == 1
+
+        # and unknown until it goes up after all
+        self.redis.down = True
+        self.counter.bump()
+        assert self.counter.get() is None
+        assert self.counter.bumped() is None
+        self.redis.down = False
+        assert self.counter.bump()
+        assert self.counter.get() == 2
+        assert self.counter.errors == 3
+
+
+if __name__ == '__main__':
+    unittest.main()
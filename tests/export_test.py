@@ -0,0 +1,84 @@
+"""Test streaming everything out as NDJSON.
+
+"""
+
+import io
+import gzip
+import json
+import datetime
+import unittest
+
+import sqlalchemy
+import sqlalchemy.orm
+
+from ..msg import export
+from ..msg import models
+from .cache_test import FakeClock
+
+
+class TestExport(unittest.TestCase):
+
+    def setUp(self):
+        engine = sqlalchemy.create_engine('sqlite://')
+        models.User.__table__.create(engine)
+        models.Message.__table__.create(engine)
+        self.session = sqlalchemy.orm.sessionmaker(bind=engine)()
+        day = datetime.datetime(2016, 1, 1)
+        engine.execute(models.User.__table__.insert(),
+                       {'username': 'kitten', 'password_hash': 'x',
+                        'created': day})
+        engine.execute(models.Message.__table__.insert(),
+                       [{'user_id': 1, 'text': u'yarn \u2764',
+                         'created': day + datetime.timedelta(days=i)}
+                        for i in range(3)])
+
+    def lines(self, chunks):
+        text = b''.join(chunks).decode('utf-8')
+        return [json.loads(line) for line in text.splitlines()]
+
+    def test_ndjson(self):
+        chunks = list(export.ndjson(self.session, chunk_size=2))
+        # the user, then two chunks of messages
+        assert len(chunks) == 3
+
+        user, first, second, third = self.lines(chunks)
+        assert user['type'] == 'user'
+        assert user['username'] == 'kitten'
+        assert user['password_hash'] == 'x'
+        assert user['created'] == '2016-01-01T00:00:00Z'
+        assert [m['id'] for m in (first, second, third)] == [1, 2, 3]
+        assert first == {'type': 'message', 'id': 1, 'user_id': 1,
+                         'text': u'yarn \u2764',
+                         'created': '2016-01-01T00:00:00Z',
+                         'edited': None, 'version': 1}
+
+    def test_since_until(self):
+        lines = self.lines(export.ndjson(
+            self.session, ['messages'],
+            since=datetime.datetime(2016, 1, 2),
+            until=datetime.datetime(2016, 1, 3),
+        ))
+        assert [m['id'] for m in lines] == [2]
+
+    def test_gzipped(self):
+        chunks = list(export.ndjson(self.session))
+        compressed = b''.join(export.gzipped(iter(chunks)))
+        assert gzip.GzipFile(fileobj=io.BytesIO(compressed)).read() == \
+            b''.join(chunks)
+
+    def test_meter(self):
+        clock = FakeClock()
+        meter = export.Meter(clock)
+
+        for __ in meter(export.ndjson(self.session, chunk_size=1)):
+            clock.now += 1
+
+        stats = meter.stats()
+        assert stats['rows'] == 4
+        assert stats['seconds'] == 4
+        assert stats['rows_per_second'] == 1
+        assert stats['megabytes_per_second'] == stats['bytes'] / 4e6
+
+
+if __name__ == '__main__':
+    unittest.main()
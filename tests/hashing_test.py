@@ -0,0 +1,68 @@
+"""Test hashing passwords off the event loop.
+
+"""
+
+import os
+import sys
+import json
+import unittest
+import subprocess
+
+from ..msg import hashing
+
+
+class TestPasswordHasher(unittest.TestCase):
+
+    def test_hash(self):
+
+        for threads in (0, 2):
+            hasher = hashing.PasswordHasher('sha512', 1000, threads)
+            password_hash = hasher.hash('yarn')
+            assert password_hash.startswith('pbkdf2:sha512:1000$')
+            assert hasher.check(password_hash, 'yarn')
+            assert not hasher.check(password_hash, 'ball')
+            assert not hasher.needs_rehash(password_hash)
+
+        assert (hasher.pool() is None) == (threads == 0)
+
+    def test_needs_rehash(self):
+        old = hashing.PasswordHasher('sha256', 1000, 0).hash('yarn')
+        hasher = hashing.PasswordHasher('sha256', 2000, 0)
+        assert hasher.needs_rehash(old)
+        assert hasher.check(old, 'yarn')
+
+
+class TestLatency(unittest.TestCase):
+    """Reads under gevent while a hash is in flight, as
+    checked by `tests.latency` in a process of its own (gevent
+    patches everything).
+
+    That also times reads during a burst of sign-ups, to be
+    run by hand: timings are too noisy to test.
+
+    """
+
+    def finished(self, threads):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.check_output(
+            [sys.executable, '-m', 'tests.latency', '--in-flight',
+             str(threads)],
+            cwd=root
+        )
+        return json.loads(output.decode('utf-8').splitlines()[-1])
+
+    def test_reads_not_stalled(self):
+
+        try:
+            import gevent  # noqa: F401
+        except ImportError:
+            self.skipTest("gevent isn't installed")
+
+        # hashing on the loop holds reads up until it's done...
+        assert self.finished(0) == ['hash', 'read']
+        # ...while a hash in the pool waits on the read
+        assert self.finished(4) == ['read', 'hash']
+
+
+if __name__ == '__main__':
+    unittest.main()
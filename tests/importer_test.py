@@ -0,0 +1,132 @@
+"""Test importing users and messages in bulk.
+
+"""
+
+import io
+import datetime
+import unittest
+import multiprocessing
+
+import sqlalchemy
+import sqlalchemy.orm
+
+from ..msg import export
+from ..msg import models
+from ..msg import importer
+
+
+CSV = u"""username,password,bio
+kitten,yarn,
+puppy,ball,woof
+"""
+
+
+class TestImporter(unittest.TestCase):
+
+    def setUp(self):
+        engine = sqlalchemy.create_engine('sqlite://')
+        models.Base.metadata.create_all(engine)
+        self.session = sqlalchemy.orm.sessionmaker(bind=engine)()
+
+    def importer(self, source='kittens.ndjson', **kwargs):
+        return importer.Importer(self.session, source, 2, **kwargs)
+
+    def messages(self, count):
+        return [{'type': 'message', 'user_id': '1', 'text': 'message %d' % i}
+                for i in range(count)]
+
+    def test_export_round_trip(self):
+        source = sqlalchemy.orm.sessionmaker(
+            bind=sqlalchemy.create_engine('sqlite://')
+        )()
+        models.Base.metadata.create_all(source.get_bind())
+        source.add(models.User('kitten', 'yarn'))
+        source.flush()
+        source.add(models.Message(1, u'yarn ❤'))
+        source.query(models.Message).update(
+            {'edited': datetime.datetime(2016, 1, 1, 12, 30), 'version': 2}
+        )
+        source.commit()
+
+        lines = b''.join(export.ndjson(source)).decode('utf-8')
+        records = importer.read_ndjson(io.StringIO(lines + u'\n\n'))
+        assert self.importer().run(records) == 2
+
+        user = self.session.query(models.User).one()
+        assert user.check_password('yarn')
+        message = self.session.query(models.Message).one()
+        assert message.user is user
+        assert message.text == u'yarn ❤'
+        assert message.edited == datetime.datetime(2016, 1, 1, 12, 30)
+        assert message.version == 2
+
+    def test_csv(self):
+        records = importer.read_csv(io.StringIO(CSV), 'user')
+        assert self.importer().run(records) == 2
+
+        kitten, puppy = self.session.query(models.User).order_by('id')
+        assert kitten.check_password('yarn')
+        assert puppy.username == 'puppy'
+        assert puppy.bio == 'woof'
+        assert puppy.created is not None
+
+    def test_pool(self):
+        pool = multiprocessing.Pool(2)
+        self.addCleanup(pool.terminate)
+        records = importer.read_csv(io.StringIO(CSV), 'user')
+        self.importer(pool=pool).run(records)
+        assert all(user.check_password(password) for user, password
+                   in zip(self.session.query(models.User).order_by('id'),
+                          ['yarn', 'ball']))
+
+    def test_resume(self):
+        """An interrupted import carries on from the last
+        chunk it saved.
+
+        """
+
+        def interrupted(records):
+
+            for i, record in enumerate(records):
+
+                if i == 3:
+                    raise KeyboardInterrupt
+
+                yield record
+
+        records = self.messages(5)
+
+        with self.assertRaises(KeyboardInterrupt):
+            self.importer().run(interrupted(records))
+
+        self.session.rollback()
+        assert self.session.query(models.Message).count() == 2
+
+        loader = self.importer()
+        assert loader.run(records) == 3
+        assert loader.resumed == 2
+        texts = [text for text, in self.session.query(models.Message.text)
+                 .order_by(models.Message.id)]
+        assert texts == ['message %d' % i for i in range(5)]
+
+        loader = self.importer()
+        assert loader.run(records) == 0
+        loader.forget()
+        assert loader.run(records[:1]) == 1
+
+    def test_bad_row(self):
+        records = self.messages(2) + [{'type': 'dog'}]
+
+        with self.assertRaises(ValueError) as context:
+            self.importer().run(records)
+
+        assert str(context.exception) == "Row 3: Unknown type: 'dog'"
+        assert self.session.query(models.Message).count() == 2
+
+        with self.assertRaises(ValueError):
+            self.importer('users.csv').run([{'type': 'user',
+                                             'username': 'kitten'}])
+
+
+if __name__ == '__main__':
+    unittest.main()
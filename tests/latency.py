@@ -0,0 +1,151 @@
+"""Measure how long reads take under gevent, as with
+`gunicorn --worker-class gevent`, while a burst of users are
+created and log in.
+
+Run from the root of this repository, with how many threads
+hash passwords (0 for none: on the event loop):
+
+    python -m tests.latency 4
+
+The last line printed is JSON: how long reads took (the
+95th percentile and the slowest), and how long one password
+hash takes, in milliseconds.
+
+Or, rather than timing anything, check which finishes first:
+a read, or a "hash" held in flight until that read is done
+(or, since on the event loop it never could be, half a
+second has gone by):
+
+    python -m tests.latency --in-flight 4
+
+The last line printed is then JSON: the order they finished.
+
+"""
+
+from gevent import monkey
+monkey.patch_all()
+
+import sys  # noqa: E402
+import json  # noqa: E402
+import time  # noqa: E402
+import base64  # noqa: E402
+
+import gevent  # noqa: E402
+import gevent.pywsgi  # noqa: E402
+import requests  # noqa: E402
+
+from msg import msg  # noqa: E402
+from msg import hashing  # noqa: E402
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def serve(threads):
+    """Start msg, hashing with `threads`, with one message
+    to read, returning the server and its URL.
+
+    """
+
+    msg.hasher = hashing.PasswordHasher(msg.config.PASSWORD_HASH_ALGORITHM,
+                                        msg.config.PASSWORD_HASH_ITERATIONS,
+                                        threads)
+    msg.limiter.enabled = False
+    msg.init_db()
+    server = gevent.pywsgi.WSGIServer(('127.0.0.1', 0), msg.app, log=None)
+    server.start()
+    url = 'http://127.0.0.1:%d' % server.server_port
+    session = requests.Session()
+    session.post(url + '/user', json={'username': 'reader',
+                                      'password': 'reader'})
+    auth = 'Basic ' + base64.b64encode(b'reader:reader').decode('ascii')
+    session.post(url + '/messages', json=[{'text': 'kitten'}],
+                 headers={'Authorization': auth})
+    return server, url
+
+
+def in_flight(threads, inline_timeout=0.5, timeout=30):
+    """Hand the hasher a job which holds on until a read
+    has finished, then make that read.
+
+    Returns:
+        list: "read" and "hash," in the order they finished.
+
+    """
+
+    server, url = serve(threads)
+    # a real lock, not a greenlet's, so it holds up a native thread
+    # (or, inline, the whole event loop)
+    latch = monkey.get_original('_thread', 'allocate_lock')()
+    latch.acquire()
+    finished = []
+
+    def held():
+        latch.acquire(True, inline_timeout if threads == 0 else timeout)
+
+    def hash_():
+        msg.hasher.run(held)
+        finished.append('hash')
+
+    def read():
+        requests.get(url + '/message/1')
+        finished.append('read')
+        latch.release()
+
+    hashing_ = gevent.spawn(hash_)
+    gevent.sleep(0)
+    gevent.joinall([hashing_, gevent.spawn(read)])
+    server.stop()
+    return finished
+
+
+def main(threads, users=8, reader_interval=0.005):
+    server, url = serve(threads)
+    started = time.time()
+    msg.hasher.hash('yarn')
+    hash_ms = (time.time() - started) * 1000
+    latencies = []
+    done = []
+
+    def reader():
+        client = requests.Session()
+
+        while not done:
+            started = time.time()
+            client.get(url + '/message/1')
+            latencies.append((time.time() - started) * 1000)
+            gevent.sleep(reader_interval)
+
+    def user(i):
+        client = requests.Session()
+        username = 'kitten%d' % i
+        client.post(url + '/user', json={'username': username,
+                                         'password': 'yarn'})
+        credentials = ('%s:yarn' % username).encode('ascii')
+        auth = 'Basic ' + base64.b64encode(credentials).decode('ascii')
+        client.post(url + '/messages', json=[{'text': 'mew'}],
+                    headers={'Authorization': auth})
+
+    reading = gevent.spawn(reader)
+    gevent.sleep(0.05)
+    gevent.joinall([gevent.spawn(user, i) for i in range(users)])
+    done.append(True)
+    reading.join()
+    server.stop()
+
+    print(json.dumps({'threads': threads,
+                      'reads': len(latencies),
+                      'hash_ms': hash_ms,
+                      'p95_ms': percentile(latencies, 0.95),
+                      'max_ms': max(latencies)}))
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+
+    if args[:1] == ['--in-flight']:
+        print(json.dumps(in_flight(int(args[1]) if len(args) > 1 else 4)))
+    else:
+        sys.exit(main(int(args[0]) if args else 4))
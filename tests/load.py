@@ -0,0 +1,493 @@
+"""End-to-end load test: msg under gunicorn with gevent
+workers, on a synthetic board, driven by a mix of readers and
+writers while stream subscribers listen.
+
+Run from the root of this repository:
+
+    python -m tests.load --users 1000 --messages 100000 \\
+        --workers 2 --concurrency 50 --subscribers 200 \\
+        --duration 30 --mix list=50,message=20,user=5,search=5,post=20
+
+The board is seeded into a fresh SQLite file (or --database,
+skipping seeding with --no-seed). Redis is whatever answers
+at `config.REDIS_URL`, or if nothing does, a fakeredis server
+(see requirements/develop.txt) started for the run.
+
+Prints the requests, errors, throughput and 50th/95th/99th
+percentile latency of each scenario, and how long stream
+subscribers took to see posted messages; --json saves them.
+
+"""
+
+from gevent import monkey
+monkey.patch_all()
+
+import os  # noqa: E402
+import re  # noqa: E402
+import sys  # noqa: E402
+import json  # noqa: E402
+import time  # noqa: E402
+import base64  # noqa: E402
+import bisect  # noqa: E402
+import random  # noqa: E402
+import shutil  # noqa: E402
+import socket  # noqa: E402
+import argparse  # noqa: E402
+import datetime  # noqa: E402
+import tempfile  # noqa: E402
+import subprocess  # noqa: E402
+import collections  # noqa: E402
+
+import gevent  # noqa: E402
+import redis  # noqa: E402
+import requests  # noqa: E402
+
+from tests.latency import percentile  # noqa: E402
+
+
+PASSWORD = 'loadtest'
+"""str: Every synthetic user's password."""
+
+WORDS = ('the a and to of i you it is that in my this for on so just '
+         'not with be but have are me at was all like what your do '
+         'kitten kittens yarn ball nap sun window treat purr mew '
+         'today lol yes no ok love cute tiny fluffy sleepy morning '
+         'night coffee rain new good great').split()
+"""list: Vocabulary of synthetic messages, most common first."""
+
+TOPICS = ('kittens', 'yarn', 'naps', 'caturday', 'msg')
+
+SENT = re.compile(r'sent=(\d+\.\d+)')
+"""re.RegexObject: When a writer posted a message, as it
+tells subscribers.
+"""
+
+FAKEREDIS = """
+from fakeredis import TcpFakeServer
+TcpFakeServer((%r, %d), server_type="redis").serve_forever()
+"""
+
+
+def make_app():
+    """The app, for gunicorn: msg's, on the database named by
+    the MSG_LOAD_DATABASE environment variable, without rate
+    limits (every client is on localhost).
+
+    """
+
+    from msg import msg
+
+    msg.app.config['SQLALCHEMY_DATABASE_URI'] = (
+        os.environ['MSG_LOAD_DATABASE']
+    )
+    # sessions keep the engine they were made with
+    msg.db.session.remove()
+    msg.limiter.enabled = False
+    return msg.app
+
+
+class Zipf(object):
+    """Picks 0 to `n` - 1, each `exponent` times less likely
+    than the last, the way a few users (or words) account for
+    most messages.
+
+    """
+
+    def __init__(self, n, exponent=1.0):
+        self.cumulative = []
+        total = 0.0
+
+        for rank in range(1, n + 1):
+            total += 1.0 / rank ** exponent
+            self.cumulative.append(total)
+
+    def choice(self, rng):
+        return bisect.bisect(self.cumulative,
+                             rng.random() * self.cumulative[-1])
+
+
+def text(rng, words=Zipf(len(WORDS))):
+    """Make up a message: a few to a few dozen words, now and
+    then tagged with a topic.
+
+    """
+
+    message = ' '.join(WORDS[words.choice(rng)]
+                       for __ in range(rng.randint(3, 30)))
+
+    if rng.random() < 0.2:
+        message += ' #' + rng.choice(TOPICS)
+
+    return message
+
+
+def dataset(users, messages, days=30, seed=0):
+    """Generate a synthetic board, as `importer` reads it:
+    users, then messages by a few prolific users and many
+    quiet ones, spread over `days`.
+
+    Every user's password is `PASSWORD`, hashed once.
+
+    """
+
+    from msg import msg
+
+    rng = random.Random(seed)
+    password_hash = msg.hasher.hash(PASSWORD)
+    start = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+
+    for i in range(users):
+        yield {'type': 'user', 'id': i + 1, 'username': 'user%d' % (i + 1),
+               'password_hash': password_hash,
+               'bio': text(rng) if rng.random() < 0.3 else None,
+               'created': start.isoformat()}
+
+    authors = Zipf(users, 1.1)
+    step = datetime.timedelta(days=days) / max(messages, 1)
+
+    for i in range(messages):
+        yield {'type': 'message', 'id': i + 1,
+               'user_id': authors.choice(rng) + 1, 'text': text(rng),
+               'created': (start + step * i).isoformat()}
+
+
+def seed_database(uri, users, messages):
+    """Create msg's tables at `uri`, and fill them."""
+
+    from msg import msg
+    from msg import importer
+
+    msg.app.config['SQLALCHEMY_DATABASE_URI'] = uri
+    # sessions keep the engine they were made with
+    msg.db.session.remove()
+
+    with msg.app.app_context():
+        msg.init_db()
+        loader = importer.Importer(msg.db.session, 'load', 5000)
+        loader.run(dataset(users, messages))
+        msg.rebuild_search_index()
+        msg.db.session.remove()
+
+    return loader.stats()
+
+
+def start_redis(url):
+    """Start a fakeredis server where `url` points, unless
+    something's there already.
+
+    Returns:
+        subprocess.Popen|None: --
+
+    """
+
+    client = redis.StrictRedis.from_url(url)
+
+    try:
+        client.ping()
+        return None
+    except redis.ConnectionError:
+        pass
+
+    kwargs = client.connection_pool.connection_kwargs
+    process = subprocess.Popen([sys.executable, '-c', FAKEREDIS
+                                % (kwargs['host'], kwargs['port'])])
+
+    for __ in range(100):
+
+        try:
+            client.ping()
+            return process
+        except redis.ConnectionError:
+            time.sleep(0.1)
+
+    process.kill()
+    raise RuntimeError("fakeredis didn't start")
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_app(uri, workers, port, log):
+    """Start gunicorn, waiting until it answers.
+
+    Returns:
+        subprocess.Popen: --
+
+    """
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, MSG_LOAD_DATABASE=uri)
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', 'tests.load:make_app()',
+         '--worker-class', 'gevent', '--workers', str(workers),
+         '--worker-connections', '2000',
+         # streams only end when they're next written to
+         '--graceful-timeout', '1',
+         '--bind', '127.0.0.1:%d' % port],
+        cwd=root, env=env, stdout=log, stderr=log,
+    )
+
+    for __ in range(300):
+
+        if process.poll() is not None:
+
+            with open(log.name) as f:
+                raise RuntimeError("gunicorn exited:\n" + f.read()[-2000:])
+
+        try:
+            requests.get('http://127.0.0.1:%d/stream/stats' % port)
+            return process
+        except requests.ConnectionError:
+            time.sleep(0.1)
+
+    process.kill()
+    raise RuntimeError("gunicorn didn't start")
+
+
+def authorization(user_id):
+    credentials = ('user%d:%s' % (user_id, PASSWORD)).encode('utf-8')
+    return 'Basic ' + base64.b64encode(credentials).decode('ascii')
+
+
+def list_messages(session, base, rng, board):
+    return session.get(base + '/messages',
+                       data=json.dumps({'offset': 0, 'limit': 20}),
+                       headers={'Content-Type': 'application/json'})
+
+
+def get_message(session, base, rng, board):
+    return session.get(base + '/message/%d'
+                       % rng.randint(1, board['messages']))
+
+
+def get_user(session, base, rng, board):
+    return session.get(base + '/user/%d' % rng.randint(1, board['users']))
+
+
+def search(session, base, rng, board):
+    return session.get(base + '/messages/search',
+                       params={'q': rng.choice(WORDS[30:])})
+
+
+def post_message(session, base, rng, board):
+    # writers are the most prolific users, as in `dataset`
+    user_id = board['authors'].choice(rng) + 1
+    data = [{'text': '%s sent=%.6f' % (text(rng), time.time())}]
+    return session.post(base + '/messages', data=json.dumps(data),
+                        headers={'Content-Type': 'application/json',
+                                 'Authorization': authorization(user_id)})
+
+
+SCENARIOS = collections.OrderedDict([
+                                     ('list', list_messages),
+                                     ('message', get_message),
+                                     ('user', get_user),
+                                     ('search', search),
+                                     ('post', post_message),
+                                    ])
+"""collections.OrderedDict: What virtual users do, by name."""
+
+
+def parse_mix(mix):
+    """Parse "name=weight,..." into names, and a `Zipf`-like
+    chooser of them.
+
+    """
+
+    names = []
+    cumulative = []
+    total = 0.0
+
+    for part in mix.split(','):
+        name, weight = part.split('=')
+
+        if name not in SCENARIOS:
+            raise ValueError("No such scenario: %s" % name)
+
+        total += float(weight)
+        names.append(name)
+        cumulative.append(total)
+
+    def choice(rng):
+        return names[bisect.bisect(cumulative, rng.random() * total)]
+
+    return choice
+
+
+def subscriber(base, stats):
+    """Listen to every message posted, noting how long after
+    it was sent each arrives.
+
+    """
+
+    response = requests.get(base + '/stream', stream=True)
+    stats['connected'] += response.status_code == 200
+
+    try:
+        for line in response.iter_lines():
+
+            if not line.startswith(b'data:'):
+                continue
+
+            received = time.time()
+            data = json.loads(line[5:].decode('utf-8'))
+
+            for message in data if isinstance(data, list) else [data]:
+                sent = SENT.search(message.get('text') or '')
+
+                if sent:
+                    stats['latencies'].append(
+                        (received - float(sent.group(1))) * 1000
+                    )
+    finally:
+        response.close()
+
+
+def drive(base, mix, concurrency, duration, subscribers, users, messages):
+    """Run `concurrency` virtual users, each doing scenarios
+    picked from `mix` back to back, for `duration` seconds,
+    while `subscribers` listen to /stream.
+
+    Returns:
+        dict: Each scenario's results, and "stream delivery".
+
+    """
+
+    choose = parse_mix(mix)
+    board = {'users': users, 'messages': messages,
+             'authors': Zipf(users, 1.1)}
+    latencies = collections.defaultdict(list)
+    errors = collections.Counter()
+    stream = {'connected': 0, 'latencies': []}
+    listening = [gevent.spawn(subscriber, base, stream)
+                 for __ in range(subscribers)]
+    # let them connect
+    gevent.sleep(1)
+    deadline = time.time() + duration
+
+    def virtual_user(i):
+        rng = random.Random(i)
+        session = requests.Session()
+
+        while time.time() < deadline:
+            name = choose(rng)
+            started = time.time()
+
+            try:
+                response = SCENARIOS[name](session, base, rng, board)
+                failed = response.status_code >= 400
+            except requests.RequestException:
+                failed = True
+
+            latencies[name].append((time.time() - started) * 1000)
+            errors[name] += failed
+
+    gevent.joinall([gevent.spawn(virtual_user, i)
+                    for i in range(concurrency)])
+    elapsed = time.time() - deadline + duration
+    # the last messages posted are still on their way
+    gevent.sleep(1)
+    gevent.killall(listening)
+    results = collections.OrderedDict()
+
+    # even those which didn't come up, so a short run shows it
+    for name in SCENARIOS:
+        results[name] = summarize(latencies[name], elapsed)
+        results[name]['errors'] = errors[name]
+
+    results['stream delivery'] = summarize(stream['latencies'], elapsed)
+    results['stream delivery']['subscribers'] = stream['connected']
+    return results
+
+
+def summarize(latencies, elapsed):
+
+    if not latencies:
+        return {'count': 0, 'per_second': 0.0}
+
+    return {'count': len(latencies),
+            'per_second': len(latencies) / elapsed,
+            'p50_ms': percentile(latencies, 0.50),
+            'p95_ms': percentile(latencies, 0.95),
+            'p99_ms': percentile(latencies, 0.99)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--database', help="SQLAlchemy URI; by default, "
+                                           "a new SQLite file.")
+    parser.add_argument('--no-seed', dest='seed', action='store_false',
+                        help="Use --database as it is.")
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--concurrency', type=int, default=50,
+                        help="Virtual users.")
+    parser.add_argument('--subscribers', type=int, default=100)
+    parser.add_argument('--duration', type=float, default=20,
+                        help="Seconds.")
+    parser.add_argument('--mix',
+                        default='list=50,message=20,user=5,search=5,post=20',
+                        help="Weights of: %s." % ', '.join(SCENARIOS))
+    parser.add_argument('--json', help="Save results to this file.")
+    args = parser.parse_args(argv)
+
+    from msg import config
+
+    directory = tempfile.mkdtemp(prefix='msg-load-')
+    uri = args.database or 'sqlite:///%s' % os.path.join(directory,
+                                                         'msg.db')
+    redis_server = start_redis(config.REDIS_URL)
+    app = None
+
+    try:
+
+        if args.seed:
+            stats = seed_database(uri, args.users, args.messages)
+            print("Seeded %d rows in %.1fs"
+                  % (stats['rows'], stats['seconds']))
+
+        port = free_port()
+        log = open(os.path.join(directory, 'gunicorn.log'), 'w')
+        app = start_app(uri, args.workers, port, log)
+        results = drive('http://127.0.0.1:%d' % port, args.mix,
+                        args.concurrency, args.duration, args.subscribers,
+                        args.users, args.messages)
+    finally:
+
+        if app is not None:
+            app.terminate()
+            app.wait()
+
+        if redis_server is not None:
+            redis_server.kill()
+
+        shutil.rmtree(directory, ignore_errors=True)
+
+    print("%-16s %9s %7s %9s %9s %9s %9s"
+          % ("scenario", "count", "errors", "per sec", "p50 ms", "p95 ms",
+             "p99 ms"))
+
+    for name, result in results.items():
+        print("%-16s %9d %7s %9.1f %9.1f %9.1f %9.1f"
+              % (name, result['count'], result.get('errors', '-'),
+                 result['per_second'], result.get('p50_ms', 0),
+                 result.get('p95_ms', 0), result.get('p99_ms', 0)))
+
+    print("%d of %d subscribers connected"
+          % (results['stream delivery']['subscribers'], args.subscribers))
+
+    if args.json:
+
+        with open(args.json, 'w') as f:
+            json.dump({'arguments': vars(args), 'results': results}, f,
+                      indent=2)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
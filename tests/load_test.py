@@ -0,0 +1,57 @@
+"""Test the load test harness, briefly and at a tiny scale.
+
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+
+class TestLoad(unittest.TestCase):
+
+    def test_smoke(self):
+
+        try:
+            import gevent  # noqa: F401
+            import gunicorn  # noqa: F401
+        except ImportError:
+            self.skipTest("gevent and gunicorn aren't installed")
+
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        output = os.path.join(directory, 'load.json')
+        subprocess.check_call(
+            [sys.executable, '-m', 'tests.load', '--users', '10',
+             '--messages', '100', '--workers', '1', '--concurrency', '4',
+             '--subscribers', '3', '--duration', '2', '--json', output,
+             # evenly, so each scenario comes up, however busy we are
+             '--mix', 'list=1,message=1,user=1,search=1,post=1'],
+            cwd=root,
+        )
+
+        with open(output) as f:
+            results = json.load(f)['results']
+
+        assert set(results) == {'list', 'message', 'user', 'search', 'post',
+                                'stream delivery'}
+
+        for name, result in results.items():
+
+            if name != 'stream delivery':
+                assert result['count'] > 0, name
+                assert result['errors'] == 0, name
+
+        stream = results['stream delivery']
+        assert stream['subscribers'] == 3
+        # every post reaches every subscriber, unless it's still on
+        # its way when the run ends
+        assert 0 < stream['count'] <= results['post']['count'] * 3
+
+
+if __name__ == '__main__':
+    unittest.main()
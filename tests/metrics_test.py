@@ -0,0 +1,124 @@
+"""Test metrics, and their sharing between workers.
+
+"""
+
+import unittest
+
+from ..msg import metrics
+from .cache_test import DictRedis
+
+
+class HashRedis(DictRedis):
+    """DictRedis, and just enough of Redis' hashes for a
+    Registry.
+
+    """
+
+    def hset(self, key, field, value):
+        self.check()
+        self.data.setdefault(key, {})[field.encode('utf-8')] = (
+            value.encode('utf-8')
+        )
+
+    def hgetall(self, key):
+        self.check()
+        return dict(self.data.get(key, {}))
+
+    def hdel(self, key, *fields):
+        self.check()
+
+        for field in fields:
+            self.data.get(key, {}).pop(field, None)
+
+
+class TestRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.redis = HashRedis()
+        self.registry = self.make_registry()
+
+    def make_registry(self, worker='here:1'):
+        registry = metrics.Registry(self.redis, interval=5, ttl=60,
+                                    timer=lambda: self.now)
+        registry.worker = lambda: worker
+        registry.counter('requests_total', "Requests.")
+        registry.gauge('connections', "Connections.")
+        registry.histogram('duration_seconds', "Durations.", (0.1, 1.0))
+        return registry
+
+    def test_render(self):
+        self.registry.inc('requests_total', (('method', 'GET'),))
+        self.registry.inc('requests_total', (('method', 'GET'),), 2)
+        self.registry.inc('requests_total', (('method', 'say "hi"'),))
+        self.registry.set('connections', 4)
+
+        for value in (0.05, 0.1, 0.5, 2.5):
+            self.registry.observe('duration_seconds', value,
+                                  (('endpoint', 'message'),))
+
+        lines = self.registry.render().splitlines()
+        assert lines == [
+            '# HELP requests_total Requests.',
+            '# TYPE requests_total counter',
+            'requests_total{method="GET"} 3',
+            'requests_total{method="say \\"hi\\""} 1',
+            '# HELP connections Connections.',
+            '# TYPE connections gauge',
+            'connections 4',
+            '# HELP duration_seconds Durations.',
+            '# TYPE duration_seconds histogram',
+            'duration_seconds_bucket{endpoint="message",le="0.1"} 2',
+            'duration_seconds_bucket{endpoint="message",le="1.0"} 3',
+            'duration_seconds_bucket{endpoint="message",le="+Inf"} 4',
+            'duration_seconds_sum{endpoint="message"} 3.15',
+            'duration_seconds_count{endpoint="message"} 4',
+        ]
+
+    def test_collectors(self):
+        self.registry.collectors.append(
+            lambda registry: registry.set('connections', 7)
+        )
+        assert 'connections 7' in self.registry.render()
+
+    def test_shared_through_redis(self):
+        other = self.make_registry('there:2')
+        self.registry.inc('requests_total')
+        self.registry.observe('duration_seconds', 0.5)
+        other.inc('requests_total', amount=2)
+        other.observe('duration_seconds', 0.05)
+
+        # not yet saved, so only our own
+        totals = self.registry.collect()
+        assert totals[('requests_total', ())] == 1
+
+        other.maybe_save()
+        self.now += 1
+        other.inc('requests_total')
+        other.maybe_save()  # too soon to save again
+        totals = self.registry.collect()
+        assert totals[('requests_total', ())] == 3
+        assert totals[('duration_seconds', ())] == [1, 1, 0, 0.55]
+
+        # and the other way round, as saved by the collect
+        assert other.collect()[('requests_total', ())] == 4
+
+        # the other worker went away
+        self.now += 61
+        assert self.registry.collect()[('requests_total', ())] == 1
+        assert list(self.redis.hgetall('metrics')) == [b'here:1']
+
+        self.registry.clear()
+        assert self.registry.collect() == {}
+
+    def test_redis_down(self):
+        self.redis.down = True
+        self.registry.inc('requests_total')
+        assert self.registry.collect() == {('requests_total', ()): 1}
+        assert self.registry.errors == 2  # saving, then reading
+
+        registry = metrics.Registry()
+        registry.counter('requests_total', "Requests.")
+        registry.inc('requests_total')
+        registry.maybe_save()
+        assert registry.render().endswith('requests_total 1\n')
@@ -3,13 +3,22 @@
 """
 
 import os
+import zlib
 import json
 import base64
+import shutil
+import sqlite3
 import unittest
 import tempfile
+import threading
 import functools
+import contextlib
+
+import sqlalchemy
 
 from ..msg import msg
+from ..msg import stream
+from ..msg import profiler
 
 
 class TestEverything(unittest.TestCase):
@@ -23,6 +32,8 @@ class TestEverything(unittest.TestCase):
         self.db_fd, msg.app.config['DATABASE'] = tempfile.mkstemp()
         msg.app.config['TESTING'] = True
         self.app = msg.app.test_client()
+        # every test starts with a clean slate of rate limits
+        msg.limiter.reset()
         msg.init_db()
 
     # TODO: docstring
@@ -108,6 +119,63 @@ class TestEverything(unittest.TestCase):
         headers = {'Authorization': 'Basic '.encode('utf-8') + base64_creds}
         return headers
 
+    @contextlib.contextmanager
+    def count_queries(self):
+        """Count the SQL statements run inside this context.
+
+        Yields:
+            list: Statements executed, appended to as they run.
+
+        """
+
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with msg.app.app_context():
+            engine = msg.db.engine
+
+        sqlalchemy.event.listen(engine, 'before_cursor_execute',
+                                before_cursor_execute)
+
+        try:
+            yield statements
+        finally:
+            sqlalchemy.event.remove(engine, 'before_cursor_execute',
+                                    before_cursor_execute)
+
+    def assert_query_budget(self, budget, method, *args, **kwargs):
+        """Make a request (as `call` does), failing if it runs
+        more than `budget` SQL statements.
+
+        Arguments:
+            budget (int): Most statements the request may run.
+            method (str): --
+            *args: --
+            **kwargs: --
+
+        Returns:
+            tuple: The status and JSON of the response.
+
+        """
+
+        msg.read_cache.clear()
+
+        with self.count_queries() as statements:
+            result = self.call(method, *args, **kwargs)
+
+        if len(statements) > budget:
+            profile = profiler.Profile('%s %s' % (method.upper(), args[0]))
+
+            for statement in statements:
+                profile.add(statement, None, 0.0)
+
+            self.fail("Over the budget of %d queries:\n%s"
+                      % (budget, profile.report()))
+
+        return result
+
     # TODO: doc *args and **kwargs
     def call(self, method, *args, **kwargs):
         """Because we're tired of entering content_type and
@@ -157,6 +225,36 @@ class TestEverything(unittest.TestCase):
         # test the expected response vs. actual
         assert user_fixture == response
 
+    def test_rehash_on_login(self):
+        """Hashes made before the work factor changed are
+        made afresh when their user next logs in.
+
+        """
+
+        self.test_create_user()
+        old_hasher = msg.hasher
+        self.addCleanup(setattr, msg, 'hasher', old_hasher)
+        msg.hasher = msg.hashing.PasswordHasher('sha256', 1000, 0)
+        msg.credential_cache.clear()
+
+        headers = self.make_base64_header("testuser", "testpass")
+        status, __ = self.post('/messages', headers=headers,
+                               data=[{"text": "kitten"}])
+        assert status == 200
+
+        with msg.app.app_context():
+            user = msg.db.session.query(msg.models.User).one()
+            assert user.password_hash.startswith('pbkdf2:sha256:1000$')
+
+        msg.credential_cache.clear()
+        status, __ = self.post('/messages', headers=headers,
+                               data=[{"text": "yarn"}])
+        assert status == 200
+        status, __ = self.post('/messages', data=[{"text": "yarn"}],
+                               headers=self.make_base64_header("testuser",
+                                                               "wrong"))
+        assert status == 401
+
     def test_create_user_without_username_password(self):
         # test creating a new user without
         # specifying username or password
@@ -268,6 +366,157 @@ class TestEverything(unittest.TestCase):
 
         assert post_fixture == response
 
+    def test_credential_cache(self):
+        """A repeat request with the same credentials is
+        answered from the credential cache; a wrong password
+        never is.
+
+        """
+
+        self.test_post()
+        assert msg.credential_cache.stats()['hits'] == 0
+        self.test_post(create_user=False)
+        assert msg.credential_cache.stats()['hits'] == 1
+
+        headers = self.make_base64_header("testuser", "wrongpass")
+        status, response = self.post('/message', headers=headers,
+                                     data={"text": "sneaky"})
+        assert status == 401
+        assert msg.credential_cache.stats()['hits'] == 1
+
+    def test_credential_cache_password_change(self):
+        """Changing a user's password forgets their cached
+        credentials.
+
+        """
+
+        self.test_post()
+        assert len(msg.credential_cache) == 1
+
+        with msg.app.app_context():
+            user = msg.db.session.query(msg.models.User).get(1)
+            user.password_hash = user.hash_password('newpass')
+            msg.db.session.commit()
+
+        assert len(msg.credential_cache) == 0
+        headers = self.make_base64_header("testuser", "testpass")
+        status, response = self.post('/message', headers=headers,
+                                     data={"text": "old password"})
+        assert status == 401
+
+    def test_read_cache_outdated(self):
+        """A message or user read before a change is committed,
+        but only cached after, isn't cached at all.
+
+        """
+
+        self.test_post()
+        msg.read_cache.clear()
+
+        with msg.app.test_request_context():
+            version = msg.read_cache.version()
+            message = msg.message_entry(1)
+            user = msg.cached_user(user_id=1)
+
+        headers = self.make_base64_header("testuser", "testpass")
+        self.put('/message/1', headers=headers, data={"text": "edited"})
+        assert not msg.read_cache.set('message:1', message, version)
+
+        with msg.app.app_context():
+            kitten = msg.db.session.query(msg.models.User).get(1)
+            kitten.bio = "meow"
+            msg.db.session.flush()
+            # others still read the old user until it's committed...
+            assert msg.read_cache.set('user:1', user,
+                                      msg.read_cache.version())
+            msg.db.session.commit()
+
+        # ...when that's forgotten
+        msg.read_cache.local.clear()
+        assert msg.read_cache.get('user:1') is None
+        assert not msg.read_cache.set('user:1', user, version)
+        status, response = self.get('/message/1')
+        assert response['text'] == "edited"
+        assert response['user']['bio'] == "meow"
+
+    def test_import_fails(self):
+        """An import which fails on a row keeps the chunks
+        before it (as its checkpoint counts), tells nobody, and
+        carries on from there when run again.
+
+        """
+
+        rows = [{"type": "user", "username": "kitten", "password": "yarn"},
+                {"type": "message", "user_id": 1, "text": "meow"},
+                {"type": "user", "username": "puppy"},
+                {"type": "message", "user_id": 1, "text": "purr"}]
+        fd, path = tempfile.mkstemp(suffix='.ndjson')
+        self.addCleanup(os.unlink, path)
+
+        with os.fdopen(fd, 'w') as ndjson:
+            ndjson.write('\n'.join(json.dumps(row) for row in rows))
+
+        with msg.app.app_context():
+            version = msg.board_version.get()
+
+        runner = msg.app.test_cli_runner()
+        arguments = ['import', path, '--chunk-size', '1', '--processes', '1']
+        result = runner.invoke(args=arguments)
+        assert result.exit_code != 0
+        assert "Row 3: User has neither password" in result.output
+
+        with msg.app.app_context():
+            assert msg.board_version.get() == version
+            session = msg.db.session
+            assert session.query(msg.models.User).count() == 1
+            assert session.query(msg.models.Message).count() == 1
+            checkpoint = session.query(msg.models.ImportCheckpoint).one()
+            assert checkpoint.rows == 2
+
+        rows[2]["password"] = "ball"
+
+        with open(path, 'w') as ndjson:
+            ndjson.write('\n'.join(json.dumps(row) for row in rows))
+
+        result = runner.invoke(args=arguments)
+        assert result.exit_code == 0
+        assert "(2 resumed)" in result.output
+
+        with msg.app.app_context():
+            assert msg.board_version.get() > version
+            assert msg.db.session.query(msg.models.Message).count() == 2
+
+    def test_credential_cache_other_worker(self):
+        """A password changed through one worker is no longer
+        trusted by another, which cached it.
+
+        """
+
+        self.test_post()
+        other_worker = msg.cache.TTLCache(msg.config.AUTH_CACHE_SIZE,
+                                          msg.config.AUTH_CACHE_TTL)
+        this_worker, msg.credential_cache = msg.credential_cache, other_worker
+
+        try:
+            self.test_post(create_user=False)
+            assert len(other_worker) == 1
+
+            msg.credential_cache = this_worker
+
+            with msg.app.app_context():
+                user = msg.db.session.query(msg.models.User).get(1)
+                user.password_hash = user.hash_password('newpass')
+                msg.db.session.commit()
+
+            msg.credential_cache = other_worker
+            headers = self.make_base64_header("testuser", "testpass")
+            status, response = self.post('/message', headers=headers,
+                                         data={"text": "old password"})
+            assert status == 401
+            assert other_worker.stats()['hits'] == 0
+        finally:
+            msg.credential_cache = this_worker
+
     # TODO: this test is lame and will only fetch one
     # message through messages.
     def test_get_messages(self):
@@ -297,6 +546,895 @@ class TestEverything(unittest.TestCase):
             del message["user"]["created"]
             assert post_fixture == message
 
+    def test_get_messages_by_cursor(self):
+        """Walk the whole board two messages at a time using
+        the cursor handed back with each page, oldest first.
+
+        """
+
+        self.test_post()
+
+        for __ in range(4):
+            self.test_post(create_user=False)
+
+        status, response = self.get('/messages',
+                                    data={"limit": 2, "after_id": None})
+        assert status == 200
+        seen = [m["id"] for m in response["messages"]]
+
+        while response["next"] is not None:
+            page_request = {"limit": 2, "cursor": response["next"]}
+            status, response = self.get('/messages', data=page_request)
+            assert status == 200
+            seen.extend(m["id"] for m in response["messages"])
+
+        assert seen == [1, 2, 3, 4, 5]
+
+    def test_get_messages_before_id(self):
+        """The /messages/<before_id> route seeks backwards,
+        newest first.
+
+        """
+
+        self.test_post()
+
+        for __ in range(3):
+            self.test_post(create_user=False)
+
+        status, response = self.get('/messages/4', data={"limit": 2})
+        assert status == 200
+        assert [m["id"] for m in response["messages"]] == [3, 2]
+
+        status, response = self.get('/messages', data={"limit": 2,
+                                                       "cursor":
+                                                       response["next"]})
+        assert status == 200
+        assert [m["id"] for m in response["messages"]] == [1]
+        assert response["next"] is None
+
+    def test_get_messages_bad_cursor(self):
+        status, response = self.get('/messages', data={"limit": 2,
+                                                       "cursor": "lol"})
+        assert status == 400
+        assert response == {"message": "Invalid cursor: lol"}
+
+        status, response = self.get('/messages', data={"limit": 2,
+                                                       "after_id": 1,
+                                                       "before_id": 5})
+        assert status == 400
+
+        status, response = self.get('/messages', data={"limit": 2})
+        assert status == 400
+        assert response == {"message": "'offset' is a required property"}
+
+    def test_get_messages_tampered_cursor(self):
+        """A cursor whose key isn't an ID, or a limit too
+        small for a page, is a bad request rather than an error.
+
+        """
+
+        self.test_post()
+
+        for key in ([[1]], [{"a": 1}], ["x"], [True], [1, 2]):
+            cursor = msg.encode_cursor('before', key)
+            status, response = self.get('/messages', data={"limit": 2,
+                                                           "cursor": cursor})
+            assert status == 400
+            assert response == {"message": "Invalid cursor."}
+
+        for limit in (0, -1):
+            status, response = self.get('/messages',
+                                        data={"limit": limit,
+                                              "before_id": None})
+            assert status == 400
+            assert response == {"message": "Request at least 1 message."}
+
+    def test_post_many(self):
+        """Create several messages with a single request.
+
+        """
+
+        self.test_create_user()
+        headers = self.make_base64_header("testuser", "testpass")
+        messages = [{"text": "message %d" % i} for i in range(3)]
+        status, response = self.post('/messages', headers=headers,
+                                     data=messages)
+        assert status == 200
+        assert [m["id"] for m in response] == [1, 2, 3]
+        assert [m["text"] for m in response] == ["message 0", "message 1",
+                                                 "message 2"]
+        assert all(m["user"]["username"] == "testuser" for m in response)
+
+        status, response = self.get('/message/3')
+        assert status == 200
+        assert response["text"] == "message 2"
+
+    def test_post_many_one_insert(self):
+        """The messages are inserted with one statement, and
+        their IDs known without asking again.
+
+        """
+
+        self.test_post()
+        headers = self.make_base64_header("testuser", "testpass")
+        messages = [{"text": "message %d" % i} for i in range(5)]
+
+        with self.count_queries() as statements:
+            status, response = self.post('/messages', headers=headers,
+                                         data=messages)
+
+        assert status == 200
+        inserts = [statement for statement in statements
+                   if statement.startswith('INSERT INTO posts (')]
+        assert len(inserts) == 1
+        assert [m["id"] for m in response] == [2, 3, 4, 5, 6]
+
+        for message in response:
+            status, stored = self.get('/message/%d' % message["id"])
+            assert stored["text"] == message["text"]
+
+    def test_search(self):
+        """Search messages, best matches first, a page at a
+        time, with every kind of index; edits and deletes are
+        seen straight away.
+
+        """
+
+        for backend in ('auto', 'memory'):
+            msg.config.SEARCH_BACKEND = backend
+            self.addCleanup(setattr, msg.config, 'SEARCH_BACKEND', 'auto')
+            msg.init_db()
+            self.check_search()
+
+        status, response = self.get('/messages/search')
+        assert status == 400
+        assert response == {'message': "Missing search query: q"}
+        status, response = self.get('/messages/search',
+                                    query_string={'q': 'kitten',
+                                                  'cursor': 'nope'})
+        assert status == 400
+
+    def check_search(self):
+        self.test_create_user()
+        headers = self.make_base64_header("testuser", "testpass")
+        texts = ["kitten", "kitten kitten kitten", "puppy",
+                 "a kitten and a puppy", "Kitten!"]
+        self.post('/messages', headers=headers,
+                  data=[{"text": text} for text in texts])
+
+        def search(**query_string):
+            status, response = self.get('/messages/search',
+                                        query_string=query_string)
+            assert status == 200
+            return [m['id'] for m in response['messages']], response
+
+        found, response = search(q='KITTEN', limit=3)
+        assert found == [2, 1, 5]
+        found, response = search(q='kitten', cursor=response['next'])
+        assert found == [4]
+        assert response['next'] is None
+        found, response = search(q='puppy kitten')
+        assert found == [4]
+        assert response['messages'][0]['user']['id'] == 1
+
+        self.put('/message/4', headers=headers, data={"text": "a puppy"})
+        self.delete('/message/2', headers=headers)
+        assert search(q='kitten')[0] == [1, 5]
+
+    def test_export(self):
+        """Admins may stream everything out as NDJSON,
+        gzipped if they like.
+
+        """
+
+        self.test_create_user()
+        self.test_create_user("admin", "adminpass", 2)
+        headers = self.make_base64_header("testuser", "testpass")
+        self.post('/messages', headers=headers,
+                  data=[{"text": "kitten"}, {"text": "yarn"}])
+
+        status, response = self.get('/messages/export', headers=headers)
+        assert status == 403
+
+        msg.config.ADMIN_USERNAMES = ["admin"]
+        self.addCleanup(setattr, msg.config, 'ADMIN_USERNAMES', [])
+        headers = self.make_base64_header("admin", "adminpass")
+        response = self.app.get('/messages/export', headers=headers)
+        assert response.status_code == 200
+        assert response.mimetype == 'application/x-ndjson'
+        assert 'Content-Encoding' not in response.headers
+        lines = [json.loads(line) for line
+                 in response.get_data(as_text=True).splitlines()]
+        assert [(line['type'], line['id']) for line in lines] == [
+            ('user', 1), ('user', 2), ('message', 1), ('message', 2),
+        ]
+        assert lines[3]['text'] == "yarn"
+
+        headers['Accept-Encoding'] = 'gzip'
+        response = self.app.get('/messages/export', headers=headers,
+                                query_string={'tables': 'messages',
+                                              'since': lines[2]['created']})
+        assert response.headers['Content-Encoding'] == 'gzip'
+        data = zlib.decompress(response.get_data(), 16 + zlib.MAX_WBITS)
+        assert len(data.splitlines()) == 2
+
+        status, response = self.get('/messages/export', headers=headers,
+                                    query_string={'since': 'yesterday'})
+        assert status == 400
+        assert response == {'message': "Invalid since: yesterday"}
+        status, response = self.get('/messages/export', headers=headers,
+                                    query_string={'tables': 'posts'})
+        assert status == 400
+
+    def test_metrics(self):
+        """/metrics counts requests, their queries and those
+        refused by rate limits, by endpoint.
+
+        """
+
+        msg.instruments.clear()
+        self.test_post()
+
+        # until the default limit, of 50 per hour (for POSTs
+        # and GETs together), is hit
+        for __ in range(50):
+            status, __ = self.get('/message/1')
+
+        assert status == 429
+
+        response = self.app.get('/metrics')
+        assert response.status_code == 200
+        assert response.mimetype == 'text/plain'
+        lines = response.get_data(as_text=True).splitlines()
+        assert ('msg_requests_total{endpoint="message",method="GET",'
+                'status="200"} 49') in lines
+        assert ('msg_requests_total{endpoint="message",method="GET",'
+                'status="429"} 1') in lines
+        assert ('msg_request_duration_seconds_count{endpoint="message",'
+                'method="GET"} 50') in lines
+        assert ('msg_rate_limited_total{limit="50 per 1 hour",'
+                'endpoint="message"} 1') in lines
+        assert any(line.startswith('msg_db_queries_total{endpoint="user"}')
+                   for line in lines)
+        assert any(line.startswith('msg_password_hash_seconds_count'
+                                   '{operation="hash"} ')
+                   for line in lines)
+        assert 'msg_stream_connections 0' in lines
+
+    def test_query_budgets(self):
+        """Reading doesn't take more queries for more messages
+        or users.
+
+        """
+
+        for id_, username in enumerate(('kitten', 'puppy', 'bunny'), 1):
+            self.test_create_user(username, 'yarn', id_)
+            headers = self.make_base64_header(username, 'yarn')
+            self.post('/messages', headers=headers,
+                      data=[{"text": "%s %d" % (username, i)}
+                            for i in range(5)])
+
+        self.assert_query_budget(1, 'get', '/user/1')
+        self.assert_query_budget(1, 'get', '/user/kitten')
+        self.assert_query_budget(1, 'get', '/message/3')
+        self.assert_query_budget(2, 'get', '/messages',
+                                 data={"offset": 0, "limit": 15})
+        self.assert_query_budget(2, 'get', '/messages/10',
+                                 data={"limit": 5})
+        self.assert_query_budget(2, 'get', '/user/2/messages',
+                                 data={"limit": 5})
+        self.assert_query_budget(3, 'get', '/messages/search',
+                                 query_string={'q': 'kitten'})
+
+    def test_profile(self):
+        """Profiled requests which repeat a query, or are slow,
+        are logged, the slow ones with their queries' plans.
+
+        """
+
+        for name in ('PROFILE_ENABLED', 'PROFILE_SLOW_SECONDS',
+                     'PROFILE_REPEATED', 'MESSAGES_AUTHOR_LOADING',
+                     'MESSAGES_COLUMNAR'):
+            self.addCleanup(setattr, msg.config, name,
+                            getattr(msg.config, name))
+
+        for id_, username in enumerate(('kitten', 'puppy', 'bunny'), 1):
+            self.test_create_user(username, 'yarn', id_)
+            headers = self.make_base64_header(username, 'yarn')
+            self.post('/message', headers=headers, data={"text": username})
+
+        msg.config.PROFILE_ENABLED = True
+        msg.config.PROFILE_REPEATED = 3
+        # each message's user loaded by itself
+        msg.AUTHOR_LOADERS['lazy'] = sqlalchemy.orm.lazyload
+        self.addCleanup(msg.AUTHOR_LOADERS.pop, 'lazy')
+        msg.config.MESSAGES_AUTHOR_LOADING = 'lazy'
+        msg.config.MESSAGES_COLUMNAR = False
+        msg.read_cache.clear()
+
+        with self.assertLogs(msg.app.logger, 'WARNING') as logs:
+            self.get('/messages', data={"offset": 0, "limit": 10})
+
+        record, = logs.records
+        report = record.getMessage()
+        assert report.startswith('GET /messages: ')
+        assert '3 x ' in report and '(N+1?)' in report
+
+        msg.config.MESSAGES_AUTHOR_LOADING = 'selectin'
+        msg.read_cache.clear()
+
+        with self.assertRaises(AssertionError):
+
+            # nothing to log
+            with self.assertLogs(msg.app.logger, 'WARNING'):
+                self.get('/messages', data={"offset": 0, "limit": 10})
+
+        msg.config.PROFILE_SLOW_SECONDS = 0
+        msg.read_cache.clear()
+
+        with self.assertLogs(msg.app.logger, 'WARNING') as logs:
+            self.get('/message/1')
+
+        record, = logs.records
+        report = record.getMessage()
+        assert report.startswith('GET /message/1: ')
+        assert '(N+1?)' not in report
+        # SQLite's plan, e.g., "SEARCH messages USING INTEGER PRIMARY KEY"
+        assert 'SEARCH' in report
+
+    def test_replicas(self):
+        """With SQLite files for a primary and its replicas:
+        reads go to the replicas, in turn, skipping those
+        which are down or broken, and clients read what they
+        write. What's read from replicas soon after a change
+        isn't cached.
+
+        """
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        primary = os.path.join(directory, 'primary.db')
+        copies = [os.path.join(directory, name)
+                  for name in ('replica1.db', 'replica2.db')]
+        uris = ['sqlite:///' + path
+                for path in copies + [os.path.join(directory, 'down/3.db')]]
+
+        for name, value in (('SQLALCHEMY_DATABASE_URI',
+                             'sqlite:///' + primary),
+                            ('SQLALCHEMY_REPLICA_URIS', uris),
+                            ('SQLALCHEMY_REPLICA_CHECK_INTERVAL', 0),
+                            ('SQLALCHEMY_REPLICA_LAG', 60)):
+            self.addCleanup(msg.app.config.__setitem__, name,
+                            msg.app.config[name])
+            msg.app.config[name] = value
+
+        self.addCleanup(msg.db.session.remove)
+        msg.db.session.remove()
+        msg.init_db()
+
+        def replicate():
+            # what's committed, whether in the file or its WAL yet
+            source = sqlite3.connect(primary)
+
+            for path in copies:
+                copy = sqlite3.connect(path)
+                source.backup(copy)
+                copy.close()
+
+            source.close()
+
+        # another client, which hasn't written
+        reader = msg.app.test_client()
+
+        def read(path):
+            response = reader.get(path)
+            return (response.status_code,
+                    json.loads(response.get_data(as_text=True)))
+
+        self.test_create_user()
+        # the replicas have no tables yet, so the primary answers
+        status, response = read('/user/1')
+        assert status == 200
+        assert response['username'] == 'testuser'
+
+        replicate()
+        # logging in reads from a replica; the message is read back
+        # from the primary
+        self.test_post(create_user=False)
+
+        # the author reads their own message from the primary...
+        msg.read_cache.clear()
+        status, response = self.get('/message/1')
+        assert status == 200
+        # ...which may be cached
+        assert msg.read_cache.get('message:1') is not None
+
+        # while the replicas are behind, for everyone else
+        msg.read_cache.clear()
+        status, __ = read('/message/1')
+        assert status == 404
+
+        replicate()
+        status, response = read('/message/1')
+        assert status == 200
+        assert response['text'] == 'I am a message.'
+        # not cached, nor given an ETag, so soon after a change
+        assert msg.read_cache.get('message:1') is None
+        response = reader.get('/messages', content_type='application/json',
+                              data='{"limit": 5, "offset": 0}')
+        assert response.status_code == 200
+        assert 'ETag' not in response.headers
+
+        msg.app.config['SQLALCHEMY_REPLICA_LAG'] = 0
+        read('/message/1')
+        assert msg.read_cache.get('message:1') is not None
+
+        with msg.app.app_context():
+            stats = msg.db.get_replicas().stats()
+
+        assert [stat['healthy'] for stat in stats] == [True, True, False]
+        assert all(stat['reads'] for stat in stats[:2])
+
+        # signed up after the replicas were copied
+        self.test_create_user('kitten', 'yarn', 2)
+        headers = self.make_base64_header('kitten', 'yarn')
+        status, __ = self.post('/message', headers=headers,
+                               data={"text": "mew"})
+        assert status == 200
+
+    def test_post_too_many(self):
+        self.test_create_user()
+        headers = self.make_base64_header("testuser", "testpass")
+        too_many = msg.app.config['LIMITS_MESSAGES_POST_LIMIT'] + 1
+        messages = [{"text": "spam"}] * too_many
+        status, response = self.post('/messages', headers=headers,
+                                     data=messages)
+        assert status == 400
+        fixture = {'message': 'You may only post 20 messages at once.'}
+        assert fixture == response
+
+        status, response = self.post('/messages', headers=headers,
+                                     data=[{"textg": "whoops"}])
+        assert status == 400
+        assert response == {'message': "'text' is a required property"}
+
+    def test_write_query_count(self):
+        """Once the author's credentials are cached, creating
+        a message takes three queries (author, INSERT, search
+        index), editing takes three (UPDATE, SELECT, search
+        index) and deleting takes two (DELETE, search index).
+
+        """
+
+        self.test_post()
+        headers = self.make_base64_header("testuser", "testpass")
+
+        with self.count_queries() as statements:
+            status, response = self.post('/message', headers=headers,
+                                         data={"text": "counted"})
+        assert status == 200
+        assert response["id"] == 2
+        assert response["user"]["username"] == "testuser"
+        assert len(statements) == 3
+
+        with self.count_queries() as statements:
+            status, response = self.put('/message/2', headers=headers,
+                                        data={"text": "recounted"})
+        assert status == 200
+        assert response["text"] == "recounted"
+        assert response["user"]["username"] == "testuser"
+        assert len(statements) == 3
+
+        with self.count_queries() as statements:
+            status, response = self.delete('/message/2', headers=headers)
+        assert status == 200
+        assert len(statements) == 2
+
+    def test_edit_missing_message(self):
+        self.test_create_user()
+        headers = self.make_base64_header("testuser", "testpass")
+        status, response = self.put('/message/5555', headers=headers,
+                                    data={"text": "nope"})
+        assert status == 404
+        assert response == {"message": "Cannot find message by id: 5555"}
+
+    def test_user_messages(self):
+        """Page through one user's messages, newest first,
+        by ID and by username.
+
+        """
+
+        self.test_post_many()
+        self.test_post(create_user=False)
+        self.test_create_user("honkhonk", "honkety", 2)
+        headers = self.make_base64_header("honkhonk", "honkety")
+        self.post('/message', headers=headers, data={"text": "honk"})
+
+        # messages 1-3 were created together, so share a timestamp
+        for url in ('/user/1/messages', '/user/testuser/messages'):
+            status, response = self.get(url, data={"limit": 3})
+            assert status == 200
+            seen = [m["id"] for m in response["messages"]]
+
+            while response["next"] is not None:
+                page_request = {"limit": 3, "cursor": response["next"]}
+                status, response = self.get(url, data=page_request)
+                assert status == 200
+                seen.extend(m["id"] for m in response["messages"])
+
+            assert seen == [4, 3, 2, 1]
+
+        status, response = self.get('/user/honkhonk/messages',
+                                    data={"limit": 3})
+        assert [m["text"] for m in response["messages"]] == ["honk"]
+        assert response["next"] is None
+
+        status, response = self.get('/user/notauser/messages',
+                                    data={"limit": 3})
+        assert status == 404
+        assert response == {"message": "No user matching username: notauser"}
+
+    def test_user_messages_bad_request(self):
+        self.test_post()
+
+        status, response = self.get('/user/1/messages', data={"limit": 0})
+        assert status == 400
+        assert response == {"message": "Request at least 1 message."}
+
+        for key in ([1, 1], ["yesterday", 1], ["2016-01-01T00:00:00", "1"],
+                    [["2016-01-01T00:00:00"], 1]):
+            cursor = msg.encode_cursor('before', key)
+            status, response = self.get('/user/1/messages',
+                                        data={"limit": 2, "cursor": cursor})
+            assert status == 400
+            assert response == {"message": "Invalid cursor."}
+
+    def test_upgrade_db(self):
+        """upgrade_db adds missing indexes without losing data.
+
+        """
+
+        self.test_post()
+
+        with msg.app.app_context():
+            msg.db.engine.execute("DROP INDEX ix_posts_user_id_created")
+            created = msg.upgrade_db()
+            assert created == ['ix_posts_user_id_created']
+            assert msg.upgrade_db() == []
+
+        status, response = self.get('/message/1')
+        assert status == 200
+
+    def test_upgrade_db_columns(self):
+        """upgrade_db adds columns missing from a posts table
+        made by an older msg.
+
+        """
+
+        self.test_create_user()
+
+        with msg.app.app_context():
+            engine = msg.db.engine
+            engine.execute("DROP TABLE posts")
+            engine.execute("CREATE TABLE posts (id INTEGER PRIMARY KEY, "
+                           "user_id INTEGER, created DATETIME, "
+                           "text VARCHAR)")
+            engine.execute("INSERT INTO posts (user_id, created, text) "
+                           "VALUES (1, '2017-01-01 00:00:00', 'old')")
+            engine.execute("DROP TABLE posts_fts")
+            created = msg.upgrade_db()
+
+        assert sorted(created) == ['ix_posts_created_id',
+                                   'ix_posts_user_id_created',
+                                   'posts.edited', 'posts.version',
+                                   'posts_fts']
+        status, response = self.get('/messages/search',
+                                    query_string={'q': 'old'})
+        assert [m['text'] for m in response['messages']] == ["old"]
+        status, response = self.get('/message/1')
+        assert status == 200
+        assert response["text"] == "old"
+
+        headers = self.make_base64_header("testuser", "testpass")
+        status, response = self.put('/message/1', headers=headers,
+                                    data={"text": "new"})
+        assert status == 200
+
+    def test_messages_author_loading(self):
+        """Every way of loading authors gives the same page,
+        in a bounded number of queries.
+
+        """
+
+        self.test_post_many()
+        self.test_create_user("honkhonk", "honkety", 2)
+        headers = self.make_base64_header("honkhonk", "honkety")
+        self.post('/message', headers=headers, data={"text": "honk"})
+        message_range = {"offset": 0, "limit": 10}
+        # loading: (queries, queries once authors are cached)
+        expected_queries = {
+                            'joined': (1, 1),
+                            'selectin': (2, 2),
+                            'subquery': (2, 2),
+                            'none': (2, 1),
+                           }
+        original_loading = msg.config.MESSAGES_AUTHOR_LOADING
+        msg.config.MESSAGES_COLUMNAR = False
+        pages = []
+
+        try:
+            for loading, queries in expected_queries.items():
+                msg.config.MESSAGES_AUTHOR_LOADING = loading
+                msg.read_cache.clear()
+
+                for expected in queries:
+
+                    with self.count_queries() as statements:
+                        status, response = self.get('/messages',
+                                                    data=message_range)
+                    assert status == 200
+                    assert len(statements) == expected, loading
+                    pages.append(response)
+        finally:
+            msg.config.MESSAGES_AUTHOR_LOADING = original_loading
+            msg.config.MESSAGES_COLUMNAR = True
+
+        assert [m["user"]["username"] for m in pages[0]] == [
+                                                             "testuser",
+                                                             "testuser",
+                                                             "testuser",
+                                                             "honkhonk",
+                                                            ]
+        assert all(page == pages[0] for page in pages)
+
+    def test_messages_columnar(self):
+        """Lists of messages built straight from columns are
+        byte-for-byte the same as those built from the ORM.
+
+        """
+
+        self.test_user_messages()
+        requests = [
+                    ('/messages', {"offset": 0, "limit": 10}),
+                    ('/messages', {"limit": 2, "before_id": None}),
+                    ('/user/testuser/messages', {"limit": 10}),
+                   ]
+
+        def get_bodies():
+            bodies = []
+
+            for url, data in requests:
+                msg.read_cache.clear()
+                response = self.app.get(url, data=json.dumps(data),
+                                        content_type='application/json')
+                assert response.status_code == 200
+                bodies.append(response.get_data())
+
+            return bodies
+
+        columnar = get_bodies()
+        msg.config.MESSAGES_COLUMNAR = False
+
+        try:
+            assert get_bodies() == columnar
+        finally:
+            msg.config.MESSAGES_COLUMNAR = True
+
+    def test_stream(self):
+        """Stream clients get events from the worker's hub,
+        and are counted while connected.
+
+        """
+
+        events = self.stream_events()
+        hub = msg.sse.hub
+        assert hub.stats()['connections'] == 1
+
+        hub.dispatch('sse', json.dumps({"data": {"id": 1},
+                                        "type": "message"}))
+        assert next(events) == 'event:message\ndata:{"id": 1}\n\n'
+
+        status, stats = self.get('/stream/stats')
+        assert status == 200
+        assert stats['connections'] == 1
+
+        self.doCleanups()
+        assert hub.stats()['connections'] == 0
+
+    def stream_events(self, **kwargs):
+        """Connect to /stream, and return a generator of
+        the events it sends, skipping keepalives.
+
+        """
+
+        msg.app.config['STREAM_KEEPALIVE'] = 0.01
+
+        try:
+            response = self.app.get('/stream', buffered=False, **kwargs)
+        finally:
+            msg.app.config['STREAM_KEEPALIVE'] = msg.config.STREAM_KEEPALIVE
+
+        self.addCleanup(response.close)
+        return (e.decode('utf-8') for e in response.response
+                if e != b':\n\n')
+
+    def last_event_id(self):
+        with msg.app.app_context():
+            return int(msg.sse.redis.get(msg.sse.ID_KEY) or 0)
+
+    def test_stream_resume(self):
+        """A client reconnecting with a Last-Event-ID is
+        sent the events it missed.
+
+        """
+
+        self.test_post()
+        last_seen = self.last_event_id()
+        self.test_post(create_user=False)
+        self.test_post(create_user=False)
+
+        events = self.stream_events(headers={'Last-Event-ID': last_seen})
+        assert next(events).endswith('id:%d\n\n' % (last_seen + 1))
+        assert next(events).endswith('id:%d\n\n' % (last_seen + 2))
+
+    def test_stream_resume_too_late(self):
+        """A client which missed more than is kept is told
+        to resync.
+
+        """
+
+        self.test_create_user()
+        last_seen = self.last_event_id()
+        msg.app.config['STREAM_REPLAY_SIZE'] = 2
+
+        try:
+            for __ in range(3):
+                self.test_post(create_user=False)
+
+            headers = {'Last-Event-ID': last_seen}
+            events = self.stream_events(headers=headers)
+            assert next(events) == stream.RESYNC
+        finally:
+            msg.app.config['STREAM_REPLAY_SIZE'] = (msg.config.
+                                                    STREAM_REPLAY_SIZE)
+
+    def test_stream_publish_in_order(self):
+        """Events published at once, from several threads, are
+        published in the order of their IDs, each kept for
+        replay as it's published.
+
+        """
+
+        with msg.app.app_context():
+            pubsub = msg.sse.redis.pubsub(ignore_subscribe_messages=True)
+
+        pubsub.subscribe('sse')
+        self.addCleanup(pubsub.close)
+        pubsub.get_message(timeout=1)  # subscribed
+        last_seen = self.last_event_id()
+
+        def publish():
+
+            with msg.app.app_context():
+
+                for i in range(10):
+                    msg.sse.publish({'i': i}, type='test')
+
+        threads = [threading.Thread(target=publish) for __ in range(4)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        published = []
+
+        for __ in range(40):
+            message = pubsub.get_message(timeout=1)
+            published.append(json.loads(message['data'])['id'])
+
+        assert published == list(range(last_seen + 1, last_seen + 41))
+
+        with msg.app.app_context():
+            replayed = msg.sse.replay('sse', last_seen)
+
+        assert [event_id for event_id, __ in replayed] == published
+
+    def test_stream_coalesce(self):
+        """With a coalescing window, posts (by any author) are
+        published to stream clients together: as one "batch"
+        event to those asking for it, one event per message to
+        the rest. Author channels get just their author's.
+
+        """
+
+        self.test_create_user()
+        self.test_create_user('kitten', 'meow', id_=2)
+        msg.app.config['STREAM_COALESCE_WINDOW'] = 60
+        msg.app.config['STREAM_COALESCE_SIZE'] = 2
+
+        try:
+            batched = self.stream_events(query_string={'batch': 1})
+            single = self.stream_events()
+            author = self.stream_events(query_string={
+                'batch': 1, 'channel': 'sse,sse.user.2'
+            })
+            self.test_post(create_user=False)
+            assert len(msg.sse.batcher) == 1
+            self.post('/message', data={"text": "meow"},
+                      headers=self.make_base64_header("kitten", "meow"))
+            assert len(msg.sse.batcher) == 0
+        finally:
+            msg.app.config['STREAM_COALESCE_WINDOW'] = (msg.config.
+                                                        STREAM_COALESCE_WINDOW)
+            msg.app.config['STREAM_COALESCE_SIZE'] = (msg.config.
+                                                      STREAM_COALESCE_SIZE)
+
+        last_id = self.last_event_id()
+        event = next(batched)
+        assert event.startswith('event:batch\n')
+        assert event.endswith('id:%d\n\n' % last_id)
+        assert [e['id'] for e in json.loads(event.split('\n')[1][5:])] == [
+            last_id - 1, last_id
+        ]
+        assert next(single).endswith('id:%d\n\n' % (last_id - 1))
+        assert next(single).endswith('id:%d\n\n' % last_id)
+        # the same batch, not again for the author's channel
+        assert next(author) == event
+
+        with msg.app.app_context():
+            replayed = msg.sse.replay('sse.user.2', last_id - 2)
+
+        assert [event_id for event_id, __ in replayed] == [last_id]
+
+    def test_stream_channels(self):
+        """Messages are also published to their author's (and
+        topics') channels; a client may subscribe to just some
+        channels, but only so many.
+
+        """
+
+        self.test_create_user()
+        self.test_create_user('kitten', 'meow', id_=2)
+        puppy = self.make_base64_header("testuser", "testpass")
+        kitten = self.make_base64_header("kitten", "meow")
+        msg.config.STREAM_TOPIC_CHANNELS = 1
+        self.addCleanup(setattr, msg.config, 'STREAM_TOPIC_CHANNELS',
+                        0)
+
+        events = self.stream_events(query_string={
+            'channel': 'sse.user.2,sse.topic.yarn'
+        })
+        last_seen = self.last_event_id()
+        self.post('/message', headers=puppy, data={"text": "woof"})
+        self.post('/message', headers=kitten, data={"text": "meow"})
+        self.post('/message', headers=puppy, data={"text": "#Yarn #bone"})
+        self.post('/message', headers=kitten, data={"text": "#yarn"})
+
+        texts = [json.loads(next(events).split('\n')[1][5:])['text']
+                 for __ in range(3)]
+        assert texts == ["meow", "#Yarn #bone", "#yarn"]
+
+        # missed events are merged from both channels, too
+        events = self.stream_events(
+            query_string={'channel': ['sse.user.2', 'sse.topic.yarn']},
+            headers={'Last-Event-ID': last_seen},
+        )
+
+        for i in range(2, 5):
+            assert next(events).endswith('id:%d\n\n' % (last_seen + i))
+
+        limit = msg.app.config['STREAM_MAX_CHANNELS']
+        channels = ','.join('sse.user.%d' % i for i in range(limit + 1))
+        response = self.app.get('/stream', query_string={'channel': channels})
+        assert response.status_code == 400
+        response = self.app.get('/stream', query_string={'channel': 'nope'})
+        assert response.status_code == 400
+        assert json.loads(response.get_data(as_text=True)) == {
+            'message': "Invalid channel: nope"
+        }
+
     def test_create_message_without_text(self):
         """Try to create a message without text.
 
@@ -327,6 +1465,156 @@ class TestEverything(unittest.TestCase):
                        }
         assert post_fixture == response
 
+    def test_get_post_cached(self):
+        """Getting the same message twice only queries the
+        database once; editing it is seen straight away.
+
+        """
+
+        self.test_get_post()
+
+        with self.count_queries() as statements:
+            status, response = self.get('/message/1')
+        assert status == 200
+        assert response["text"] == 'I am a message.'
+        assert statements == []
+
+        headers = self.make_base64_header("testuser", "testpass")
+        self.put('/message/1', headers=headers, data={"text": "edited"})
+        status, response = self.get('/message/1')
+        assert status == 200
+        assert response["text"] == "edited"
+        assert response["user"]["username"] == "testuser"
+
+        self.delete('/message/1', headers=headers)
+        status, response = self.get('/message/1')
+        assert status == 404
+
+    def test_get_user_cached(self):
+        """A user's description is cached by ID and by username,
+        and forgotten once they change.
+
+        """
+
+        self.test_get_user()
+
+        with self.count_queries() as statements:
+            self.get('/user/1')
+            status, response = self.get('/user/testuser')
+        assert status == 200
+        assert statements == []
+
+        with msg.app.app_context():
+            user = msg.db.session.query(msg.models.User).get(1)
+            user.bio = "i love kittens"
+            msg.db.session.commit()
+
+        status, response = self.get('/user/testuser')
+        assert response["bio"] == "i love kittens"
+        status, response = self.get('/user/1')
+        assert response["bio"] == "i love kittens"
+
+    def test_get_post_conditional(self):
+        """A client which already has the current version
+        of a message gets a 304, and the database is left
+        alone; once it's edited they get the new version.
+
+        """
+
+        self.test_post()
+        response = self.app.get('/message/1')
+        etag = response.headers['ETag']
+        last_modified = response.headers['Last-Modified']
+
+        with self.count_queries() as statements:
+            response = self.app.get('/message/1',
+                                    headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert response.get_data() == b''
+        assert statements == []
+
+        response = self.app.get('/message/1',
+                                headers={'If-Modified-Since': last_modified})
+        assert response.status_code == 304
+
+        headers = self.make_base64_header("testuser", "testpass")
+        self.put('/message/1', headers=headers, data={"text": "edited"})
+        response = self.app.get('/message/1',
+                                headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert response.headers['ETag'] != etag
+        etag = response.headers['ETag']
+
+        # the author is part of the message, too
+        with msg.app.app_context():
+            user = msg.db.session.query(msg.models.User).get(1)
+            user.bio = "i love kittens"
+            msg.db.session.commit()
+
+        response = self.app.get('/message/1',
+                                headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert response.headers['ETag'] != etag
+        body = json.loads(response.get_data(as_text=True))
+        assert body['user']['bio'] == "i love kittens"
+
+    def test_get_messages_conditional(self):
+        """Lists of messages get a 304 until any message
+        changes, without touching the database.
+
+        """
+
+        self.test_post()
+        message_range = json.dumps({"offset": 0, "limit": 10})
+        response = self.app.get('/messages', data=message_range,
+                                content_type='application/json')
+        etag = response.headers['ETag']
+
+        with self.count_queries() as statements:
+            response = self.app.get('/messages', data=message_range,
+                                    content_type='application/json',
+                                    headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert statements == []
+
+        # a different range is a different list
+        other_range = json.dumps({"offset": 0, "limit": 5})
+        response = self.app.get('/messages', data=other_range,
+                                content_type='application/json',
+                                headers={'If-None-Match': etag})
+        assert response.status_code == 200
+
+        self.test_post(create_user=False)
+        response = self.app.get('/messages', data=message_range,
+                                content_type='application/json',
+                                headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert len(json.loads(response.get_data(as_text=True))) == 2
+
+        # a version only this worker knows can't be trusted
+        self.addCleanup(setattr, msg.board_version, 'redis',
+                        msg.board_version.redis)
+        msg.board_version.redis = None
+        response = self.app.get('/messages', data=message_range,
+                                content_type='application/json')
+        assert response.status_code == 200
+        assert 'ETag' not in response.headers
+
+    def test_get_user_conditional(self):
+        self.test_create_user()
+        response = self.app.get('/user/1')
+        etag = response.headers['ETag']
+        response = self.app.get('/user/1', headers={'If-None-Match': etag})
+        assert response.status_code == 304
+
+        with msg.app.app_context():
+            user = msg.db.session.query(msg.models.User).get(1)
+            user.bio = "i love kittens"
+            msg.db.session.commit()
+
+        response = self.app.get('/user/1', headers={'If-None-Match': etag})
+        assert response.status_code == 200
+
     def test_get_wrong_post(self):
         self.test_post()
         status, response = self.get('/message/2')
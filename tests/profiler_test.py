@@ -0,0 +1,69 @@
+"""Test profiling requests' SQL.
+
+"""
+
+import unittest
+
+import sqlalchemy
+
+from ..msg import profiler
+
+
+class TestShape(unittest.TestCase):
+
+    def test_shape(self):
+        assert (profiler.shape("SELECT * FROM users\n  WHERE id = 12 "
+                               "AND name = 'it''s'")
+                == "SELECT * FROM users WHERE id = ? AND name = ?")
+        # whatever the paramstyle, and however many in a list
+        for statement in ("SELECT * FROM posts_1 WHERE id IN (?, ?, ?)",
+                          "SELECT * FROM posts_1 WHERE id IN (%s, %s)",
+                          "SELECT * FROM posts_1 WHERE id IN (:id_1)",
+                          "SELECT * FROM posts_1 WHERE id IN "
+                          "(%(id_1)s, %(id_2)s)"):
+            assert (profiler.shape(statement)
+                    == "SELECT * FROM posts_1 WHERE id IN (?)")
+
+
+class TestProfile(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 10.0
+        self.profile = profiler.Profile('GET /messages',
+                                        timer=lambda: self.now)
+
+    def test_repeated(self):
+        self.profile.add("SELECT * FROM posts LIMIT ?", (20,), 0.003)
+
+        for user_id in (1, 2, 3):
+            self.profile.add("SELECT * FROM users WHERE id = ?",
+                             (user_id,), 0.001)
+
+        assert self.profile.repeated(3) == [
+            ("SELECT * FROM users WHERE id = ?", 3)
+        ]
+        assert self.profile.repeated(4) == []
+
+        self.now += 0.25
+        lines = self.profile.report(
+            3, {"SELECT * FROM posts LIMIT ?": ["SCAN posts"]}
+        ).splitlines()
+        assert lines == [
+            "GET /messages: 250.0 ms, 4 queries (6.0 ms)",
+            "  1 x 3.0 ms: SELECT * FROM posts LIMIT ?",
+            "    SCAN posts",
+            "  3 x 3.0 ms (N+1?): SELECT * FROM users WHERE id = ?",
+        ]
+
+    def test_explain(self):
+        engine = sqlalchemy.create_engine('sqlite://')
+
+        with engine.connect() as connection:
+            connection.execute("CREATE TABLE users (id INTEGER PRIMARY KEY, "
+                               "name TEXT)")
+            plan = profiler.explain(connection,
+                                    "SELECT * FROM users WHERE id = ?", (1,))
+            assert len(plan) == 1 and plan[0].startswith('SEARCH users')
+            assert profiler.explain(connection,
+                                    "DELETE FROM users WHERE id = ?",
+                                    (1,)) == []
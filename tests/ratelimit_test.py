@@ -0,0 +1,163 @@
+"""Test counting rate limits locally, synced with Redis.
+
+"""
+
+import unittest
+
+import limits
+import limits.storage
+import limits.strategies
+
+from ..msg import config
+from ..msg import ratelimit
+from .cache_test import FakeClock
+
+
+KEY = 'LIMITER/kitten/100/1/minute'
+
+
+class TestTwoTierStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.workers = [self.worker(), self.worker()]
+        self.workers[0].reset()
+
+    def worker(self, uri='tiered+redis://localhost:6379', **options):
+        options.setdefault('error', 0.1)
+        return ratelimit.TwoTierStorage(uri, timer=self.clock, **options)
+
+    def test_scheme(self):
+        storage = limits.storage.storage_from_string(
+            'tiered+redis://localhost:6379'
+        )
+        assert isinstance(storage, ratelimit.TwoTierStorage)
+        assert storage.check()
+
+    def test_error_bound(self):
+        """Each worker counts up to its share of the error
+        before syncing, and then learns the others' counts.
+
+        """
+
+        kitten, puppy = self.workers
+        assert kitten.incr(KEY, 60) == 1
+        assert kitten.syncs == 1
+
+        for __ in range(10):
+            kitten.incr(KEY, 60)
+
+        assert kitten.syncs == 1
+        assert kitten.get(KEY) == 11
+        assert puppy.incr(KEY, 60) == 2
+        assert kitten.incr(KEY, 60) == 13
+        assert kitten.syncs == 2
+        assert puppy.get(KEY) == 2
+
+    def test_sync_interval(self):
+        kitten, puppy = self.workers
+        kitten.incr(KEY, 60)
+        puppy.incr(KEY, 60)
+        assert kitten.incr(KEY, 60) == 2
+
+        self.clock.now = 1
+        assert kitten.incr(KEY, 60) == 4
+        assert kitten.syncs == 2
+
+    def test_window_ends(self):
+        kitten = self.workers[0]
+        kitten.incr(KEY, 60)
+        assert kitten.get_expiry(KEY) == 60
+
+        self.clock.now = 60
+        assert kitten.get(KEY) == 0
+        assert kitten.get_expiry(KEY) == 60
+
+    def test_exact(self):
+        """With no error, limits are exactly shared."""
+
+        # strategies only keep weak references to storages
+        storages = [self.worker(error=0) for __ in range(2)]
+        workers = [limits.strategies.FixedWindowRateLimiter(storage)
+                   for storage in storages]
+        item = limits.parse("3 per minute")
+        hits = [workers[i % 2].hit(item, 'kitten') for i in range(4)]
+        assert hits == [True, True, True, False]
+
+    def test_burst_across_nodes(self):
+        """However a burst is spread over two nodes, no more
+        than each one's share of the error gets through over
+        the limit.
+
+        """
+
+        item = limits.parse("100 per minute")
+        slack = 10  # 0.1 of 100, per node
+
+        for spread in ('alternate', 'kitten first', 'puppy late'):
+            self.workers[0].reset()
+            storages = [self.worker() for __ in range(2)]
+            nodes = [limits.strategies.FixedWindowRateLimiter(storage)
+                     for storage in storages]
+
+            if spread == 'alternate':
+                order = [i % 2 for i in range(300)]
+            elif spread == 'kitten first':
+                order = [0] * 150 + [1] * 150
+            else:
+                order = [0] * 95 + [1] * 205
+
+            allowed = sum(nodes[node].hit(item, 'burst') for node in order)
+            assert 100 <= allowed <= 100 + 2 * slack, spread
+
+    def test_configured_limits(self):
+        """msg's own limits are mostly too small for their
+        share of the error to spare any syncs, but `min_slack`,
+        and refusing hits past a limit without asking, still
+        spare most of a burst's; a limit of one stays exact.
+
+        """
+
+        items = [limits.parse(limit) for limit in config.LIMITS_GLOBAL]
+        items.extend(limits.parse(getattr(config, name))
+                     for name in dir(config)
+                     if name.startswith('LIMITS_')
+                     and isinstance(getattr(config, name), str))
+        syncs = {}
+
+        for min_slack in (0, 2):
+            self.workers[0].reset()
+            kitten = self.worker(min_slack=min_slack)
+            nodes = limits.strategies.FixedWindowRateLimiter(kitten)
+
+            # a burst of 5 hits on each, within the sync interval
+            for item in items:
+                allowed = sum(nodes.hit(item, 'kitten') for __ in range(5))
+
+                if item.amount == 1:
+                    assert allowed == 1
+
+            syncs[min_slack] = kitten.syncs
+
+        hits = 5 * len(items)
+        # past a limit, a burst's hits aren't synced...
+        assert syncs[0] < hits / 2
+        # ...nor, before it, are the first few
+        assert syncs[2] < syncs[0]
+        assert syncs[2] < hits / 5
+
+    def test_redis_down(self):
+        """Without Redis, each worker counts by itself."""
+
+        kitten = self.worker('tiered+redis://localhost:1')
+
+        for __ in range(3):
+            kitten.incr(KEY, 60)
+
+        assert kitten.get(KEY) == 3
+        assert kitten.errors == 1
+        assert not kitten.check()
+
+
+if __name__ == '__main__':
+    unittest.main()
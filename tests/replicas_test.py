@@ -0,0 +1,55 @@
+"""Test choosing replicas to read from.
+
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from ..msg import replicas
+
+
+class TestReplicaSet(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 100.0
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.uris = ['sqlite:///' + os.path.join(self.directory, name)
+                     for name in ('a.db', 'b.db', 'missing/c.db')]
+        self.replicas = replicas.ReplicaSet(self.uris, check_interval=5,
+                                            timer=lambda: self.now)
+        self.addCleanup(self.replicas.dispose)
+
+    def test_round_robin(self):
+        chosen = [self.replicas.choose() for __ in range(4)]
+        assert [str(engine.url) for engine in chosen] == (
+            self.uris[:2] + self.uris[:2]
+        )
+        stats = self.replicas.stats()
+        assert [stat['reads'] for stat in stats] == [2, 2, 0]
+        assert [stat['healthy'] for stat in stats] == [True, True, False]
+
+    def test_health_checks(self):
+        for __ in self.uris:
+            self.replicas.choose()
+
+        checked = list(self.replicas.checked)
+        assert None not in checked
+
+        # the missing one isn't checked again till it's due
+        self.now += 1
+        self.replicas.choose()
+        self.replicas.choose()
+        assert self.replicas.checked == checked
+
+        os.mkdir(os.path.join(self.directory, 'missing'))
+        self.now += 5
+        chosen = [str(self.replicas.choose().url) for __ in range(3)]
+        assert sorted(chosen) == sorted(self.uris)
+
+    def test_none_up(self):
+        down = replicas.ReplicaSet(['sqlite:////nowhere/at/all.db'])
+        assert down.choose() is None
+        assert replicas.ReplicaSet([]).choose() is None
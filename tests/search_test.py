@@ -0,0 +1,84 @@
+"""Test the pure Python search index.
+
+"""
+
+import unittest
+
+import sqlalchemy
+
+from ..msg import search
+
+
+class TestMemorySearch(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = sqlalchemy.create_engine('sqlite://')
+        self.engine.execute("CREATE TABLE posts (id INTEGER PRIMARY KEY, "
+                            "text VARCHAR)")
+        self.engine.execute("INSERT INTO posts (text) VALUES ('kitten'), "
+                            "('kitten kitten kitten yarn'), ('yarn')")
+        self.index = search.MemorySearch()
+
+    def test_words(self):
+        assert search.words("Kitten's yarn-ball!") == ['kitten', 's',
+                                                       'yarn', 'ball']
+        assert search.words(None) == []
+
+    def test_loads_on_first_search(self):
+        # not loaded yet, so there's nothing to add to
+        self.index.add(self.engine, [(4, 'kitten')])
+        assert len(self.index) == 0
+
+        results = self.index.search(self.engine, 'kitten', 10)
+        assert [message_id for __, message_id in results] == [2, 1]
+        assert len(self.index) == 3
+
+    def test_every_word(self):
+        results = self.index.search(self.engine, 'yarn KITTEN', 10)
+        assert [message_id for __, message_id in results] == [2]
+        assert self.index.search(self.engine, 'puppy kitten', 10) == []
+        assert self.index.search(self.engine, '!!!', 10) == []
+
+    def test_after(self):
+        first, second = self.index.search(self.engine, 'kitten', 10)
+        assert self.index.search(self.engine, 'kitten', 10,
+                                 list(first)) == [second]
+        assert self.index.search(self.engine, 'kitten', 1) == [first]
+
+    def test_changes(self):
+        self.index.rebuild(self.engine)
+        self.index.add(self.engine, [(4, 'a kitten')])
+        self.index.update(self.engine, [(2, 'yarn')])
+        self.index.remove(self.engine, [1])
+        results = self.index.search(self.engine, 'kitten', 10)
+        assert [message_id for __, message_id in results] == [4]
+        results = self.index.search(self.engine, 'yarn', 10)
+        assert sorted(message_id for __, message_id in results) == [2, 3]
+
+    def test_changes_once_committed(self):
+        """Changes made through a session are only seen once
+        it commits; never, if it rolls back.
+
+        """
+
+        self.index.rebuild(self.engine)
+        session = sqlalchemy.orm.Session(bind=self.engine)
+        session.execute("INSERT INTO posts (id, text) VALUES (4, 'kitten')")
+        self.index.add(session, [(4, 'kitten')])
+        self.index.remove(session, [1])
+        results = self.index.search(self.engine, 'kitten', 10)
+        assert [message_id for __, message_id in results] == [2, 1]
+
+        session.rollback()
+        results = self.index.search(self.engine, 'kitten', 10)
+        assert [message_id for __, message_id in results] == [2, 1]
+
+        self.index.add(session, [(4, 'kitten')])
+        self.index.remove(session, [1])
+        session.commit()
+        results = self.index.search(self.engine, 'kitten', 10)
+        assert sorted(message_id for __, message_id in results) == [2, 4]
+
+
+if __name__ == '__main__':
+    unittest.main()
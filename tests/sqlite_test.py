@@ -0,0 +1,169 @@
+"""Test running on a SQLite file.
+
+"""
+
+import os
+import time
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+import sqlalchemy
+
+from ..msg import sqlite
+
+
+PRAGMAS = {"journal_mode": "WAL", "busy_timeout": 5000}
+
+
+class TestSQLite(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.url = 'sqlite:///' + os.path.join(directory, 'msg.db')
+
+    def make_engine(self, single_writer=True, pragmas=PRAGMAS):
+        options = {}
+        sqlite.engine_options(options, pool_size=4)
+        engine = sqlalchemy.create_engine(self.url, **options)
+        sqlite.tune(engine, pragmas, single_writer)
+        self.addCleanup(engine.dispose)
+
+        with engine.begin() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS counts "
+                               "(id INTEGER PRIMARY KEY, n INTEGER)")
+            connection.execute("INSERT OR IGNORE INTO counts VALUES (1, 0)")
+
+        return engine
+
+    def test_is_file(self):
+        make_url = sqlalchemy.engine.url.make_url
+        assert sqlite.is_file(make_url(self.url))
+        assert not sqlite.is_file(make_url('sqlite://'))
+        assert not sqlite.is_file(make_url('sqlite:///:memory:'))
+        assert not sqlite.is_file(make_url('postgresql://localhost/msg'))
+
+    def test_pragmas(self):
+        engine = self.make_engine()
+        assert isinstance(engine.pool, sqlalchemy.pool.QueuePool)
+
+        with engine.connect() as connection:
+            assert connection.scalar("PRAGMA journal_mode") == 'wal'
+            assert connection.scalar("PRAGMA busy_timeout") == 5000
+
+    def read_then_write(self, engine):
+        """Read in one transaction, write (and commit) in
+        another, then write in the first.
+
+        """
+
+        first = engine.connect()
+        self.addCleanup(first.close)
+        transaction = first.begin()
+        n = first.scalar("SELECT n FROM counts WHERE id = 1")
+
+        with engine.begin() as second:
+            second.execute("UPDATE counts SET n = n + 1 WHERE id = 1")
+
+        first.execute("UPDATE counts SET n = ? WHERE id = 1", n + 10)
+        transaction.commit()
+
+    def test_read_then_write(self):
+        engine = self.make_engine(single_writer=False)
+
+        with self.assertRaises(sqlalchemy.exc.OperationalError) as context:
+            self.read_then_write(engine)
+
+        assert 'database is locked' in str(context.exception)
+
+        # the second transaction's write, before, went through
+        engine = self.make_engine()
+        self.read_then_write(engine)
+        assert engine.scalar("SELECT n FROM counts WHERE id = 1") == 11
+
+    def test_same_thread(self):
+        """A second connection writing on the thread of one
+        already writing is told so straight away, rather than
+        waiting for a lock which can't be let go.
+
+        """
+
+        engine = self.make_engine()
+        first = engine.connect()
+        self.addCleanup(first.close)
+        transaction = first.begin()
+        first.execute("UPDATE counts SET n = 1 WHERE id = 1")
+        started = time.time()
+
+        with self.assertRaises(sqlalchemy.exc.OperationalError) as context:
+
+            with engine.begin() as second:
+                second.execute("UPDATE counts SET n = 2 WHERE id = 1")
+
+        assert time.time() - started < 1  # not busy_timeout
+        assert 'on this thread' in str(context.exception)
+
+        transaction.commit()
+
+        with engine.begin() as second:
+            second.execute("UPDATE counts SET n = n + 2 WHERE id = 1")
+
+        assert engine.scalar("SELECT n FROM counts WHERE id = 1") == 3
+
+    def test_single_writer(self, pragmas=PRAGMAS):
+        engine = self.make_engine(pragmas=pragmas)
+        errors = []
+
+        def increment():
+
+            try:
+
+                for __ in range(20):
+
+                    with engine.begin() as connection:
+                        n = connection.scalar("SELECT n FROM counts "
+                                              "WHERE id = 1")
+                        connection.execute("UPDATE counts SET n = ? "
+                                           "WHERE id = 1", n + 1)
+            except sqlalchemy.exc.OperationalError as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=increment) for __ in range(8)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        assert errors == []
+        # each write began again after its read, so some are lost
+        assert 0 < engine.scalar("SELECT n FROM counts WHERE id = 1") <= 160
+
+    def test_released_once_committed(self):
+        """The next writer only goes once the last has
+        committed, so needn't wait on SQLite at all.
+
+        """
+
+        engine = self.make_engine()
+        other = sqlite3.connect(self.url[len('sqlite:///'):], timeout=0,
+                                isolation_level=None)
+        self.addCleanup(other.close)
+        began = []
+
+        # after the lock's let go
+        @sqlalchemy.event.listens_for(engine, 'commit')
+        def begin_immediate(connection):
+            other.execute("BEGIN IMMEDIATE")
+            other.execute("ROLLBACK")
+            began.append(True)
+
+        with engine.begin() as connection:
+            connection.execute("UPDATE counts SET n = 1 WHERE id = 1")
+
+        assert began == [True]
+        self.test_single_writer(dict(PRAGMAS, busy_timeout=0))
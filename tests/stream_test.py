@@ -0,0 +1,221 @@
+"""Test fanning server-sent events out to stream clients.
+
+"""
+
+import json
+import threading
+import unittest
+
+from ..msg import stream
+
+
+def published(data, type_=None, id_=None):
+    """What flask_sse publishes to Redis for an event."""
+
+    event = {"data": data, "id": id_}
+
+    if type_:
+        event["type"] = type_
+
+    return json.dumps(event).encode('utf-8')
+
+
+class TestHub(unittest.TestCase):
+
+    def setUp(self):
+        self.hub = stream.Hub(None, queue_size=2)
+
+    def test_fan_out(self):
+        kitten = self.hub.subscribe(['sse'])
+        puppy = self.hub.subscribe(['sse'])
+        other = self.hub.subscribe(['sse.other'])
+        self.hub.dispatch(b'sse', published({"id": 1}, 'message', 7))
+
+        expected = (7, 'event:message\ndata:{"id": 1}\nid:7\n\n')
+        assert kitten.get(0) == expected
+        assert puppy.get(0) == expected
+        assert other.get(0) is None
+        assert self.hub.stats()['events'] == 1
+
+    def test_drop_slow_consumer(self):
+        slow = self.hub.subscribe(['sse'])
+
+        for i in range(3):
+            self.hub.dispatch('sse', published(i))
+
+        assert slow.closed
+        assert slow.get(0) is None
+        stats = self.hub.stats()
+        assert stats['dropped'] == 1
+        assert stats['connections'] == 0
+
+    def test_coalesce_slow_consumer(self):
+        self.hub.slow_consumer = 'coalesce'
+        slow = self.hub.subscribe(['sse'])
+
+        for i in range(3):
+            self.hub.dispatch('sse', published(i))
+
+        assert not slow.closed
+        assert slow.get(0) == (None, stream.RESYNC)
+        assert slow.get(0) == (None, 'data:2\n\n')
+        assert self.hub.stats()['coalesced'] == 1
+
+    def test_stats(self):
+        kitten = self.hub.subscribe(['sse', 'sse.kitten'])
+        self.hub.subscribe(['sse'])
+        self.hub.dispatch('sse.kitten', published("meow"))
+        stats = self.hub.stats()
+        assert stats['connections'] == 2
+        assert stats['channels'] == 2
+        assert stats['queue_depth'] == 1
+        assert stats['max_queue_depth'] == 1
+
+        self.hub.unsubscribe(kitten)
+        assert kitten.closed
+        assert self.hub.stats()['connections'] == 1
+
+    def test_several_channels(self):
+        """An event published to several channels is only
+        queued once for a client subscribed to them all.
+
+        """
+
+        kitten = self.hub.subscribe(['sse', 'sse.user.1'])
+        self.hub.dispatch('sse', published("meow", id_=3))
+        self.hub.dispatch('sse.user.1', published("meow", id_=3))
+        self.hub.dispatch('sse.user.1', published("purr", id_=4))
+
+        assert kitten.get(0) == (3, 'data:meow\nid:3\n\n')
+        assert kitten.get(0) == (4, 'data:purr\nid:4\n\n')
+        assert kitten.get(0) is None
+
+    def test_batch(self):
+        """Batch clients get a batch as one event, the rest
+        get one event per message.
+
+        """
+
+        batched = self.hub.subscribe(['sse'], batch=True)
+        single = self.hub.subscribe(['sse'])
+        batch = [{"data": 1, "id": 5, "type": "message"},
+                 {"data": 2, "id": 6, "type": "message"}]
+        self.hub.dispatch('sse', json.dumps({"batch": batch}))
+
+        expected = ('event:batch\ndata:' + json.dumps(batch) + '\nid:6\n\n')
+        assert batched.get(0) == (6, expected)
+        assert batched.get(0) is None
+        assert single.get(0) == (5, 'event:message\ndata:1\nid:5\n\n')
+        assert single.get(0) == (6, 'event:message\ndata:2\nid:6\n\n')
+        assert self.hub.stats()['events'] == 2
+
+    def test_batch_several_channels(self):
+        """A batch client on several channels gets each event
+        once, however the channels' batches overlap.
+
+        """
+
+        kitten = self.hub.subscribe(['sse', 'sse.user.1'], batch=True)
+        batch = [{"data": i, "id": i} for i in range(1, 4)]
+        self.hub.dispatch('sse', json.dumps({"batch": batch}))
+        self.hub.dispatch('sse.user.1', json.dumps({"batch": batch[1:]}))
+        self.hub.dispatch('sse.user.1', json.dumps({"batch": [
+            batch[2], {"data": 4, "id": 4}
+        ]}))
+
+        assert kitten.get(0)[0] == 3
+        assert kitten.get(0) == (4, 'data:4\nid:4\n\n')
+        assert kitten.get(0) is None
+
+        self.hub.dispatch('sse', json.dumps({"batch": [
+            {"data": 6, "id": 6}, {"data": 7, "id": 7}, batch[0]
+        ]}))
+        event = kitten.get(0)
+        assert event[0] == 7
+        assert event[1].startswith('event:batch\ndata:[{"data": 6')
+
+
+class PubSub(object):
+    """Just enough of a Redis PubSub for `Hub.listen`: plays
+    back `messages`, raising any exception among them.
+
+    """
+
+    def __init__(self, messages):
+        self.messages = messages
+
+    def psubscribe(self, pattern):
+        pass
+
+    def listen(self):
+
+        for message in self.messages:
+
+            if isinstance(message, Exception):
+                raise message
+
+            yield {'type': 'pmessage', 'channel': b'sse', 'data': message}
+
+        threading.Event().wait()
+
+
+class PubSubRedis(object):
+    """Hands out one `PubSub` per connection."""
+
+    def __init__(self, *connections):
+        self.connections = list(connections)
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        return PubSub(self.connections.pop(0))
+
+
+class TestListen(unittest.TestCase):
+
+    def test_malformed(self):
+        """A message that can't be dispatched is skipped,
+        and any other failure resubscribes, without leaving
+        clients already connected behind.
+
+        """
+
+        redis_client = PubSubRedis(
+            [b'not json', b'[1]', published("meow", id_=1),
+             RuntimeError("oops")],
+            [published("purr", id_=2)],
+        )
+        hub = stream.Hub(redis_client)
+        kitten = hub.subscribe(['sse'])
+        assert kitten.get(5) == (1, 'data:meow\nid:1\n\n')
+        assert kitten.get(5) == (2, 'data:purr\nid:2\n\n')
+        assert hub._listener.is_alive()
+        assert hub.stats()['malformed'] == 2
+
+
+class TestBatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.sent = []
+        self.batcher = stream.Batcher(
+            lambda channel, items: self.sent.append((channel, items))
+        )
+        self.addCleanup(self.batcher.flush)
+
+    def test_full(self):
+        for i in range(5):
+            self.batcher.add('sse', i, 60, 2)
+
+        assert self.sent == [('sse', [0, 1]), ('sse', [2, 3])]
+        assert len(self.batcher) == 1
+
+    def test_window(self):
+        self.batcher.add('sse', 'kitten', 0.1, 10)
+        timer = self.batcher._timer
+        self.batcher.add('sse.other', 'puppy', 0.1, 10)
+        assert self.sent == []
+        timer.join(1)
+        assert self.sent == [('sse', ['kitten']), ('sse.other', ['puppy'])]
+        assert self.batcher.batches == 2
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+"""Test the compiled JSON schema registry.
+
+"""
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+import jsonschema
+
+from ..msg import validation
+
+
+SCHEMA = {
+          "type": "object",
+          "properties": {
+                         "text": {"type": "string"},
+                         "before_id": {"type": ["integer", "null"]},
+                        },
+          "required": ["text"],
+         }
+
+
+class TestSchemaRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.schemas = validation.SchemaRegistry()
+        self.schemas.register('message', SCHEMA)
+
+    def assert_same_verdict(self, instance):
+        """The registry must agree with `jsonschema.validate`,
+        down to the error message.
+
+        """
+
+        try:
+            jsonschema.validate(instance, SCHEMA)
+        except jsonschema.ValidationError as e:
+            expected = e.message
+        else:
+            expected = None
+
+        try:
+            self.schemas.validate(instance, 'message')
+        except jsonschema.ValidationError as e:
+            actual = e.message
+        else:
+            actual = None
+
+        assert expected == actual
+
+    def test_same_verdict_as_jsonschema(self):
+        instances = [
+                     {"text": "hi"},
+                     {"text": "hi", "before_id": None},
+                     {"text": "hi", "before_id": 5},
+                     {"text": "hi", "before_id": 5.0},
+                     {"text": "hi", "before_id": True},
+                     {"text": 5},
+                     {"textg": "whoops"},
+                     [],
+                     None,
+                    ]
+
+        for instance in instances:
+            self.assert_same_verdict(instance)
+
+    def test_fast_path(self):
+        assert self.schemas.get('message').fast_path is not None
+
+        fancy = {"type": "object", "minProperties": 1}
+        assert self.schemas.get(fancy).fast_path is None
+        assert self.schemas.get(fancy) is self.schemas.get(fancy)
+
+    def test_bad_schema(self):
+        with self.assertRaises(jsonschema.SchemaError):
+            self.schemas.register('bad', {"type": "kitten"})
+
+    def test_load_directory(self):
+        path = tempfile.mkdtemp()
+
+        try:
+            with open(os.path.join(path, 'bio.json'), 'w') as f:
+                json.dump({"type": "object", "required": ["bio"]}, f)
+
+            with open(os.path.join(path, 'README.md'), 'w') as f:
+                f.write("not a schema")
+
+            assert self.schemas.load_directory(path) == ['bio']
+            assert 'bio' in self.schemas
+
+            with self.assertRaises(jsonschema.ValidationError):
+                self.schemas.validate({}, 'bio')
+        finally:
+            shutil.rmtree(path)
+
+        assert self.schemas.load_directory(path) == []
+
+
+if __name__ == '__main__':
+    unittest.main()